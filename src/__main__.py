@@ -1,26 +1,313 @@
+import json
 import click 
+import asyncio
 
 from dotenv import load_dotenv
+from typing import Optional
 
-from anthropic_openai import AgentLoop, Role, ChatMessage, StopReason
-from anthropic_openai.settings import Credentials
+from anthropic_openai import AgentLoop, AsyncAgentLoop, Role, ChatMessage, StopReason
+from anthropic_openai.settings import Credentials, RateLimits, SearchCacheSettings, TelemetrySettings, ResearchSettings, AggregationSettings, ResilienceSettings, TranscriptSettings, PrefetchSettings
+from anthropic_openai.cache import SearchCache
+from anthropic_openai.history import HistoryCompactor
+from anthropic_openai.throttling import request_scheduler, ProviderLimits
+from anthropic_openai.resilience import resilience, ResiliencePolicy
+from anthropic_openai.telemetry import telemetry
+from anthropic_openai.sinks import TerminalSink, StructuredSink, NullSink, current_sink
+from anthropic_openai.mock_providers import ProviderProfile
+from anthropic_openai.benchmarks import EngineBenchmarkConfig, run_engine_benchmark, write_results, AccumulatorBenchmarkConfig, run_accumulator_benchmark
+from anthropic_openai.distributed import SearchBroker, SearchWorker, RemoteSearchClient
+from anthropic_openai.sessions import SessionStore
+from anthropic_openai.novelty import NoveltyScheduler
+from anthropic_openai.aggregation import SearchAggregator
+from anthropic_openai.transcript import TranscriptStore
+from anthropic_openai.prefetch import SearchPrefetcher
+from anthropic_openai.server import SessionServer
+from anthropic_openai.batch import BatchRunner, BatchWriter, BatchProgress, load_items, load_done_ids
+from anthropic_openai.log import logger
+
+OFFLINE_COMMANDS = ('benchmark', 'benchmark-accumulator', 'broker')
+
+def make_research_scheduler(research_settings:ResearchSettings) -> Optional[NoveltyScheduler]:
+    if not research_settings.adaptive and research_settings.max_seconds is None and research_settings.max_tokens is None:
+        return None
+    # budgets alone are enforced without novelty based stopping
+    return NoveltyScheduler(
+        min_novelty=research_settings.min_novelty if research_settings.adaptive else 0.0,
+        shrink_novelty=research_settings.shrink_novelty if research_settings.adaptive else 0.0,
+        patience=research_settings.patience,
+        max_seconds=research_settings.max_seconds,
+        max_tokens=research_settings.max_tokens
+    )
+
+def make_search_aggregator(aggregation_settings:AggregationSettings) -> Optional[SearchAggregator]:
+    if not aggregation_settings.enabled:
+        return None
+    return SearchAggregator(token_budget=aggregation_settings.token_budget, similarity_threshold=aggregation_settings.similarity_threshold)
+
+def make_transcript_store(transcript_settings:TranscriptSettings) -> Optional[TranscriptStore]:
+    if transcript_settings.path is None or transcript_settings.path == '':
+        return None
+    return TranscriptStore(path=transcript_settings.path, snapshot_every=transcript_settings.snapshot_every, fsync=transcript_settings.fsync)
+
+def make_search_prefetcher(prefetch_settings:PrefetchSettings) -> Optional[SearchPrefetcher]:
+    if not prefetch_settings.enabled:
+        return None
+    return SearchPrefetcher(max_inflight=prefetch_settings.max_inflight, max_per_job=prefetch_settings.max_per_job, search_context_size=prefetch_settings.search_context_size)
 
 @click.group(chain=False, invoke_without_command=True)
 @click.pass_context
 def group_handler(ctx:click.core.Context):
     ctx.ensure_object(dict)
     ctx.obj['settings'] = {
-        'credentials': Credentials()
+        'credentials': Credentials() if ctx.invoked_subcommand not in OFFLINE_COMMANDS else None,
+        'rate_limits': RateLimits(),
+        'search_cache': SearchCacheSettings(),
+        'telemetry': TelemetrySettings(),
+        'research': ResearchSettings(),
+        'aggregation': AggregationSettings(),
+        'resilience': ResilienceSettings(),
+        'transcripts': TranscriptSettings(),
+        'prefetch': PrefetchSettings()
     }
+    rate_limits:RateLimits = ctx.obj['settings']['rate_limits']
+    request_scheduler.configure('anthropic', ProviderLimits(
+        max_concurrency=rate_limits.anthropic_max_concurrency, 
+        requests_per_minute=rate_limits.anthropic_requests_per_minute, 
+        tokens_per_minute=rate_limits.anthropic_tokens_per_minute
+    ))
+    request_scheduler.configure('openai', ProviderLimits(
+        max_concurrency=rate_limits.openai_max_concurrency, 
+        requests_per_minute=rate_limits.openai_requests_per_minute, 
+        tokens_per_minute=rate_limits.openai_tokens_per_minute
+    ))
+    resilience_settings:ResilienceSettings = ctx.obj['settings']['resilience']
+    resilience.configure('anthropic', ResiliencePolicy(
+        timeout=resilience_settings.anthropic_timeout,
+        max_retries=resilience_settings.anthropic_max_retries,
+        backoff_base=resilience_settings.backoff_base,
+        backoff_max=resilience_settings.backoff_max,
+        breaker_failure_threshold=resilience_settings.breaker_failure_threshold,
+        breaker_reset_timeout=resilience_settings.breaker_reset_timeout
+    ))
+    resilience.configure('openai', ResiliencePolicy(
+        timeout=resilience_settings.openai_timeout,
+        max_retries=resilience_settings.openai_max_retries,
+        backoff_base=resilience_settings.backoff_base,
+        backoff_max=resilience_settings.backoff_max,
+        hedge=resilience_settings.search_hedge,
+        hedge_quantile=resilience_settings.search_hedge_quantile,
+        hedge_min_delay=resilience_settings.search_hedge_min_delay,
+        breaker_failure_threshold=resilience_settings.breaker_failure_threshold,
+        breaker_reset_timeout=resilience_settings.breaker_reset_timeout
+    ))
+    telemetry_settings:TelemetrySettings = ctx.obj['settings']['telemetry']
+    if telemetry_settings.enabled and ctx.invoked_subcommand != 'benchmark':
+        telemetry.configure(enabled=True, trace_path=telemetry_settings.trace_path, prometheus_path=telemetry_settings.prometheus_path)
+        ctx.call_on_close(telemetry.close)
+
 
+@group_handler.command()
+@click.option('--use-asyncio', is_flag=True, default=False, help='run the session on the asyncio engine')
+@click.option('--compaction-threshold', type=int, default=None, help='compact older tool results once a deep research prompt exceeds this many tokens')
+@click.option('--broker-address', type=str, default=None, help='send web searches to the worker pool behind this broker frontend, e.g. tcp://localhost:5555')
+@click.option('--remote-deep-research', is_flag=True, default=False, help='also run whole deep_iterative_web_search jobs on the worker pool')
+@click.option('--output-format', type=click.Choice(['terminal', 'jsonl', 'none']), default='terminal', help='render the stream for a terminal, as one json event per line, or not at all')
+@click.option('--partial-tool-input', is_flag=True, default=False, help='with jsonl output, also emit the arguments of a tool call while they stream')
+@click.option('--session', 'session_id', type=str, default=None, help='continue the session with this id from its transcript')
+@click.pass_context
+def launch_engine(ctx:click.core.Context, use_asyncio:bool, compaction_threshold:Optional[int], broker_address:Optional[str], remote_deep_research:bool, output_format:str, partial_tool_input:bool, session_id:Optional[str]):
+    settings = ctx.obj['settings']
+    credentials:Credentials = settings['credentials']
+    search_cache_settings:SearchCacheSettings = settings['search_cache']
+    search_cache = SearchCache(path=search_cache_settings.path, max_entries=search_cache_settings.max_entries, ttl=search_cache_settings.ttl)
+    history_compactor = HistoryCompactor(threshold_tokens=compaction_threshold) if compaction_threshold is not None else None
+    remote_search = RemoteSearchClient(broker_address) if broker_address is not None else None
+    match output_format:
+        case 'jsonl':
+            sink = StructuredSink(partial_tool_input=partial_tool_input)
+        case 'none':
+            sink = NullSink()
+        case _:
+            sink = TerminalSink()
+    current_sink.set(sink)
+    try:
+        if use_asyncio:
+            async def main() -> None:
+                async with AsyncAgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key, search_cache=search_cache, history_compactor=history_compactor, remote_search=remote_search, remote_deep_research=remote_deep_research, research_scheduler=make_research_scheduler(settings['research']), search_aggregator=make_search_aggregator(settings['aggregation']), search_prefetcher=make_search_prefetcher(settings['prefetch']), transcript_store=make_transcript_store(settings['transcripts'])) as agent_loop:
+                    await agent_loop.run(session_id)
+            asyncio.run(main())
+            return
+        with AgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key, search_cache=search_cache, history_compactor=history_compactor, remote_search=remote_search, remote_deep_research=remote_deep_research, research_scheduler=make_research_scheduler(settings['research']), search_aggregator=make_search_aggregator(settings['aggregation']), search_prefetcher=make_search_prefetcher(settings['prefetch']), transcript_store=make_transcript_store(settings['transcripts'])) as agent_loop:
+            agent_loop.run(session_id)
+    finally:
+        sink.close()
+        if remote_search is not None:
+            remote_search.close()
+        search_cache.close()
 
 @group_handler.command()
+@click.option('--host', type=str, default='127.0.0.1')
+@click.option('--port', type=int, default=8000)
+@click.option('--max-sessions', type=int, default=1024, help='idle sessions beyond this number are evicted, least recently used first')
+@click.option('--session-ttl', type=float, default=3600.0, help='seconds of inactivity after which a session is evicted')
+@click.option('--max-pending-events', type=int, default=256, help='stream events buffered per client before the turn waits for a slow reader')
+@click.option('--compaction-threshold', type=int, default=None, help='compact older tool results once a deep research prompt exceeds this many tokens')
+@click.option('--broker-address', type=str, default=None, help='send web searches to the worker pool behind this broker frontend, e.g. tcp://localhost:5555')
 @click.pass_context
-def launch_engine(ctx:click.core.Context):
+def serve(ctx:click.core.Context, host:str, port:int, max_sessions:int, session_ttl:float, max_pending_events:int, compaction_threshold:Optional[int], broker_address:Optional[str]):
     settings = ctx.obj['settings']
     credentials:Credentials = settings['credentials']
-    agent_loop = AgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key)
-    agent_loop.run()
+    search_cache_settings:SearchCacheSettings = settings['search_cache']
+    search_cache = SearchCache(path=search_cache_settings.path, max_entries=search_cache_settings.max_entries, ttl=search_cache_settings.ttl)
+    history_compactor = HistoryCompactor(threshold_tokens=compaction_threshold) if compaction_threshold is not None else None
+    remote_search = RemoteSearchClient(broker_address) if broker_address is not None else None
+    transcript_store = make_transcript_store(settings['transcripts'])
+    current_sink.set(NullSink())
+
+    async def main() -> None:
+        async with AsyncAgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key, search_cache=search_cache, history_compactor=history_compactor, remote_search=remote_search, research_scheduler=make_research_scheduler(settings['research']), search_aggregator=make_search_aggregator(settings['aggregation']), search_prefetcher=make_search_prefetcher(settings['prefetch']), transcript_store=transcript_store) as agent_loop:
+            session_server = SessionServer(agent_loop, SessionStore(max_sessions=max_sessions, idle_ttl=session_ttl, transcript_store=transcript_store), host=host, port=port, max_pending_events=max_pending_events)
+            await session_server.serve_forever()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if remote_search is not None:
+            remote_search.close()
+        search_cache.close()
+
+@group_handler.command()
+@click.option('--input', 'input_path', type=click.Path(exists=True, dir_okay=False), required=True, help='jsonl file with one {"id": ..., "query": ...} object per line')
+@click.option('--output', 'output_path', type=click.Path(dir_okay=False), required=True, help='results are appended as one json object per query, ids already answered in this file are skipped')
+@click.option('--concurrency', type=int, default=8, help='number of queries researched at the same time')
+@click.option('--shard-index', type=int, default=0, help='index of the shard of the input this process runs')
+@click.option('--num-shards', type=int, default=1, help='the input is split by a hash of the ids, run one process per shard with its own --output')
+@click.option('--use-asyncio', is_flag=True, default=False, help='run the sessions on the asyncio engine')
+@click.option('--compaction-threshold', type=int, default=None, help='compact older tool results once a deep research prompt exceeds this many tokens')
+@click.option('--broker-address', type=str, default=None, help='send web searches to the worker pool behind this broker frontend, e.g. tcp://localhost:5555')
+@click.option('--progress-interval', type=float, default=10.0, help='seconds between two throughput and eta reports')
+@click.pass_context
+def batch(ctx:click.core.Context, input_path:str, output_path:str, concurrency:int, shard_index:int, num_shards:int, use_asyncio:bool, compaction_threshold:Optional[int], broker_address:Optional[str], progress_interval:float):
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise click.BadParameter(f'--shard-index must be in [0, {num_shards})', param_hint='--shard-index')
+    settings = ctx.obj['settings']
+    credentials:Credentials = settings['credentials']
+    items, nb_skipped = load_items(input_path, load_done_ids(output_path), shard_index=shard_index, num_shards=num_shards)
+    logger.info(f'batch: shard {shard_index}/{num_shards}, {len(items)} queries to run, {nb_skipped} already answered in {output_path}')
+    search_cache_settings:SearchCacheSettings = settings['search_cache']
+    search_cache = SearchCache(path=search_cache_settings.path, max_entries=search_cache_settings.max_entries, ttl=search_cache_settings.ttl)
+    history_compactor = HistoryCompactor(threshold_tokens=compaction_threshold) if compaction_threshold is not None else None
+    remote_search = RemoteSearchClient(broker_address) if broker_address is not None else None
+    transcript_store = make_transcript_store(settings['transcripts'])
+    current_sink.set(NullSink())
+    writer = BatchWriter(output_path)
+    progress = BatchProgress(total=len(items), nb_skipped=nb_skipped, interval=progress_interval)
+    batch_runner = BatchRunner(writer, progress, transcript_store=transcript_store)
+    progress.start()
+    try:
+        if use_asyncio:
+            async def main() -> None:
+                async with AsyncAgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key, search_cache=search_cache, history_compactor=history_compactor, remote_search=remote_search, research_scheduler=make_research_scheduler(settings['research']), search_aggregator=make_search_aggregator(settings['aggregation']), search_prefetcher=make_search_prefetcher(settings['prefetch']), transcript_store=transcript_store) as agent_loop:
+                    await batch_runner.arun(agent_loop, items, concurrency)
+            try:
+                asyncio.run(main())
+            except KeyboardInterrupt:
+                logger.info('batch: interrupted, unfinished queries are picked up by the next run')
+        else:
+            # every session may hold a deep research in the tool pool, each fanning out its searches
+            with AgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key, max_search_workers=max(16, 4 * concurrency), max_tool_workers=max(8, concurrency), search_cache=search_cache, history_compactor=history_compactor, remote_search=remote_search, research_scheduler=make_research_scheduler(settings['research']), search_aggregator=make_search_aggregator(settings['aggregation']), search_prefetcher=make_search_prefetcher(settings['prefetch']), transcript_store=transcript_store) as agent_loop:
+                batch_runner.run(agent_loop, items, concurrency)
+    finally:
+        summary = progress.stop()
+        writer.close()
+        if remote_search is not None:
+            remote_search.close()
+        search_cache.close()
+    click.echo(json.dumps(summary, indent=2))
+
+@group_handler.command()
+@click.option('--frontend', type=str, default='tcp://*:5555', help='address the agent front-ends connect to')
+@click.option('--backend', type=str, default='tcp://*:5556', help='address the search workers connect to')
+@click.option('--heartbeat-interval', type=float, default=1.0)
+@click.option('--liveness', type=int, default=3, help='number of missed heartbeats before a worker is declared dead')
+@click.option('--job-timeout', type=float, default=120.0, help='seconds a worker may spend on a job before it is requeued')
+@click.option('--max-attempts', type=int, default=3)
+def broker(frontend:str, backend:str, heartbeat_interval:float, liveness:int, job_timeout:float, max_attempts:int):
+    search_broker = SearchBroker(frontend, backend, heartbeat_interval=heartbeat_interval, liveness=liveness, job_timeout=job_timeout, max_attempts=max_attempts)
+    search_broker.run()
+
+@group_handler.command()
+@click.option('--broker-address', type=str, default='tcp://localhost:5556', help='backend address of the broker')
+@click.option('--capacity', type=int, default=8, help='number of jobs this worker runs concurrently')
+@click.option('--heartbeat-interval', type=float, default=1.0)
+@click.option('--liveness', type=int, default=3)
+@click.pass_context
+def worker(ctx:click.core.Context, broker_address:str, capacity:int, heartbeat_interval:float, liveness:int):
+    settings = ctx.obj['settings']
+    credentials:Credentials = settings['credentials']
+    search_cache_settings:SearchCacheSettings = settings['search_cache']
+    search_cache = SearchCache(path=search_cache_settings.path, max_entries=search_cache_settings.max_entries, ttl=search_cache_settings.ttl)
+    current_sink.set(NullSink())
+    try:
+        with AgentLoop(openai_api_key=credentials.openai_api_key, anthropic_api_key=credentials.anthropic_api_key, max_search_workers=capacity, search_cache=search_cache, research_scheduler=make_research_scheduler(settings['research']), search_aggregator=make_search_aggregator(settings['aggregation']), search_prefetcher=make_search_prefetcher(settings['prefetch'])) as agent_loop:
+            search_worker = SearchWorker(agent_loop, broker_address, capacity=capacity, heartbeat_interval=heartbeat_interval, liveness=liveness)
+            search_worker.run()
+    finally:
+        search_cache.close()
+
+@group_handler.command()
+@click.option('--engine', type=click.Choice(['thread', 'asyncio']), default='thread')
+@click.option('--scenario', type=click.Choice(['run', 'deep_iterative_web_search', 'simple_web_search']), default='run')
+@click.option('--sessions', type=int, default=32)
+@click.option('--concurrency', type=int, default=8)
+@click.option('--research-iterations', type=int, default=3)
+@click.option('--queries-per-search', type=int, default=4)
+@click.option('--anthropic-ttfb', type=float, default=0.2, help='mock anthropic time to first byte in seconds')
+@click.option('--anthropic-token-delay', type=float, default=0.002, help='mock anthropic delay per streamed token in seconds')
+@click.option('--openai-ttfb', type=float, default=0.5, help='mock openai time to first byte in seconds')
+@click.option('--openai-token-delay', type=float, default=0.0005, help='mock openai delay per generated token in seconds')
+@click.option('--error-rate', type=float, default=0.0, help='probability of an injected provider failure per request')
+@click.option('--prefetch', is_flag=True, default=False, help='run the speculative searches of the follow-up queries proposed during deep research')
+@click.option('--proposal-accuracy', type=float, default=None, help='make the mock research turns propose their next queries, this share of them is actually searched')
+@click.option('--recording', type=click.Path(exists=True, dir_okay=False), default=None, help='jsonl file of recorded anthropic streams to replay')
+@click.option('--search-recording', type=click.Path(exists=True, dir_okay=False), default=None, help='jsonl file of recorded openai search completions to replay')
+@click.option('--trace-memory', is_flag=True, default=False, help='report the tracemalloc peak (slows the run down)')
+@click.option('--seed', type=int, default=0)
+@click.option('--output', type=click.Path(dir_okay=False), default='bench_output.jsonl', help='results are appended as one json document per run')
+def benchmark(engine:str, scenario:str, sessions:int, concurrency:int, research_iterations:int, queries_per_search:int, anthropic_ttfb:float, anthropic_token_delay:float, openai_ttfb:float, openai_token_delay:float, error_rate:float, prefetch:bool, proposal_accuracy:Optional[float], recording:Optional[str], search_recording:Optional[str], trace_memory:bool, seed:int, output:str):
+    config = EngineBenchmarkConfig(
+        engine=engine,
+        scenario=scenario,
+        sessions=sessions,
+        concurrency=concurrency,
+        research_iterations=research_iterations,
+        queries_per_search=queries_per_search,
+        anthropic_profile=ProviderProfile(time_to_first_byte=anthropic_ttfb, per_token_delay=anthropic_token_delay, error_rate=error_rate, seed=seed),
+        openai_profile=ProviderProfile(time_to_first_byte=openai_ttfb, per_token_delay=openai_token_delay, error_rate=error_rate, seed=seed),
+        recording=recording,
+        search_recording=search_recording,
+        prefetch=prefetch,
+        proposal_accuracy=proposal_accuracy,
+        trace_memory=trace_memory,
+        seed=seed
+    )
+    results = run_engine_benchmark(config)
+    write_results(results, output)
+    click.echo(json.dumps(results['results'], indent=2))
+
+@group_handler.command()
+@click.option('--deltas', type=int, default=10_000, help='approximate number of text and thinking deltas in the synthetic stream')
+@click.option('--tokens-per-delta', type=int, default=4)
+@click.option('--tool-argument-chars', type=int, default=4096, help='size of the streamed tool_use arguments')
+@click.option('--repeat', type=int, default=20)
+@click.option('--seed', type=int, default=0)
+@click.option('--output', type=click.Path(dir_okay=False), default='bench_output.jsonl', help='results are appended as one json document per run')
+def benchmark_accumulator(deltas:int, tokens_per_delta:int, tool_argument_chars:int, repeat:int, seed:int, output:str):
+    config = AccumulatorBenchmarkConfig(deltas=deltas, tokens_per_delta=tokens_per_delta, tool_argument_chars=tool_argument_chars, repeat=repeat, seed=seed)
+    results = run_accumulator_benchmark(config)
+    write_results(results, output)
+    click.echo(json.dumps(results['results'], indent=2))
 
 if __name__ == '__main__':
     load_dotenv()
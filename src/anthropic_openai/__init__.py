@@ -1,2 +1,3 @@
 from .agent_loop import AgentLoop
-from .types import Role, ChatMessage, StopReason
\ No newline at end of file
+from .async_agent_loop import AsyncAgentLoop
+from .types import Role, ChatMessage, StopReason
@@ -0,0 +1,200 @@
+import re
+import json
+
+from typing import List, Dict, Optional, Any
+
+_STRING_STOP = re.compile(r'["\\]')
+_CLOSERS = {'{': '}', '[': ']'}
+# a snapshot re-parses the whole safe prefix, it is only taken again once the prefix grew by a share of its size
+# so that the parses of one tool_use sum to a few times its length instead of growing with its square
+_SNAPSHOT_MIN_BYTES = 64
+_SNAPSHOT_GROWTH = 0.25
+
+class PartialJSONParser:
+    # incremental scanner for input_json_delta fragments, every character is visited once ; it only runs when a
+    # consumer asks for the arguments of an unfinished tool_use (BlockRecord.partial_arguments). it remembers
+    # the last offset at which the document can be closed into valid json, so that snapshot()
+    # returns the arguments streamed so far (complete values only) before the tool_use block is finished
+    __slots__ = ('chunks', 'size', 'stack', 'expect_key', 'in_string', 'escape', 'string_is_key', 'in_literal', 'safe_end', 'safe_closers', 'cached_end', 'cached_value')
+
+    def __init__(self):
+        self.chunks:List[str] = []
+        self.size = 0
+        self.stack:List[str] = []
+        self.expect_key:List[bool] = []
+        self.in_string = False
+        self.escape = False
+        self.string_is_key = False
+        self.in_literal = False
+        self.safe_end = 0
+        self.safe_closers = ''
+        self.cached_end = -1
+        self.cached_value:Any = None
+
+    def _mark_safe(self, offset:int) -> None:
+        self.safe_end = offset
+        self.safe_closers = ''.join([ _CLOSERS[opener] for opener in reversed(self.stack) ])
+
+    def _end_value(self, offset:int) -> None:
+        if len(self.stack) == 0 or self.stack[-1] == '[' or not self.expect_key[-1]:
+            self._mark_safe(offset)
+
+    def feed(self, chunk:str) -> None:
+        position = self.size
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        index, length = 0, len(chunk)
+        while index < length:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    index += 1
+                    continue
+                match = _STRING_STOP.search(chunk, index)
+                if match is None:
+                    break
+                index = match.end()
+                if match.group() == '\\':
+                    self.escape = True
+                    continue
+                self.in_string = False
+                if not self.string_is_key:
+                    self._end_value(position + index)
+                continue
+
+            character = chunk[index]
+            if self.in_literal and (character in ',}]:' or character.isspace()):
+                self.in_literal = False
+                self._end_value(position + index)
+            match character:
+                case '"':
+                    self.in_string = True
+                    self.string_is_key = len(self.stack) > 0 and self.stack[-1] == '{' and self.expect_key[-1]
+                case '{' | '[':
+                    self.stack.append(character)
+                    self.expect_key.append(character == '{')
+                    self._mark_safe(position + index + 1)
+                case '}' | ']':
+                    if len(self.stack) > 0:
+                        self.stack.pop()
+                        self.expect_key.pop()
+                    self._end_value(position + index + 1)
+                case ',':
+                    if len(self.stack) > 0 and self.stack[-1] == '{':
+                        self.expect_key[-1] = True
+                case ':':
+                    if len(self.stack) > 0:
+                        self.expect_key[-1] = False
+                case _:
+                    if not character.isspace():
+                        self.in_literal = True
+            index += 1
+
+    def text(self) -> str:
+        if len(self.chunks) > 1:
+            self.chunks[:] = [''.join(self.chunks)]
+        return self.chunks[0] if len(self.chunks) > 0 else ''
+
+    def snapshot(self) -> Optional[Any]:
+        # None until the first container was opened
+        if self.safe_end == 0:
+            return None
+        if self.cached_end != self.safe_end:
+            candidate = self.text()[:self.safe_end].rstrip()
+            if candidate.endswith(','):
+                candidate = candidate[:-1]
+            try:
+                self.cached_value = json.loads(candidate + self.safe_closers)
+            except ValueError:
+                self.cached_value = None
+            self.cached_end = self.safe_end
+        return self.cached_value
+
+class BlockRecord:
+    __slots__ = ('type', 'chunks', 'signature_chunks', 'name', 'id', 'arguments', 'parser', 'nb_parsed', 'parsed_end')
+
+    def __init__(self, block_type:str, name:Optional[str]=None, id:Optional[str]=None):
+        self.type = block_type
+        self.chunks:List[str] = []
+        self.signature_chunks:List[str] = []
+        self.name = name
+        self.id = id
+        self.arguments:Optional[str] = None
+        self.parser:Optional[PartialJSONParser] = None
+        self.nb_parsed = 0
+        self.parsed_end = 0
+
+    def arguments_json(self) -> str:
+        return self.arguments if self.arguments is not None else ''.join(self.chunks)
+
+    def partial_arguments(self) -> Optional[Any]:
+        # the arguments streamed so far (complete values only), or None when not enough was completed since the
+        # previous snapshot ; the parser is created on the first call and catches up on the chunks it has not seen
+        if self.type != 'tool_use':
+            return None
+        if self.parser is None:
+            self.parser = PartialJSONParser()
+        for chunk in self.chunks[self.nb_parsed:]:
+            self.parser.feed(chunk)
+        self.nb_parsed = len(self.chunks)
+        if self.parser.safe_end - self.parsed_end < max(_SNAPSHOT_MIN_BYTES, self.parsed_end * _SNAPSHOT_GROWTH):
+            return None
+        self.parsed_end = self.parser.safe_end
+        return self.parser.snapshot()
+
+    def materialize(self) -> Optional[Dict]:
+        match self.type:
+            case 'text':
+                return {'type': 'text', 'text': ''.join(self.chunks)}
+            case 'thinking':
+                return {'type': 'thinking', 'thinking': ''.join(self.chunks), 'signature': ''.join(self.signature_chunks)}
+            case 'tool_use':
+                self.arguments = ''.join(self.chunks)
+                return {'type': 'tool_use', 'name': self.name, 'input': json.loads(self.arguments or '{}'), 'id': self.id}
+        return None
+
+class StreamAccumulator:
+    # collects the deltas of each block in a list, a block is joined into its api dict once, when it stops,
+    # and its chunks are released right after
+    __slots__ = ('current', 'content')
+
+    def __init__(self):
+        self.current:Optional[BlockRecord] = None
+        self.content:List[Dict] = []
+
+    def start(self, content_block:Any) -> BlockRecord:
+        block = BlockRecord(content_block.type, getattr(content_block, 'name', None), getattr(content_block, 'id', None))
+        match content_block.type:
+            case 'text':
+                block.chunks.append(content_block.text or '')
+            case 'thinking':
+                block.chunks.append(content_block.thinking or '')
+                block.signature_chunks.append(content_block.signature or '')
+        self.current = block
+        return block
+
+    def add(self, delta:Any) -> None:
+        block = self.current
+        if block is None:
+            return
+        match delta.type:
+            case 'text_delta':
+                block.chunks.append(delta.text)
+            case 'thinking_delta':
+                block.chunks.append(delta.thinking)
+            case 'signature_delta':
+                block.signature_chunks.append(delta.signature)
+            case 'input_json_delta':
+                block.chunks.append(delta.partial_json)
+
+    def stop(self) -> Optional[BlockRecord]:
+        block = self.current
+        self.current = None
+        if block is not None:
+            content_block = block.materialize()
+            if content_block is not None:
+                self.content.append(content_block)
+            block.chunks.clear()
+            block.signature_chunks.clear()
+            block.parser = None
+        return block
@@ -1,59 +1,166 @@
 import json 
+import time
 from openai import OpenAI
 from anthropic import Anthropic
 
 from anthropic.types import RawMessageStreamEvent
 from openai.types.chat import ChatCompletion, ChatCompletionChunk, ParsedChatCompletion
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
-from .types import Role, ChatMessage, StopReason
+from .types import Role, ChatMessage, StopReason, Usage
 from .definitions import SystemPromptDefinitions, deep_iterattive_web_search_tool, simple_web_search_tool
 from typing import List, Tuple, Dict, Any, Optional, Iterable
 
 from operator import itemgetter, attrgetter
 
 from .log import logger 
+from .throttling import request_scheduler, throttled_stream, estimate_tokens, Reservation
+from .resilience import resilience, guarded_stream
+from .cache import SearchCache
+from .distributed import RemoteSearchClient
+from .sinks import current_sink
+from .novelty import NoveltyScheduler, ResearchJob, current_research_job, budgeted_stream
+from .aggregation import SearchAggregator
+from .prefetch import SearchPrefetcher, PrefetchEntry, QueryProposalParser
+from .transcript import TranscriptStore, Transcript, current_transcript, current_tool_use_id, open_research_transcript
+from .accumulator import StreamAccumulator
+from .telemetry import telemetry, traced_stream
+from .history import SEARCH_RESULT_SEPARATOR, HistoryCompactor, with_cache_control, annotate_iteration, usage_from_event, synthesize_research
+from .executors import LayeredExecutor
 from contextlib import suppress
+from uuid import uuid4
 
 class AgentLoop:
-    def __init__(self, openai_api_key:str, anthropic_api_key:str):
+    def __init__(self, openai_api_key:str, anthropic_api_key:str, max_search_workers:int=16, max_tool_workers:int=8, search_cache:Optional[SearchCache]=None, history_compactor:Optional[HistoryCompactor]=None, openai_client:Optional[OpenAI]=None, anthropic_client:Optional[Anthropic]=None, remote_search:Optional[RemoteSearchClient]=None, remote_deep_research:bool=False, research_scheduler:Optional[NoveltyScheduler]=None, search_aggregator:Optional[SearchAggregator]=None, transcript_store:Optional[TranscriptStore]=None, search_prefetcher:Optional[SearchPrefetcher]=None):
         self.openai_api_key = openai_api_key
         self.anthropic_api_key = anthropic_api_key
+        self.openai_client = openai_client if openai_client is not None else OpenAI(api_key=self.openai_api_key, max_retries=0)
+        self.anthropic_client = anthropic_client if anthropic_client is not None else Anthropic(api_key=self.anthropic_api_key, max_retries=0)
+        self.search_executor = ThreadPoolExecutor(max_workers=max_search_workers, thread_name_prefix='web_search')
+        # searches run here so that they can be given a deadline and hedged, twice the fan-out leaves room for the duplicates
+        self.hedge_executor = ThreadPoolExecutor(max_workers=2 * max_search_workers, thread_name_prefix='hedge')
+        self.tool_executor = LayeredExecutor(max_workers=max_tool_workers, thread_name_prefix='tool')
+        self.owns_search_cache = search_cache is None
+        self.search_cache = search_cache if search_cache is not None else SearchCache()
+        self.history_compactor = history_compactor
+        self.remote_search = remote_search
+        self.remote_deep_research = remote_deep_research
+        self.research_scheduler = research_scheduler
+        self.search_aggregator = search_aggregator
+        self.transcript_store = transcript_store
+        self.search_prefetcher = search_prefetcher
+        # speculative searches get their own pool so that they never hold up the fan-out of a real call
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=search_prefetcher.max_inflight, thread_name_prefix='prefetch') if search_prefetcher is not None else None
     
-    def simple_web_search(self, expanded_queries:str, search_context_size:str) -> List[Dict]:
-        
-        openai_client = OpenAI(api_key=self.openai_api_key)
-        def make_search(openai_client:OpenAI, query:str, search_context_size:str) -> str:
+    def __enter__(self) -> 'AgentLoop':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+    
+    def close(self) -> None:
+        self.tool_executor.shutdown(wait=True, cancel_futures=True)
+        # speculative searches are launched by tools and hedged on hedge_executor
+        if self.prefetch_executor is not None:
+            self.prefetch_executor.shutdown(wait=True, cancel_futures=True)
+            logger.info(f'speculative search stats: {self.search_prefetcher.stats()}')
+        self.search_executor.shutdown(wait=True, cancel_futures=True)
+        self.hedge_executor.shutdown(wait=True, cancel_futures=True)
+        self.openai_client.close()
+        self.anthropic_client.close()
+        logger.info(f'search cache stats: {self.search_cache.stats()}')
+        if self.owns_search_cache:
+            self.search_cache.close()
+    
+    def search(self, query:str, search_context_size:str) -> str:
+        model = 'gpt-4o-mini-search-preview'
+        if self.remote_search is not None:
+            return self.remote_search.search(query, search_context_size)
+        return resilience.call('openai', model, lambda: self._search(query, search_context_size, model), hedge_executor=self.hedge_executor)
+
+    def _search(self, query:str, search_context_size:str, model:str) -> str:
+        with request_scheduler.acquire('openai', model, tokens=estimate_tokens(query) + 4096) as reservation:
+            if telemetry.enabled:
+                telemetry.observe('llm_queue_wait_seconds', reservation.queue_wait, provider='openai', model=model)
+            completion_res:ChatCompletion = self.openai_client.chat.completions.create(
+                model=model,
+                max_tokens=4096,
+                web_search_options={
+                    'search_context_size': search_context_size
+                },
+                messages=[ChatMessage(role=Role.USER, content=query)],
+                timeout=resilience.policy('openai', model).timeout
+            ) 
+            reservation.release(completion_res.usage.total_tokens if completion_res.usage else None)
+        return completion_res.choices[0].message.content
+    
+    def prefetch_search(self, research_job:ResearchJob, query:str) -> None:
+        search_context_size = research_job.narrow(self.search_prefetcher.search_context_size)
+        entry = self.search_prefetcher.admit(research_job.prefetched, query, search_context_size)
+        if entry is not None:
+            self.search_prefetcher.attach(entry, self.prefetch_executor.submit(self.search_cache.get_or_compute, query, search_context_size, lambda: self.search(query, search_context_size)))
+
+    def take_prefetched(self, entry:PrefetchEntry) -> Optional[str]:
+        try:
+            search_result = entry.future.result()
+        except Exception as e:
+            logger.warning(f'speculative search for {entry.query} failed, searching again: {e}')
+            return None
+        self.search_prefetcher.used(entry, search_result)
+        return search_result
+
+    def make_search(self, query:str, search_context_size:str, prefetched:Optional[PrefetchEntry]=None) -> str:
+        with telemetry.span('search', search_context_size=search_context_size) as span:
             try:
-                completion_res:ChatCompletion = openai_client.chat.completions.create(
-                    model='gpt-4o-mini-search-preview',
-                    max_tokens=4096,
-                    web_search_options={
-                        'search_context_size': search_context_size
-                    },
-                    messages=[ChatMessage(role=Role.USER, content=query)]
-                ) 
-                search_result = completion_res.choices[0].message.content
+                search_result = self.take_prefetched(prefetched) if prefetched is not None else None
+                if search_result is None:
+                    search_result = self.search_cache.get_or_compute(query, search_context_size, lambda: self.search(query, search_context_size))
                 search_result = f'query:{query}\n###\nresult:{search_result}'
                 logger.info(f'query {query} was successful')
+                span['outcome'] = 'ok'
                 return search_result
             except Exception as e:
                 logger.error(f'query {query} -> error: {e}')
+                span['outcome'] = 'error'
                 return f'query:{query} -> result: error: {e}'
-        
-        nb_queries = len(expanded_queries)
-        with ThreadPoolExecutor(max_workers=nb_queries) as executor:
-            futures = executor.map(lambda query: make_search(openai_client, query, search_context_size), expanded_queries)
-            search_results = list(futures)
+    
+    def simple_web_search(self, expanded_queries:List[str], search_context_size:str) -> List[Dict]:
+        research_job = current_research_job.get()
+        if research_job is not None:
+            search_context_size = research_job.narrow(search_context_size)
+        # speculative searches are claimed here, the search threads do not see the research job
+        prefetched = [ self.search_prefetcher.take(research_job.prefetched, query, search_context_size) if self.search_prefetcher is not None and research_job is not None else None for query in expanded_queries ]
+        futures = [ self.search_executor.submit(self.make_search, query, search_context_size, entry) for query, entry in zip(expanded_queries, prefetched) ]
+        # a research does not wait for its searches past its wall clock budget, late ones finish into the cache only
+        wait(futures, timeout=research_job.remaining() if research_job is not None else None)
+        search_results:List[str] = []
+        for query, future in zip(expanded_queries, futures):
+            if future.done():
+                search_results.append(future.result())
+                continue
+            future.cancel()
+            research_job.cut_off(research_job.overrun() or f'wall clock budget: {research_job.max_seconds:.1f}s')
+            search_results.append(f'query:{query} -> result: error: research budget spent')
+        # novelty is only measured for the scheduler that acts on it
+        if research_job is not None and self.research_scheduler is not None:
+            for search_result in search_results:
+                research_job.observe(search_result)
+        if self.search_aggregator is not None:
+            search_result = self.search_aggregator.aggregate(search_results, research_job.passages if research_job is not None else None, research_job.query if research_job is not None else None)
+        else:
+            search_result = SEARCH_RESULT_SEPARATOR.join(search_results)
         return [
             {
                 'type': 'text',
-                'text': '\n\n---$$$---\n\n'.join(search_results)
+                'text': search_result
             }
         ]
     
     def deep_iterative_web_search(self, query:str, user_contraints:str, task_complexity:str, max_iterations:int=1) -> List[Dict]:
+        if self.remote_search is not None and self.remote_deep_research:
+            return self.remote_search.submit('deep_iterative_web_search', {'query': query, 'user_contraints': user_contraints, 'task_complexity': task_complexity, 'max_iterations': max_iterations}).result()
+        
         budget_tokens = 1024 
         match task_complexity:
             case 'medium':
@@ -65,29 +172,99 @@ class AgentLoop:
         conversation_history = [ChatMessage(role=Role.USER, content=user_message_content)]
         stop_reason = StopReason.TOOL_USE
 
+        system = SystemPromptDefinitions.DEEP_ITERATIVE_WEB_SEARCH.format(max_iterations=max_iterations)
+        research_usage = Usage()
+        prompt_tokens:Optional[int] = None
+
+        # the job is visible to the simple_web_search calls dispatched from this research only
+        research_job = self.research_scheduler.start(query, budget_tokens, max_iterations) if self.research_scheduler is not None else ResearchJob(query, budget_tokens, max_iterations)
+        conversation_history_delta:List[ChatMessage] = []
         counter = 0
-        while stop_reason == StopReason.TOOL_USE:
-            if counter > max_iterations:
-                break
+        interrupted = False
+        research_transcript = open_research_transcript(self.transcript_store)
+        if research_transcript is not None and research_transcript.checkpoint_state is not None:
+            # the iterations completed before a restart are not paid for again, an unfinished one is dropped
+            state = research_transcript.checkpoint_state
+            research_transcript.rewind(research_transcript.checkpoint_index)
+            conversation_history = list(research_transcript.messages)
+            conversation_history_delta = conversation_history[state['delta_start']:]
+            counter, budget_tokens = state['iteration'], state['budget_tokens']
+            stop_reason = StopReason.END_TURN if state['done'] else StopReason.TOOL_USE
+            research_job.budget_tokens = budget_tokens
+            research_job.budget_stop = state.get('budget_stop')
+            logger.info(f'research {research_transcript.transcript_id} resumed after iteration {counter}/{max_iterations}')
+        elif research_transcript is not None:
+            research_transcript.rewind(0)
+            research_transcript.append(conversation_history)
+        # the messages of this research go to its own transcript, never to the one of the calling session
+        research_transcript_token = current_transcript.set(research_transcript)
+        research_job_token = current_research_job.set(research_job)
+        try:
+            while stop_reason == StopReason.TOOL_USE:
+                if counter > max_iterations:
+                    break
 
-            completion_res:Iterable[RawMessageStreamEvent] = self.handle_conversation(
-                system=SystemPromptDefinitions.DEEP_ITERATIVE_WEB_SEARCH.format(max_iterations=max_iterations, current_iteration=counter + 1),
-                conversation_history=conversation_history,
-                model='claude-3-7-sonnet-latest',
-                max_tokens=budget_tokens * 10,
-                thinking={
-                    'type': 'enabled',
-                    'budget_tokens': budget_tokens
-                },
-                tools=[simple_web_search_tool]
-            ) 
+                iteration_started_at = time.perf_counter()
+                conversation_history = annotate_iteration(conversation_history, counter + 1, max_iterations)
+                if self.history_compactor is not None:
+                    conversation_history = self.history_compactor.compact(conversation_history, prompt_tokens)
 
-            stop_reason_delta, conversation_history_delta = self.consume_stream(completion_res)
-            print('current stop reason', stop_reason_delta, 'counter', counter)
-            stop_reason = stop_reason_delta
-            conversation_history.extend(conversation_history_delta)
-            counter += 1
-        deep_search_result = "\n###\n".join([ chat_message.model_dump_json(indent=2) for chat_message in conversation_history_delta ])
+                completion_res:Iterable[RawMessageStreamEvent] = self.handle_conversation(
+                    system=system,
+                    conversation_history=conversation_history,
+                    model='claude-3-7-sonnet-latest',
+                    max_tokens=budget_tokens * 10,
+                    thinking={
+                        'type': 'enabled',
+                        'budget_tokens': budget_tokens
+                    },
+                    tools=[simple_web_search_tool]
+                ) 
+                if completion_res is None:
+                    logger.error('error: completion_res is None')
+                    interrupted = True
+                    break
+
+                usage = Usage()
+                stop_reason_delta, conversation_history_delta = self.consume_stream(budgeted_stream(completion_res, research_job, usage), usage)
+                logger.info(f'current stop reason {stop_reason_delta} counter {counter}')
+                logger.info(f'iteration {counter + 1}/{max_iterations} usage: input_tokens={usage.input_tokens} cache_read_input_tokens={usage.cache_read_input_tokens} cache_creation_input_tokens={usage.cache_creation_input_tokens} output_tokens={usage.output_tokens}')
+                prompt_tokens = usage.input_tokens + usage.cache_read_input_tokens + usage.cache_creation_input_tokens
+                if telemetry.enabled:
+                    iteration_duration = time.perf_counter() - iteration_started_at
+                    telemetry.observe('research_iteration_seconds', iteration_duration)
+                    telemetry.trace('research_iteration', iteration=counter + 1, max_iterations=max_iterations, duration=iteration_duration, stop_reason=stop_reason_delta, **usage.model_dump())
+                for field_name in Usage.model_fields:
+                    setattr(research_usage, field_name, getattr(research_usage, field_name) + getattr(usage, field_name))
+                stop_reason = stop_reason_delta
+                conversation_history.extend(conversation_history_delta)
+                counter += 1
+                done = stop_reason != StopReason.TOOL_USE
+                if self.research_scheduler is not None and not done:
+                    decision = self.research_scheduler.decide(research_job, usage)
+                    budget_tokens = research_job.budget_tokens
+                    done = decision.action == 'stop'
+                done = done or research_job.budget_stop is not None
+                if research_transcript is not None:
+                    research_transcript.checkpoint(iteration=counter, budget_tokens=budget_tokens, delta_start=len(conversation_history) - len(conversation_history_delta), done=done, budget_stop=research_job.budget_stop)
+                if done:
+                    break
+        finally:
+            current_research_job.reset(research_job_token)
+            current_transcript.reset(research_transcript_token)
+            if research_transcript is not None:
+                research_transcript.close()
+        if self.search_prefetcher is not None:
+            self.search_prefetcher.finish(research_job.prefetched)
+        if research_transcript is not None and not interrupted:
+            # the result is recorded by the session as a tool_result, the checkpoints are not needed anymore ;
+            # a research that raised or lost its api connection keeps them so that the next attempt resumes from its last iteration
+            self.transcript_store.delete(research_transcript.transcript_id)
+        logger.info(f'deep research usage over {counter} iterations: {research_usage.model_dump()}')
+        if research_job.budget_stop is not None:
+            deep_search_result = synthesize_research(conversation_history, research_job.budget_stop, self.history_compactor)
+        else:
+            deep_search_result = "\n###\n".join([ chat_message.model_dump_json(indent=2) for chat_message in conversation_history_delta ])
         # summaryze the conversation history
         return [
             {
@@ -96,135 +273,198 @@ class AgentLoop:
             }
         ]
     
-    def handle_tool(self, tool_name:str, tool_args:str, tool_use_id:str) -> ChatMessage:
+    def execute_tool(self, tool_name:str, tool_args:str, tool_use_id:str) -> Dict:
+        tool_use_id_token = current_tool_use_id.set(tool_use_id)
+        try:
+            with telemetry.span('tool', tool=tool_name):
+                return self._execute_tool(tool_name, tool_args, tool_use_id)
+        finally:
+            current_tool_use_id.reset(tool_use_id_token)
+
+    def _execute_tool(self, tool_name:str, tool_args:str, tool_use_id:str) -> Dict:
         try:
             tool_function = attrgetter(tool_name)(self)
-            arguments = json.loads(tool_args)
+            arguments = json.loads(tool_args or '{}')
             tool_result_content:List[Dict] = tool_function(**arguments)
-            return ChatMessage(
-                role=Role.USER, 
-                content=[
-                    {
-                        'type': 'tool_result',
-                        'tool_use_id': tool_use_id,
-                        'content': tool_result_content
-                    }
-                ]
-            )
+            return {
+                'type': 'tool_result',
+                'tool_use_id': tool_use_id,
+                'content': tool_result_content
+            }
         except Exception as e:
             logger.error(f'error: {e}')
-            return ChatMessage(
-                role=Role.USER,
-                content=[
-                    {
-                        'type': 'tool_result',
-                        'tool_use_id': tool_use_id,
-                        'is_error': True,
-                        'content': str(e)
-                    }
-                ]
-            )
+            return {
+                'type': 'tool_result',
+                'tool_use_id': tool_use_id,
+                'is_error': True,
+                'content': str(e)
+            }
+
+    def handle_tool(self, tool_name:str, tool_args:str, tool_use_id:str) -> ChatMessage:
+        tool_result = self.execute_tool(tool_name, tool_args, tool_use_id)
+        return ChatMessage(role=Role.USER, content=[tool_result])
 
-    def consume_stream(self, stream:Iterable[RawMessageStreamEvent]) -> Tuple[StopReason, List[ChatMessage]]:
+    def consume_stream(self, stream:Iterable[RawMessageStreamEvent], usage:Optional[Usage]=None) -> Tuple[StopReason, List[ChatMessage]]:
         conversation_history:List[ChatMessage] = []
         stop_reason = StopReason.END_TURN
-        content:List[Dict] = []
-        current_block_type = None
-        text, signature, thinking, tool_name, tool_args, tool_use_id = None, None, None, None, None, None
-        for event in stream:
-            match event.type:
-                case 'message_start':
-                    print('')
-                case 'message_delta':
-                    stop_reason = event.delta.stop_reason
-                    conversation_history.append(ChatMessage(role=Role.ASSISTANT, content=content))
-                    if stop_reason != StopReason.TOOL_USE:
-                        continue
-                    print(tool_name)
-                    print(tool_args)
-                    tool_result = self.handle_tool(tool_name, tool_args, tool_use_id)
-                    conversation_history.append(tool_result)
-                case 'content_block_start':
-                    current_block_type = event.content_block.type
-                    match event.content_block.type:
-                        case 'text': 
-                            print('<response>')
-                            text = event.content_block.text
-                        case 'thinking': 
-                            print('<thinking>')
-                            thinking = event.content_block.thinking
-                            signature = event.content_block.signature
-                        case 'tool_use':
-                            print('<tool_use>')
-                            tool_name = event.content_block.name
-                            tool_args = ''
-                            tool_use_id = event.content_block.id
-                case 'content_block_delta':
-                    match event.delta.type:
-                        case 'text_delta':
-                            print(event.delta.text, end='', flush=True)
-                            text = text + event.delta.text 
-                        case 'thinking_delta':
-                            print(event.delta.thinking, end='', flush=True)
-                            thinking = thinking + event.delta.thinking
-                        case 'signature_delta':
-                            signature = signature + event.delta.signature
-                        case 'input_json_delta':
-                            tool_args = tool_args + event.delta.partial_json 
-                case 'content_block_stop':
-                    print('')
-                    match current_block_type:
-                        case 'text':
-                            print('</response>')
-                            content.append({'type': 'text', 'text': text})  
-                        case 'thinking':
-                            print('</thinking>')
-                            content.append({'type': 'thinking', 'thinking': thinking, 'signature': signature})
-                        case 'tool_use':
-                            print('</tool_use>')
-                            content.append({'type': 'tool_use', 'name': tool_name, 'input': json.loads(tool_args), 'id': tool_use_id})
-            # end match event.type 
-        # end for event in stream
+        accumulator = StreamAccumulator()
+        pending_tools:List[Future] = []
+        sink = current_sink.get()
+        transcript = current_transcript.get()
+        # inside a research the follow-up queries proposed in the text are searched before the model asks for them
+        research_job = current_research_job.get() if self.search_prefetcher is not None else None
+        proposals = QueryProposalParser() if research_job is not None else None
+        try:
+            for event in stream:
+                if usage is not None:
+                    usage_from_event(event, usage)
+                match event.type:
+                    case 'message_start':
+                        sink.emit({'type': 'message_start'})
+                    case 'message_delta':
+                        stop_reason = event.delta.stop_reason
+                        sink.emit({'type': 'message_stop', 'stop_reason': stop_reason})
+                        conversation_history.append(ChatMessage(role=Role.ASSISTANT, content=accumulator.content))
+                        if transcript is not None:
+                            transcript.append(conversation_history[-1:])
+                    case 'content_block_start':
+                        accumulator.start(event.content_block)
+                        sink.emit({'type': 'block_start', 'block': event.content_block.type})
+                    case 'content_block_delta':
+                        accumulator.add(event.delta)
+                        match event.delta.type:
+                            case 'text_delta':
+                                sink.emit({'type': 'text_delta', 'text': event.delta.text})
+                                if proposals is not None:
+                                    for query in proposals.feed(event.delta.text):
+                                        self.prefetch_search(research_job, query)
+                            case 'thinking_delta':
+                                sink.emit({'type': 'thinking_delta', 'thinking': event.delta.thinking})
+                            case 'input_json_delta':
+                                # the partial arguments are only parsed for a sink that displays them
+                                if sink.partial_tool_input:
+                                    partial_input = accumulator.current.partial_arguments()
+                                    if partial_input is not None:
+                                        sink.emit({'type': 'tool_input_delta', 'name': accumulator.current.name, 'input': partial_input, 'id': accumulator.current.id})
+                    case 'content_block_stop':
+                        block = accumulator.stop()
+                        if block is None:
+                            continue
+                        sink.emit({'type': 'block_stop', 'block': block.type})
+                        if proposals is not None and block.type == 'text':
+                            for query in proposals.close():
+                                self.prefetch_search(research_job, query)
+                        if block.type == 'tool_use':
+                            tool_args = block.arguments_json()
+                            sink.emit({'type': 'tool_call', 'name': block.name, 'arguments': tool_args, 'id': block.id})
+                            pending_tools.append(self.tool_executor.submit(self.execute_tool, block.name, tool_args, block.id))
+                # end match event.type 
+            # end for event in stream
+        except BaseException:
+            for future in pending_tools:
+                future.cancel()
+            raise
+
+        if stop_reason == StopReason.TOOL_USE and len(pending_tools) > 0:
+            # tools were dispatched as soon as their block closed, results are gathered in block order
+            tool_results = [ future.result() for future in pending_tools ]
+            conversation_history.append(ChatMessage(role=Role.USER, content=list(tool_results)))
+            if transcript is not None:
+                transcript.append(conversation_history[-1:])
+        else:
+            for pending_tool in pending_tools:
+                pending_tool.cancel()
         return stop_reason, conversation_history
     
-    def handle_conversation(self, conversation_history:List[ChatMessage], system:str, model:str='claude-3-5-sonnet-latest', max_tokens:int=2048, thinking={'type': 'disabled'}, tools=[]) -> Optional[Iterable[RawMessageStreamEvent]]:
+    def handle_conversation(self, conversation_history:List[ChatMessage], system:str, model:str='claude-3-5-sonnet-latest', max_tokens:int=2048, thinking={'type': 'disabled'}, tools=[], cache_prompt:bool=True) -> Optional[Iterable[RawMessageStreamEvent]]:
+        try:
+            payload = system + ''.join([ chat_message.model_dump_json() for chat_message in conversation_history ]) + json.dumps(tools)
+            if cache_prompt:
+                system, tools, conversation_history = with_cache_control(system, tools, conversation_history)
+            # only opening the stream is retried, a failure once events were consumed would replay output
+            completion_res, reservation, started_at = resilience.call('anthropic', model, lambda: self.open_stream(conversation_history, system, model, max_tokens, thinking, tools, estimate_tokens(payload) + max_tokens))
+            completion_res = guarded_stream(completion_res, resilience.breaker('anthropic', model))
+            if telemetry.enabled:
+                telemetry.observe('llm_queue_wait_seconds', reservation.queue_wait, provider='anthropic', model=model)
+                return traced_stream(throttled_stream(completion_res, reservation), model, started_at)
+            return throttled_stream(completion_res, reservation)
+        except Exception as e:
+            logger.error(f'error: {e}')
+
+    def open_stream(self, conversation_history:List[ChatMessage], system:str, model:str, max_tokens:int, thinking:Dict, tools:List[Dict], tokens:int) -> Tuple[Iterable[RawMessageStreamEvent], Reservation, float]:
+        reservation = request_scheduler.reserve('anthropic', model, tokens=tokens)
+        research_job = current_research_job.get()
+        timeout = resilience.policy('anthropic', model).timeout
         try:
-            anthropic_client = Anthropic(api_key=self.anthropic_api_key)
-            completion_res:Iterable[RawMessageStreamEvent] = anthropic_client.messages.create(
+            started_at = time.perf_counter()
+            completion_res:Iterable[RawMessageStreamEvent] = self.anthropic_client.messages.create(
                 model=model, 
                 messages=conversation_history,
                 system=system,
                 max_tokens=max_tokens,
                 stream=True,
                 thinking=thinking, 
-                tools=tools
+                tools=tools,
+                timeout=research_job.bound(timeout) if research_job is not None else timeout
             )
-            return completion_res
-        except Exception as e:
-            logger.error(f'error: {e}')
+        except BaseException:
+            reservation.release()
+            raise
+        return completion_res, reservation, started_at
             
-    def run(self) -> None:
-        stop_reason = StopReason.END_TURN
+    def handle_turn(self, conversation_history:List[ChatMessage]) -> StopReason:
+        stop_reason = StopReason.TOOL_USE
+        while stop_reason == StopReason.TOOL_USE:
+            completion_res = self.handle_conversation(conversation_history, SystemPromptDefinitions.MAIN_AGENT_LOOP, tools=[deep_iterattive_web_search_tool])
+            if completion_res is None:
+                logger.error('error: completion_res is None')
+                break
+            
+            stop_reason, conversation_history_delta = self.consume_stream(completion_res)
+            conversation_history.extend(conversation_history_delta)
+        return stop_reason
+    
+    def resume_turn(self, conversation_history:List[ChatMessage]) -> Optional[StopReason]:
+        # a history restored from a transcript may stop in the middle of a turn: tool calls without results are
+        # dispatched again (a deep research resumes from its checkpoint) and the model is asked to finish the turn
+        if len(conversation_history) == 0:
+            return None
+        last_message = conversation_history[-1]
+        if last_message.role == Role.ASSISTANT:
+            tool_uses = [ block for block in last_message.content if block.get('type') == 'tool_use' ] if isinstance(last_message.content, list) else []
+            if len(tool_uses) == 0:
+                return None
+            logger.info(f'resuming {len(tool_uses)} interrupted tool calls')
+            futures = [ self.tool_executor.submit(self.execute_tool, block['name'], json.dumps(block['input']), block['id']) for block in tool_uses ]
+            tool_results_message = ChatMessage(role=Role.USER, content=[ future.result() for future in futures ])
+            conversation_history.append(tool_results_message)
+            transcript = current_transcript.get()
+            if transcript is not None:
+                transcript.append([tool_results_message])
+        return self.handle_turn(conversation_history)
+
+    def run(self, session_id:Optional[str]=None) -> None:
         conversation_history:List[ChatMessage] = []
+        transcript:Optional[Transcript] = None
+        if self.transcript_store is not None:
+            transcript = self.transcript_store.open(session_id if session_id is not None else uuid4().hex)
+            conversation_history = list(transcript.messages)
+            current_transcript.set(transcript)
+            logger.info(f'session {transcript.transcript_id} ({len(conversation_history)} messages), continue it with --session {transcript.transcript_id}')
+            self.resume_turn(conversation_history)
         while True:
             try:
-                if stop_reason != StopReason.TOOL_USE:
-                    query = input('query: ')
-                    user_message = ChatMessage(role=Role.USER, content=query)
-                    conversation_history.append(user_message)
-                
-                completion_res = self.handle_conversation(conversation_history, SystemPromptDefinitions.MAIN_AGENT_LOOP, tools=[deep_iterattive_web_search_tool])
-                if completion_res is None:
-                    logger.error('error: completion_res is None')
-                    continue
-                
-                stop_reason_delta, conversation_history_delta = self.consume_stream(completion_res)
-                stop_reason = stop_reason_delta
-                conversation_history.extend(conversation_history_delta)
+                query = input('query: ')
+                user_message = ChatMessage(role=Role.USER, content=query)
+                conversation_history.append(user_message)
+                if transcript is not None:
+                    transcript.append([user_message])
+                self.handle_turn(conversation_history)
             except KeyboardInterrupt:
                 logger.info('exiting...')
                 break
             except Exception as e:
                 logger.error(f'error: {e}')
-                break  
-
+                break
+        if transcript is not None:
+            transcript.close()  
@@ -0,0 +1,172 @@
+import re
+import heapq
+import threading
+
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from typing import List, Dict, Set, Deque, Iterable, Optional, FrozenSet
+
+from .log import logger
+from .telemetry import telemetry
+from .throttling import estimate_tokens
+from .history import SEARCH_RESULT_SEPARATOR
+
+URL_PATTERN = re.compile(r'https?://[^\s)\]>"\']+')
+WORD_PATTERN = re.compile(r'\w+')
+RESULT_PATTERN = re.compile(r'query:(?P<query>.*?)\n###\nresult:(?P<result>.*)', re.DOTALL)
+STOPWORDS = frozenset('the and for are was were with that this from what which who whom how why when where into about over than then them they their there these those have has had not but can will would should could its his her our your you also such more most other some any each been being does did very just like'.split())
+TRACKING_PARAMETERS = ('ref', 'fbclid', 'gclid')
+
+def normalize_url(url:str) -> str:
+    # search previews append tracking parameters (utm_source=openai) to every link, they cost tokens and split identical sources
+    url = url.rstrip('.,;:')
+    parts = urlsplit(url)
+    if parts.query == '':
+        return url
+    query = [ (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not key.startswith('utm_') and key not in TRACKING_PARAMETERS ]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+def terms(text:str) -> Set[str]:
+    return set([ word for word in WORD_PATTERN.findall(text.casefold()) if len(word) > 2 and word not in STOPWORDS ])
+
+def sketch(text:str, shingle_size:int, size:int) -> FrozenSet[int]:
+    # bottom-k minhash: the `size` smallest shingle hashes estimate the jaccard similarity of two passages with one hash per shingle
+    words = WORD_PATTERN.findall(text.casefold())
+    width = min(shingle_size, max(1, len(words)))
+    shingles = set([ hash(tuple(words[index:index + width])) for index in range(max(1, len(words) - width + 1)) ])
+    return frozenset(heapq.nsmallest(size, shingles))
+
+def similarity(left:FrozenSet[int], right:FrozenSet[int], size:int) -> float:
+    if len(left) == 0 or len(right) == 0:
+        return 0.0
+    union = heapq.nsmallest(size, left | right)
+    return sum([ 1 for value in union if value in left and value in right ]) / len(union)
+
+class Passage:
+    __slots__ = ('section', 'position', 'text', 'urls', 'sketch', 'score', 'tokens')
+    def __init__(self, section:int, position:int, text:str, urls:List[str]):
+        self.section = section
+        self.position = position
+        self.text = text
+        self.urls = urls
+        self.sketch:FrozenSet[int] = frozenset()
+        self.score = 0.0
+        self.tokens = estimate_tokens(text)
+
+class PassageIndex:
+    # passages and sources already returned to the model, shared by the searches of one research job ;
+    # only the max_passages most recent sketches and the max_urls most recent sources are remembered,
+    # which also bounds the duplicate scan of every new passage
+    def __init__(self, max_passages:int=1024, max_urls:int=8192):
+        self.sketches:Deque[FrozenSet[int]] = deque(maxlen=max_passages)
+        self.urls:OrderedDict[str, None] = OrderedDict()
+        self.max_urls = max_urls
+        self.lock = threading.Lock()
+
+    def add_urls(self, urls:Iterable[str]) -> None:
+        # must be called with self.lock held
+        for url in urls:
+            self.urls[url] = None
+            self.urls.move_to_end(url)
+        while len(self.urls) > self.max_urls:
+            self.urls.popitem(last=False)
+
+class SearchAggregator:
+    # sits between make_search and the tool_result of simple_web_search:
+    #   results are split into passages, links are normalized, near duplicates (across queries and across the
+    #   iterations sharing a PassageIndex) are dropped, the rest is packed into token_budget by relevance;
+    #   every url of a dropped passage that the model has not seen yet is kept in a trailing sources section
+    def __init__(self, token_budget:int=4000, similarity_threshold:float=0.7, shingle_size:int=5, sketch_size:int=64, min_passage_chars:int=80):
+        self.token_budget = token_budget
+        self.similarity_threshold = similarity_threshold
+        self.shingle_size = shingle_size
+        self.sketch_size = sketch_size
+        self.min_passage_chars = min_passage_chars
+
+    def split(self, section:int, result:str) -> List[Passage]:
+        passages:List[Passage] = []
+        pending = ''
+        for paragraph in re.split(r'\n\s*\n', result.strip()):
+            paragraph = URL_PATTERN.sub(lambda match: normalize_url(match.group()), paragraph.strip())
+            if paragraph == '':
+                continue
+            # headings and short lines are kept with the paragraph that follows them
+            pending = f'{pending}\n{paragraph}' if pending != '' else paragraph
+            if len(pending) < self.min_passage_chars:
+                continue
+            passages.append(Passage(section, len(passages), pending, list(dict.fromkeys(URL_PATTERN.findall(pending)))))
+            pending = ''
+        if pending != '':
+            passages.append(Passage(section, len(passages), pending, list(dict.fromkeys(URL_PATTERN.findall(pending)))))
+        return passages
+
+    def score(self, passage:Passage, query_terms:Set[str]) -> float:
+        passage_terms = terms(URL_PATTERN.sub(' ', passage.text))
+        coverage = len(passage_terms & query_terms) / len(query_terms) if len(query_terms) > 0 else 0.0
+        # cited passages and the opening of an answer usually carry the substance
+        return coverage + 0.1 * min(3, len(passage.urls)) + 0.2 / (1 + passage.position)
+
+    def aggregate(self, search_results:List[str], index:Optional[PassageIndex]=None, research_query:Optional[str]=None) -> str:
+        index = index if index is not None else PassageIndex()
+        queries:List[str] = []
+        sections:List[str] = []
+        failures:List[str] = []
+        passages:List[Passage] = []
+        for search_result in search_results:
+            match = RESULT_PATTERN.fullmatch(search_result)
+            if match is None:
+                # failed searches are returned as they are
+                failures.append(search_result)
+                continue
+            query = match.group('query')
+            query_terms = terms(query) | (terms(research_query) if research_query is not None else set())
+            for passage in self.split(len(queries), match.group('result')):
+                passage.score = self.score(passage, query_terms)
+                passage.sketch = sketch(passage.text, self.shingle_size, self.sketch_size)
+                passages.append(passage)
+            queries.append(query)
+
+        nb_duplicates, nb_over_budget, used_tokens = 0, 0, sum([ estimate_tokens(failure) for failure in failures ])
+        kept:List[Passage] = []
+        dropped_urls:List[str] = []
+        with index.lock:
+            for passage in sorted(passages, key=lambda passage: passage.score, reverse=True):
+                if any([ similarity(passage.sketch, seen, self.sketch_size) >= self.similarity_threshold for seen in index.sketches ]):
+                    nb_duplicates += 1
+                    dropped_urls.extend(passage.urls)
+                    continue
+                if used_tokens + passage.tokens > self.token_budget:
+                    nb_over_budget += 1
+                    dropped_urls.extend(passage.urls)
+                    continue
+                index.sketches.append(passage.sketch)
+                kept.append(passage)
+                used_tokens += passage.tokens
+
+            kept_urls = set([ url for passage in kept for url in passage.urls ])
+            sources = [ url for url in dict.fromkeys(dropped_urls) if url not in kept_urls and url not in index.urls ]
+            index.add_urls(kept_urls)
+            index.add_urls(sources)
+
+        # sections follow the relevance of their best passage, passages keep their order inside a section
+        by_section:Dict[int, List[Passage]] = {}
+        for passage in kept:
+            by_section.setdefault(passage.section, []).append(passage)
+        for section, section_passages in by_section.items():
+            section_passages.sort(key=lambda passage: passage.position)
+            sections.append(f'query:{queries[section]}\n###\nresult:' + '\n\n'.join([ passage.text for passage in section_passages ]))
+        sections.extend(failures)
+        if len(sources) > 0:
+            sections.append('sources (passages left out as duplicates or over the token budget):\n' + '\n'.join(sources))
+
+        text = SEARCH_RESULT_SEPARATOR.join(sections)
+        raw_tokens = sum([ estimate_tokens(search_result) for search_result in search_results ])
+        logger.info(f'search aggregation: {len(kept)}/{len(passages)} passages kept, {nb_duplicates} duplicates, {nb_over_budget} over budget, {len(sources)} extra sources, {raw_tokens} -> {estimate_tokens(text)} tokens')
+        if telemetry.enabled:
+            telemetry.inc('search_aggregation_tokens_total', raw_tokens, stage='raw')
+            telemetry.inc('search_aggregation_tokens_total', estimate_tokens(text), stage='packed')
+            telemetry.inc('search_aggregation_passages_total', nb_duplicates, outcome='duplicate')
+            telemetry.inc('search_aggregation_passages_total', nb_over_budget, outcome='over_budget')
+            telemetry.inc('search_aggregation_passages_total', len(kept), outcome='kept')
+        return text
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import threading
+
+from collections import deque
+
+from typing import List, Dict, Set, Tuple, Deque, Optional, Any
+
+from .agent_loop import AgentLoop
+from .async_agent_loop import AsyncAgentLoop
+from .types import Role, ChatMessage, StopReason
+from .sinks import NullSink, current_sink
+from .transcript import TranscriptStore, Transcript, current_transcript
+from .log import logger
+
+class BatchItem:
+    __slots__ = ('item_id', 'query')
+    def __init__(self, item_id:str, query:str):
+        self.item_id = item_id
+        self.query = query
+
+def in_shard(item_id:str, shard_index:int, num_shards:int) -> bool:
+    # crc32 rather than hash() so that every process (and every restart) agrees on the split
+    return zlib.crc32(item_id.encode('utf-8')) % num_shards == shard_index
+
+def load_done_ids(output_path:str) -> Set[str]:
+    # only answered queries are skipped, failed ones are tried again on the next run
+    done_ids:Set[str] = set()
+    if not os.path.exists(output_path):
+        return done_ids
+    with open(output_path, mode='r', encoding='utf-8') as file_pointer:
+        for line in file_pointer:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get('status') == 'ok' and record.get('id') is not None:
+                done_ids.add(str(record['id']))
+    return done_ids
+
+def load_items(input_path:str, done_ids:Set[str], shard_index:int=0, num_shards:int=1) -> Tuple[List[BatchItem], int]:
+    # every line is {"id": ..., "query": ...}, a missing id is derived from the query so that restarts still recognize it
+    items:List[BatchItem] = []
+    seen_ids:Set[str] = set()
+    nb_skipped = 0
+    with open(input_path, mode='r', encoding='utf-8') as file_pointer:
+        for line_number, line in enumerate(file_pointer, start=1):
+            if line.strip() == '':
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            query = record.get('query') if isinstance(record, dict) else None
+            if not isinstance(query, str) or query.strip() == '':
+                logger.warning(f'batch: line {line_number} of {input_path} is not a json object with a query string, skipped')
+                continue
+            item_id = str(record['id']) if record.get('id') is not None else hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+            if not in_shard(item_id, shard_index, num_shards):
+                continue
+            if item_id in done_ids or item_id in seen_ids:
+                nb_skipped += 1
+                continue
+            seen_ids.add(item_id)
+            items.append(BatchItem(item_id, query))
+    return items, nb_skipped
+
+def final_answer(conversation_history:List[ChatMessage]) -> str:
+    for chat_message in reversed(conversation_history):
+        if chat_message.role != Role.ASSISTANT:
+            continue
+        if isinstance(chat_message.content, str):
+            return chat_message.content
+        return '\n'.join([ block['text'] for block in chat_message.content if block.get('type') == 'text' ])
+    return ''
+
+class BatchWriter:
+    # results are appended and flushed one line at a time, the output doubles as the record of finished ids
+    def __init__(self, output_path:str):
+        self.lock = threading.Lock()
+        self.file_pointer = open(output_path, mode='a+', encoding='utf-8')
+        # a line torn by a crash is terminated so that it does not swallow the next record
+        if self.file_pointer.tell() > 0:
+            self.file_pointer.seek(self.file_pointer.tell() - 1)
+            if self.file_pointer.read(1) != '\n':
+                self.file_pointer.write('\n')
+
+    def write(self, record:Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.file_pointer.write(line + '\n')
+            self.file_pointer.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file_pointer.close()
+
+class BatchProgress:
+    # logs throughput and an eta every interval seconds from a background thread, for both engines
+    def __init__(self, total:int, nb_skipped:int=0, interval:float=10.0):
+        self.total = total
+        self.nb_skipped = nb_skipped
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.nb_completed = 0
+        self.nb_failed = 0
+        self.started_at = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, name='batch_progress', daemon=True)
+
+    def record(self, succeeded:bool) -> None:
+        with self.lock:
+            self.nb_completed += 1
+            if not succeeded:
+                self.nb_failed += 1
+
+    def loop(self) -> None:
+        nb_reported, reported_at = 0, self.started_at
+        while not self.stop_event.wait(self.interval):
+            with self.lock:
+                nb_completed, nb_failed = self.nb_completed, self.nb_failed
+            now = time.monotonic()
+            recent_rate = (nb_completed - nb_reported) / (now - reported_at)
+            overall_rate = nb_completed / (now - self.started_at)
+            eta = format_duration((self.total - nb_completed) / overall_rate) if overall_rate > 0 else 'unknown'
+            logger.info(f'batch: {nb_completed}/{self.total} done ({nb_failed} failed), {recent_rate:.2f} queries/s over the last {now - reported_at:.0f}s, {overall_rate:.2f} queries/s overall, eta {eta}')
+            nb_reported, reported_at = nb_completed, now
+
+    def start(self) -> None:
+        self.started_at = time.monotonic()
+        self.thread.start()
+
+    def stop(self) -> Dict[str, Any]:
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        wall_time = time.monotonic() - self.started_at
+        return {
+            'total': self.total,
+            'completed': self.nb_completed,
+            'failed': self.nb_failed,
+            'skipped': self.nb_skipped,
+            'wall_time': wall_time,
+            'queries_per_second': self.nb_completed / wall_time if wall_time > 0 else 0.0
+        }
+
+def format_duration(seconds:float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m{seconds:02d}s' if hours > 0 else f'{minutes}m{seconds:02d}s'
+
+class BatchRunner:
+    # drives `concurrency` sessions that pull queries from a shared queue until it is empty ;
+    # with a transcript store every query is checkpointed under batch-<hash of its id>, a query interrupted
+    # by a crash resumes from its transcript (and its deep research from its last iteration) on the next run
+    def __init__(self, writer:BatchWriter, progress:BatchProgress, transcript_store:Optional[TranscriptStore]=None):
+        self.writer = writer
+        self.progress = progress
+        self.transcript_store = transcript_store
+
+    def open_transcript(self, item:BatchItem) -> Tuple[Optional[Transcript], List[ChatMessage]]:
+        if self.transcript_store is None:
+            return None, []
+        transcript = self.transcript_store.open('batch-' + hashlib.sha1(item.item_id.encode('utf-8')).hexdigest()[:16])
+        return transcript, list(transcript.messages)
+
+    def start_turn(self, item:BatchItem, transcript:Optional[Transcript], conversation_history:List[ChatMessage]) -> None:
+        user_message = ChatMessage(role=Role.USER, content=item.query)
+        conversation_history.append(user_message)
+        if transcript is not None:
+            transcript.append([user_message])
+
+    def finish(self, item:BatchItem, transcript:Optional[Transcript], conversation_history:List[ChatMessage], stop_reason:Optional[StopReason], error:Optional[Exception], started_at:float) -> None:
+        succeeded = error is None and stop_reason != StopReason.TOOL_USE
+        if transcript is not None:
+            transcript.close()
+            if succeeded:
+                self.transcript_store.delete(transcript.transcript_id)
+        record = {
+            'id': item.item_id,
+            'query': item.query,
+            'status': 'ok' if succeeded else 'error',
+            'stop_reason': stop_reason,
+            'answer': final_answer(conversation_history) if succeeded else None,
+            'nb_messages': len(conversation_history),
+            'duration': time.perf_counter() - started_at
+        }
+        if not succeeded:
+            record['error'] = repr(error) if error is not None else 'the turn did not complete'
+            logger.error(f'batch: query {item.item_id} failed: {record["error"]}')
+        self.writer.write(record)
+        self.progress.record(succeeded)
+
+    def process(self, agent_loop:AgentLoop, item:BatchItem) -> None:
+        started_at = time.perf_counter()
+        transcript, conversation_history = self.open_transcript(item)
+        token = current_transcript.set(transcript)
+        stop_reason:Optional[StopReason] = None
+        error:Optional[Exception] = None
+        try:
+            if len(conversation_history) > 0:
+                # resume_turn returns None when the restored turn had already finished
+                stop_reason = agent_loop.resume_turn(conversation_history) or StopReason.END_TURN
+            else:
+                self.start_turn(item, transcript, conversation_history)
+                stop_reason = agent_loop.handle_turn(conversation_history)
+        except Exception as e:
+            error = e
+        finally:
+            current_transcript.reset(token)
+        self.finish(item, transcript, conversation_history, stop_reason, error, started_at)
+
+    async def aprocess(self, agent_loop:AsyncAgentLoop, item:BatchItem) -> None:
+        # the transcript and output files are only touched from worker threads, never on the event loop
+        started_at = time.perf_counter()
+        transcript, conversation_history = await asyncio.to_thread(self.open_transcript, item)
+        token = current_transcript.set(transcript)
+        stop_reason:Optional[StopReason] = None
+        error:Optional[Exception] = None
+        try:
+            if len(conversation_history) > 0:
+                stop_reason = await agent_loop.resume_turn(conversation_history) or StopReason.END_TURN
+            else:
+                await asyncio.to_thread(self.start_turn, item, transcript, conversation_history)
+                stop_reason = await agent_loop.handle_turn(conversation_history)
+        except Exception as e:
+            error = e
+        finally:
+            current_transcript.reset(token)
+        await asyncio.to_thread(self.finish, item, transcript, conversation_history, stop_reason, error, started_at)
+
+    def run(self, agent_loop:AgentLoop, items:List[BatchItem], concurrency:int) -> None:
+        pending:Deque[BatchItem] = deque(items)
+
+        def session() -> None:
+            current_sink.set(NullSink())
+            while True:
+                try:
+                    item = pending.popleft()
+                except IndexError:
+                    return
+                self.process(agent_loop, item)
+
+        threads = [ threading.Thread(target=session, name=f'batch_{index}') for index in range(min(concurrency, len(items))) ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            # queries in flight are finished and written, the rest is picked up by the next run
+            logger.info(f'batch: interrupted, finishing the queries in flight and leaving {len(pending)} for the next run')
+            pending.clear()
+            for thread in threads:
+                thread.join()
+
+    async def arun(self, agent_loop:AsyncAgentLoop, items:List[BatchItem], concurrency:int) -> None:
+        pending:Deque[BatchItem] = deque(items)
+
+        async def session() -> None:
+            current_sink.set(NullSink())
+            while len(pending) > 0:
+                await self.aprocess(agent_loop, pending.popleft())
+
+        await asyncio.gather(*[ session() for _ in range(min(concurrency, len(items))) ])
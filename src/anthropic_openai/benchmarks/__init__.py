@@ -0,0 +1,2 @@
+from .engine import EngineBenchmarkConfig, run_engine_benchmark, write_results
+from .accumulator import AccumulatorBenchmarkConfig, run_accumulator_benchmark
@@ -0,0 +1,139 @@
+import json
+import time
+import random
+import platform
+import tracemalloc
+
+from pydantic import BaseModel
+
+from typing import List, Dict, Any, Callable
+
+from ..accumulator import StreamAccumulator
+from ..mock_providers import synthetic_message_events, to_namespace
+from .engine import git_commit
+
+class AccumulatorBenchmarkConfig(BaseModel):
+    deltas:int = 10_000
+    tokens_per_delta:int = 4
+    tool_argument_chars:int = 4096
+    repeat:int = 20
+    seed:int = 0
+
+def legacy_accumulate(events:List[Any]) -> List[Dict]:
+    # the string concatenation consume_stream used before StreamAccumulator, kept as the baseline
+    content:List[Dict] = []
+    current_block_type = None
+    text, signature, thinking, tool_name, tool_args, tool_use_id = None, None, None, None, None, None
+    for event in events:
+        match event.type:
+            case 'content_block_start':
+                current_block_type = event.content_block.type
+                match event.content_block.type:
+                    case 'text':
+                        text = event.content_block.text
+                    case 'thinking':
+                        thinking = event.content_block.thinking
+                        signature = event.content_block.signature
+                    case 'tool_use':
+                        tool_name = event.content_block.name
+                        tool_args = ''
+                        tool_use_id = event.content_block.id
+            case 'content_block_delta':
+                match event.delta.type:
+                    case 'text_delta':
+                        text = text + event.delta.text
+                    case 'thinking_delta':
+                        thinking = thinking + event.delta.thinking
+                    case 'signature_delta':
+                        signature = signature + event.delta.signature
+                    case 'input_json_delta':
+                        tool_args = tool_args + event.delta.partial_json
+            case 'content_block_stop':
+                match current_block_type:
+                    case 'text':
+                        content.append({'type': 'text', 'text': text})
+                    case 'thinking':
+                        content.append({'type': 'thinking', 'thinking': thinking, 'signature': signature})
+                    case 'tool_use':
+                        content.append({'type': 'tool_use', 'name': tool_name, 'input': json.loads(tool_args or '{}'), 'id': tool_use_id})
+    return content
+
+def stream_accumulate(events:List[Any]) -> List[Dict]:
+    accumulator = StreamAccumulator()
+    for event in events:
+        match event.type:
+            case 'content_block_start':
+                accumulator.start(event.content_block)
+            case 'content_block_delta':
+                accumulator.add(event.delta)
+            case 'content_block_stop':
+                accumulator.stop()
+    return accumulator.content
+
+def stream_accumulate_partial_arguments(events:List[Any]) -> List[Dict]:
+    # consume_stream feeding a sink with partial_tool_input, the tool arguments are parsed after every delta
+    accumulator = StreamAccumulator()
+    for event in events:
+        match event.type:
+            case 'content_block_start':
+                accumulator.start(event.content_block)
+            case 'content_block_delta':
+                accumulator.add(event.delta)
+                if event.delta.type == 'input_json_delta':
+                    accumulator.current.partial_arguments()
+            case 'content_block_stop':
+                accumulator.stop()
+    return accumulator.content
+
+def synthetic_stream(config:AccumulatorBenchmarkConfig) -> List[Any]:
+    rng = random.Random(config.seed)
+    nb_tokens = config.deltas * config.tokens_per_delta
+    queries = []
+    while len(json.dumps(queries)) < config.tool_argument_chars:
+        queries.append(' '.join([ word.strip() for word in rng.sample(['quantum', 'error', 'correction', 'latest', 'results', 'surface', 'code', 'qubit', 'logical', 'threshold'], 5) ]) + '?')
+    events = synthetic_message_events(
+        rng,
+        thinking_tokens=nb_tokens // 2,
+        text_tokens=nb_tokens // 2,
+        tool_calls=[{'name': 'simple_web_search', 'input': {'expanded_queries': queries, 'search_context_size': 'medium'}}],
+        tokens_per_delta=config.tokens_per_delta
+    )
+    return to_namespace(events)
+
+def _measure(accumulate:Callable[[List[Any]], List[Dict]], events:List[Any], repeat:int, nb_deltas:int) -> Dict[str, float]:
+    cpu_times:List[float] = []
+    for _ in range(repeat):
+        started_at = time.process_time()
+        accumulate(events)
+        cpu_times.append(time.process_time() - started_at)
+    tracemalloc.start()
+    accumulate(events)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = min(cpu_times)
+    return {
+        'cpu_seconds_best': best,
+        'cpu_seconds_mean': sum(cpu_times) / len(cpu_times),
+        'cpu_microseconds_per_10k_deltas': best / nb_deltas * 10_000 * 1e6,
+        'peak_traced_memory_bytes': peak_memory
+    }
+
+def run_accumulator_benchmark(config:AccumulatorBenchmarkConfig) -> Dict[str, Any]:
+    events = synthetic_stream(config)
+    nb_deltas = sum([ 1 for event in events if event.type == 'content_block_delta' ])
+    if not legacy_accumulate(events) == stream_accumulate(events) == stream_accumulate_partial_arguments(events):
+        raise ValueError('the accumulators disagree on the synthetic stream')
+    return {
+        'benchmark': 'accumulator',
+        'timestamp': time.time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config.model_dump(),
+        'results': {
+            'deltas': nb_deltas,
+            'legacy': _measure(legacy_accumulate, events, config.repeat, nb_deltas),
+            'accumulator': _measure(stream_accumulate, events, config.repeat, nb_deltas),
+            'accumulator_partial_arguments': _measure(stream_accumulate_partial_arguments, events, config.repeat, nb_deltas)
+        }
+    }
@@ -0,0 +1,244 @@
+import sys
+import json
+import math
+import time
+import asyncio
+import logging
+import platform
+import resource
+import threading
+import subprocess
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from pydantic import BaseModel, Field
+
+from typing import List, Dict, Any, Optional, Callable
+
+from ..agent_loop import AgentLoop
+from ..async_agent_loop import AsyncAgentLoop
+from ..cache import SearchCache
+from ..prefetch import SearchPrefetcher
+from ..types import Role, ChatMessage
+from ..throttling import request_scheduler, ProviderLimits
+from ..sinks import NullSink, current_sink
+from ..mock_providers import ProviderProfile, AgentScript, ReplayScript, MockAnthropic, MockOpenAI, AsyncMockAnthropic, AsyncMockOpenAI, load_recorded_streams, load_recorded_completions
+from ..log import logger
+
+class EngineBenchmarkConfig(BaseModel):
+    engine:str = 'thread'
+    scenario:str = 'run'
+    sessions:int = 32
+    concurrency:int = 8
+    research_iterations:int = 3
+    queries_per_search:int = 4
+    thinking_tokens:int = 256
+    text_tokens:int = 512
+    search_result_tokens:int = 400
+    anthropic_profile:ProviderProfile = Field(default_factory=ProviderProfile)
+    openai_profile:ProviderProfile = Field(default_factory=lambda: ProviderProfile(time_to_first_byte=0.5, per_token_delay=0.0005))
+    recording:Optional[str] = None
+    search_recording:Optional[str] = None
+    use_search_cache:bool = False
+    prefetch:bool = False
+    proposal_accuracy:Optional[float] = None
+    trace_memory:bool = False
+    seed:int = 0
+
+def percentile(sorted_values:List[float], q:float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def summarize(values:List[float]) -> Dict[str, float]:
+    sorted_values = sorted(values)
+    return {
+        'count': len(sorted_values),
+        'mean': sum(sorted_values) / len(sorted_values) if len(sorted_values) > 0 else 0.0,
+        'p50': percentile(sorted_values, 50),
+        'p95': percentile(sorted_values, 95),
+        'p99': percentile(sorted_values, 99),
+        'max': sorted_values[-1] if len(sorted_values) > 0 else 0.0
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5, check=True).stdout.strip()
+    except Exception:
+        return None
+
+class LatencyRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples:Dict[str, List[float]] = {}
+
+    def add(self, name:str, duration:float) -> None:
+        with self.lock:
+            self.samples.setdefault(name, []).append(duration)
+
+    def wrap(self, name:str, fn:Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started_at)
+        return wrapper
+
+    def awrap(self, name:str, fn:Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started_at)
+        return wrapper
+
+def _script(config:EngineBenchmarkConfig) -> Callable[[Dict, int], List[Dict]]:
+    if config.recording is not None:
+        return ReplayScript(load_recorded_streams(config.recording))
+    return AgentScript(
+        research_iterations=config.research_iterations,
+        queries_per_search=config.queries_per_search,
+        thinking_tokens=config.thinking_tokens,
+        text_tokens=config.text_tokens,
+        seed=config.seed,
+        proposal_accuracy=config.proposal_accuracy
+    )
+
+def _completions(config:EngineBenchmarkConfig) -> Optional[List[Dict]]:
+    return load_recorded_completions(config.search_recording) if config.search_recording is not None else None
+
+def _queries(config:EngineBenchmarkConfig, session_id:int) -> List[str]:
+    return [ f'benchmark session {session_id} query {index}?' for index in range(config.queries_per_search) ]
+
+def _run_threaded(config:EngineBenchmarkConfig, recorder:LatencyRecorder, search_cache:SearchCache, search_prefetcher:Optional[SearchPrefetcher]) -> Dict[str, int]:
+    anthropic_client = MockAnthropic(script=_script(config), profile=config.anthropic_profile)
+    openai_client = MockOpenAI(profile=config.openai_profile, result_tokens=config.search_result_tokens, completions=_completions(config))
+    agent_loop = AgentLoop(
+        openai_api_key='benchmark',
+        anthropic_api_key='benchmark',
+        max_search_workers=config.concurrency * config.queries_per_search,
+        max_tool_workers=config.concurrency,
+        search_cache=search_cache,
+        openai_client=openai_client,
+        anthropic_client=anthropic_client,
+        search_prefetcher=search_prefetcher
+    )
+    agent_loop.simple_web_search = recorder.wrap('fan_out', agent_loop.simple_web_search)
+
+    def session(session_id:int) -> None:
+        current_sink.set(NullSink())
+        started_at = time.perf_counter()
+        try:
+            match config.scenario:
+                case 'run':
+                    agent_loop.handle_turn([ChatMessage(role=Role.USER, content=f'benchmark question {session_id}')])
+                case 'deep_iterative_web_search':
+                    agent_loop.deep_iterative_web_search(f'benchmark question {session_id}', 'none', 'low', config.research_iterations)
+                case 'simple_web_search':
+                    agent_loop.simple_web_search(_queries(config, session_id), 'medium')
+        finally:
+            recorder.add('turn', time.perf_counter() - started_at)
+
+    with agent_loop:
+        with ThreadPoolExecutor(max_workers=config.concurrency, thread_name_prefix='session') as executor:
+            list(executor.map(session, range(config.sessions)))
+    return {'anthropic_requests': anthropic_client.nb_requests, 'openai_requests': openai_client.nb_requests, 'injected_failures': anthropic_client.nb_failures + openai_client.nb_failures}
+
+async def _run_asyncio(config:EngineBenchmarkConfig, recorder:LatencyRecorder, search_cache:SearchCache, search_prefetcher:Optional[SearchPrefetcher]) -> Dict[str, int]:
+    anthropic_client = AsyncMockAnthropic(script=_script(config), profile=config.anthropic_profile)
+    openai_client = AsyncMockOpenAI(profile=config.openai_profile, result_tokens=config.search_result_tokens, completions=_completions(config))
+    agent_loop = AsyncAgentLoop(
+        openai_api_key='benchmark',
+        anthropic_api_key='benchmark',
+        search_cache=search_cache,
+        openai_client=openai_client,
+        anthropic_client=anthropic_client,
+        search_prefetcher=search_prefetcher
+    )
+    agent_loop.simple_web_search = recorder.awrap('fan_out', agent_loop.simple_web_search)
+    semaphore = asyncio.Semaphore(config.concurrency)
+
+    async def session(session_id:int) -> None:
+        current_sink.set(NullSink())
+        async with semaphore:
+            started_at = time.perf_counter()
+            try:
+                match config.scenario:
+                    case 'run':
+                        await agent_loop.handle_turn([ChatMessage(role=Role.USER, content=f'benchmark question {session_id}')])
+                    case 'deep_iterative_web_search':
+                        await agent_loop.deep_iterative_web_search(f'benchmark question {session_id}', 'none', 'low', config.research_iterations)
+                    case 'simple_web_search':
+                        await agent_loop.simple_web_search(_queries(config, session_id), 'medium')
+            finally:
+                recorder.add('turn', time.perf_counter() - started_at)
+
+    async with agent_loop:
+        await asyncio.gather(*[ session(session_id) for session_id in range(config.sessions) ])
+    return {'anthropic_requests': anthropic_client.nb_requests, 'openai_requests': openai_client.nb_requests, 'injected_failures': anthropic_client.nb_failures + openai_client.nb_failures}
+
+def run_engine_benchmark(config:EngineBenchmarkConfig) -> Dict[str, Any]:
+    log_level = logger.level
+    logger.setLevel(logging.WARNING)
+    saved_limits = dict(request_scheduler.provider_limits)
+    unlimited = ProviderLimits(max_concurrency=sys.maxsize)
+    request_scheduler.configure('anthropic', unlimited)
+    request_scheduler.configure('openai', unlimited)
+    search_cache = SearchCache(path=None, max_entries=1024 if config.use_search_cache else 0)
+    search_prefetcher = SearchPrefetcher(max_inflight=config.concurrency * config.queries_per_search) if config.prefetch else None
+
+    recorder = LatencyRecorder()
+    if config.trace_memory:
+        tracemalloc.start()
+    cpu_started_at = time.process_time()
+    started_at = time.perf_counter()
+    try:
+        if config.engine == 'asyncio':
+            counters = asyncio.run(_run_asyncio(config, recorder, search_cache, search_prefetcher))
+        else:
+            counters = _run_threaded(config, recorder, search_cache, search_prefetcher)
+    finally:
+        wall_time = time.perf_counter() - started_at
+        cpu_time = time.process_time() - cpu_started_at
+        peak_memory = tracemalloc.get_traced_memory()[1] if config.trace_memory else None
+        if config.trace_memory:
+            tracemalloc.stop()
+        search_cache.close()
+        for provider, limits in saved_limits.items():
+            request_scheduler.configure(provider, limits)
+        logger.setLevel(log_level)
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'benchmark': 'engine',
+        'timestamp': time.time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config.model_dump(),
+        'results': {
+            'sessions': config.sessions,
+            'wall_time': wall_time,
+            'sessions_per_second': config.sessions / wall_time if wall_time > 0 else 0.0,
+            'turn_latency': summarize(recorder.samples.get('turn', [])),
+            'fan_out_latency': summarize(recorder.samples.get('fan_out', [])),
+            'cpu_time': cpu_time,
+            'cpu_time_per_session': cpu_time / config.sessions if config.sessions > 0 else 0.0,
+            'peak_traced_memory_bytes': peak_memory,
+            'max_rss_bytes': max_rss * 1024 if sys.platform != 'darwin' else max_rss,
+            'search_cache': search_cache.stats(),
+            'prefetch': search_prefetcher.stats() if search_prefetcher is not None else None,
+            **counters
+        }
+    }
+
+def write_results(results:Dict[str, Any], path:str) -> None:
+    # one json document per line so that runs from successive commits can be appended and diffed
+    with open(path, mode='a', encoding='utf-8') as file_pointer:
+        file_pointer.write(json.dumps(results) + '\n')
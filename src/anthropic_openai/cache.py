@@ -0,0 +1,210 @@
+import re
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from typing import Dict, Tuple, Optional, Callable, Awaitable
+
+from .log import logger
+
+SEARCH_CONTEXT_SIZES = ('low', 'medium', 'high')
+
+class ComputationAbandoned(Exception):
+    # set on a shared in-flight future when its owner was cancelled or interrupted, its waiters retry the key
+    pass
+
+def normalize_query(query:str) -> str:
+    query = unicodedata.normalize('NFKC', query).casefold()
+    query = re.sub(r'[^\w\s]', ' ', query)
+    return ' '.join(query.split())
+
+def consume_outcome(future:asyncio.Future) -> None:
+    # the outcome of a shielded future whose waiter went away is still retrieved, asyncio would log it otherwise
+    if not future.cancelled():
+        future.exception()
+
+class SearchCache:
+    def __init__(self, path:Optional[str]='search_cache.sqlite3', max_entries:int=1024, ttl:float=3600.0, purge_every:int=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self.lock = threading.Lock()
+        self.entries:OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self.inflight:Dict[str, Future] = {}
+        self.counters:Dict[str, int] = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'expirations': 0
+        }
+        self.nb_writes = 0
+        self.connection:Optional[sqlite3.Connection] = None
+        self.connection_lock = threading.Lock()
+        if path is not None:
+            self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS search_results (key TEXT PRIMARY KEY, query TEXT, search_context_size TEXT, result TEXT, expires_at REAL)'
+            )
+
+    @staticmethod
+    def make_key(query:str, search_context_size:str) -> str:
+        return hashlib.sha256(f'{normalize_query(query)}\x00{search_context_size}'.encode('utf-8')).hexdigest()
+
+    def close(self) -> None:
+        if self.connection is not None:
+            with self.connection_lock:
+                self.connection.close()
+                self.connection = None
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['hits'] = stats['memory_hits'] + stats['disk_hits']
+            stats['entries'] = len(self.entries)
+            stats['inflight'] = len(self.inflight)
+        return stats
+
+    def _get_memory(self, key:str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                self.counters['expirations'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['memory_hits'] += 1
+            return value
+
+    def _put_memory(self, key:str, value:str, expires_at:float) -> None:
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def _get_disk(self, key:str) -> Optional[str]:
+        if self.connection is None:
+            return None
+        with self.connection_lock:
+            row = self.connection.execute('SELECT result, expires_at FROM search_results WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        value, expires_at = row
+        self._put_memory(key, value, expires_at)
+        with self.lock:
+            self.counters['disk_hits'] += 1
+        return value
+
+    def _put_disk(self, key:str, value:str, expires_at:float, query:str, search_context_size:str) -> None:
+        if self.connection is None:
+            return
+        with self.connection_lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO search_results (key, query, search_context_size, result, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (key, query, search_context_size, value, expires_at)
+            )
+            self.nb_writes += 1
+            if self.nb_writes % self.purge_every == 0:
+                self.connection.execute('DELETE FROM search_results WHERE expires_at < ?', (time.time(),))
+
+    def _claim(self, key:str) -> Tuple[Future, bool]:
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                self.counters['coalesced'] += 1
+                return future, False
+            future = Future()
+            self.inflight[key] = future
+            return future, True
+
+    def _settle(self, key:str, future:Future, value:Optional[str]=None, error:Optional[BaseException]=None) -> None:
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+        if future.done():
+            return
+        if error is not None and not isinstance(error, Exception):
+            # a cancelled or interrupted owner must not cancel the waiters of other sessions, one of them takes over
+            error = ComputationAbandoned(f'the search of this key was abandoned ({type(error).__name__})')
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def _store(self, key:str, value:str, query:str, search_context_size:str) -> None:
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, value, expires_at)
+        try:
+            self._put_disk(key, value, expires_at, query, search_context_size)
+        except sqlite3.Error as e:
+            logger.warning(f'search cache write failed: {e}')
+
+    def get_or_compute(self, query:str, search_context_size:str, compute:Callable[[], str]) -> str:
+        key = self.make_key(query, search_context_size)
+        while True:
+            value = self._get_memory(key)
+            if value is not None:
+                return value
+            future, owner = self._claim(key)
+            if owner:
+                break
+            try:
+                return future.result()
+            except ComputationAbandoned:
+                continue
+        try:
+            value = self._get_disk(key)
+            if value is None:
+                with self.lock:
+                    self.counters['misses'] += 1
+                value = compute()
+                self._store(key, value, query, search_context_size)
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, value=value)
+        return value
+
+    async def aget_or_compute(self, query:str, search_context_size:str, compute:Callable[[], Awaitable[str]]) -> str:
+        key = self.make_key(query, search_context_size)
+        while True:
+            value = self._get_memory(key)
+            if value is not None:
+                return value
+            future, owner = self._claim(key)
+            if owner:
+                break
+            # the shared future is shielded, a waiter that is cancelled only stops waiting
+            shared = asyncio.wrap_future(future)
+            shared.add_done_callback(consume_outcome)
+            try:
+                return await asyncio.shield(shared)
+            except ComputationAbandoned:
+                continue
+        try:
+            value = await asyncio.to_thread(self._get_disk, key)
+            if value is None:
+                with self.lock:
+                    self.counters['misses'] += 1
+                value = await compute()
+                await asyncio.to_thread(self._store, key, value, query, search_context_size)
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, value=value)
+        return value
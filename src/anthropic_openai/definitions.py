@@ -33,7 +33,7 @@ class SystemPromptDefinitions(str, Enum):
     DEEP_ITERATIVE_WEB_SEARCH:str = ('''
     TASK: Conduct a deep iterative web search to provide comprehensive, accurate, and up-to-date information.
     MAX ITERATIONS: {max_iterations}
-    CURRENT ITERATION: {current_iteration}
+    CURRENT ITERATION: given as "current iteration: N/{max_iterations}" at the end of the latest user turn
                                      
     SEARCH METHODOLOGY:
     1. Begin with broad search queries to establish baseline understanding
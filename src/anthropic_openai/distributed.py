@@ -0,0 +1,450 @@
+import zmq
+import json
+import time
+import uuid
+import heapq
+import random
+import threading
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import suppress
+from contextvars import copy_context
+
+from typing import List, Dict, Any, Optional, Deque, Tuple, Callable, TYPE_CHECKING
+
+from .log import logger
+
+if TYPE_CHECKING:
+    from .agent_loop import AgentLoop
+
+# frames exchanged between clients (DEALER) -> broker (ROUTER/ROUTER) <- workers (DEALER)
+# client -> broker : JOB job_id payload
+# broker -> client : RESULT job_id result | ERROR job_id message
+# worker -> broker : READY capacity | HEARTBEAT | RESULT job_id result | ERROR job_id message | DISCONNECT
+# broker -> worker : JOB job_id payload | HEARTBEAT | DISCONNECT
+READY = b'READY'
+HEARTBEAT = b'HEARTBEAT'
+JOB = b'JOB'
+RESULT = b'RESULT'
+ERROR = b'ERROR'
+DISCONNECT = b'DISCONNECT'
+
+class RemoteJobError(Exception):
+    pass
+
+def encode(value:Any) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def decode(frame:bytes) -> Any:
+    return json.loads(frame.decode('utf-8'))
+
+class _Mailbox:
+    # lets any thread hand frames to the thread that owns a zmq socket, the wake-up socket is only touched under the lock
+    def __init__(self, context:zmq.Context, name:str):
+        address = f'inproc://{name}-{uuid.uuid4().hex}'
+        self.lock = threading.Lock()
+        self.closed = False
+        self.messages:Deque[List[bytes]] = deque()
+        self.receiver = context.socket(zmq.PULL)
+        self.receiver.bind(address)
+        self.sender = context.socket(zmq.PUSH)
+        self.sender.setsockopt(zmq.LINGER, 0)
+        self.sender.connect(address)
+
+    def post(self, frames:List[bytes]) -> None:
+        with self.lock:
+            if self.closed:
+                return
+            self.messages.append(frames)
+            with suppress(zmq.Again):
+                self.sender.send(b'', flags=zmq.DONTWAIT)
+
+    def drain(self) -> List[List[bytes]]:
+        with suppress(zmq.Again):
+            while True:
+                self.receiver.recv(flags=zmq.DONTWAIT)
+        with self.lock:
+            messages = list(self.messages)
+            self.messages.clear()
+        return messages
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            self.sender.close(linger=0)
+        self.receiver.close(linger=0)
+
+class _WorkerState:
+    __slots__ = ('identity', 'capacity', 'jobs', 'expires_at')
+    def __init__(self, identity:bytes, capacity:int, expires_at:float):
+        self.identity = identity
+        self.capacity = capacity
+        self.jobs:set = set()
+        self.expires_at = expires_at
+
+class _JobState:
+    __slots__ = ('job_id', 'client_id', 'payload', 'timeout', 'attempts', 'worker_id', 'deadline')
+    def __init__(self, job_id:bytes, client_id:bytes, payload:bytes, timeout:float):
+        self.job_id = job_id
+        self.client_id = client_id
+        self.payload = payload
+        self.timeout = timeout
+        self.attempts = 0
+        self.worker_id:Optional[bytes] = None
+        self.deadline = 0.0
+
+class SearchBroker:
+    def __init__(self, frontend_address:str, backend_address:str, heartbeat_interval:float=1.0, liveness:int=3, job_timeout:float=120.0, max_attempts:int=3, max_batch:int=1024):
+        self.frontend_address = frontend_address
+        self.backend_address = backend_address
+        self.heartbeat_interval = heartbeat_interval
+        self.liveness = liveness
+        self.job_timeout = job_timeout
+        self.max_attempts = max_attempts
+        self.max_batch = max_batch
+        self.workers:OrderedDict[bytes, _WorkerState] = OrderedDict()
+        self.jobs:Dict[bytes, _JobState] = {}
+        self.queue:Deque[bytes] = deque()
+        # (deadline, attempt, job_id) of every dispatch, entries of answered or redispatched jobs are skipped when they surface
+        self.deadlines:List[Tuple[float, int, bytes]] = []
+
+    def run(self, stop_event:Optional[threading.Event]=None) -> None:
+        context = zmq.Context()
+        self.frontend = context.socket(zmq.ROUTER)
+        self.frontend.bind(self.frontend_address)
+        self.backend = context.socket(zmq.ROUTER)
+        self.backend.bind(self.backend_address)
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        logger.info(f'broker is listening on {self.frontend_address} (clients) and {self.backend_address} (workers)')
+
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        try:
+            while stop_event is None or not stop_event.is_set():
+                events = dict(poller.poll(self.heartbeat_interval * 1000))
+                if self.backend in events:
+                    self.drain(self.backend, self.handle_worker_message)
+                if self.frontend in events:
+                    self.drain(self.frontend, self.handle_client_message)
+                now = time.monotonic()
+                self.purge_workers(now)
+                self.expire_jobs(now)
+                self.dispatch(now)
+                if now >= next_heartbeat:
+                    for identity in self.workers:
+                        self.backend.send_multipart([identity, HEARTBEAT])
+                    next_heartbeat = now + self.heartbeat_interval
+        except KeyboardInterrupt:
+            logger.info('broker is shutting down...')
+        finally:
+            for identity in self.workers:
+                self.backend.send_multipart([identity, DISCONNECT])
+            context.destroy(linger=0)
+
+    def drain(self, socket:zmq.Socket, handle:Callable[[List[bytes]], None]) -> None:
+        # every message already queued on a ready socket is handled in one wakeup, max_batch keeps a flooded
+        # socket from starving the other one and the dispatch that follows
+        with suppress(zmq.Again):
+            for _ in range(self.max_batch):
+                handle(socket.recv_multipart(flags=zmq.NOBLOCK))
+
+    def handle_client_message(self, frames:List[bytes]) -> None:
+        client_id, command, *rest = frames
+        if command != JOB or len(rest) != 2:
+            logger.warning(f'broker: unexpected client message {command}')
+            return
+        job_id, payload = rest
+        timeout = decode(payload).get('timeout') or self.job_timeout
+        self.jobs[job_id] = _JobState(job_id, client_id, payload, timeout)
+        self.queue.append(job_id)
+
+    def handle_worker_message(self, frames:List[bytes]) -> None:
+        identity, command, *rest = frames
+        now = time.monotonic()
+        worker = self.workers.get(identity)
+        if command == READY:
+            capacity = decode(rest[0]).get('capacity', 1) if len(rest) > 0 else 1
+            if worker is not None:
+                self.requeue_worker_jobs(worker)
+            self.workers[identity] = _WorkerState(identity, capacity, now + self.heartbeat_interval * self.liveness)
+            logger.info(f'broker: worker {identity.hex()} joined with capacity {capacity} ({len(self.workers)} workers)')
+            return
+        if worker is None:
+            # the broker restarted or already declared this worker dead: force it to register again
+            self.backend.send_multipart([identity, DISCONNECT])
+            return
+        worker.expires_at = now + self.heartbeat_interval * self.liveness
+        self.workers.move_to_end(identity)
+        match command:
+            case b'HEARTBEAT':
+                pass
+            case b'RESULT' | b'ERROR':
+                job_id, body = rest
+                worker.jobs.discard(job_id)
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return  # late answer for a job that was already answered by another worker or given up
+                if command == ERROR and job.worker_id != identity:
+                    return  # the job was already handed to another worker after a timeout
+                if command == ERROR and job.attempts < self.max_attempts:
+                    logger.warning(f'broker: job {job_id.hex()} failed on worker {identity.hex()} ({body.decode("utf-8")}), requeue')
+                    job.worker_id = None
+                    self.queue.appendleft(job_id)
+                    return
+                del self.jobs[job_id]
+                self.frontend.send_multipart([job.client_id, command, job_id, body])
+            case b'DISCONNECT':
+                self.requeue_worker_jobs(worker)
+                del self.workers[identity]
+                logger.info(f'broker: worker {identity.hex()} left')
+
+    def requeue_worker_jobs(self, worker:_WorkerState) -> None:
+        for job_id in worker.jobs:
+            job = self.jobs.get(job_id)
+            if job is not None and job.worker_id == worker.identity:
+                job.worker_id = None
+                self.queue.appendleft(job_id)
+        worker.jobs.clear()
+
+    def purge_workers(self, now:float) -> None:
+        for identity in [ identity for identity, worker in self.workers.items() if worker.expires_at < now ]:
+            worker = self.workers.pop(identity)
+            logger.warning(f'broker: worker {identity.hex()} missed its heartbeats, requeue {len(worker.jobs)} jobs')
+            self.requeue_worker_jobs(worker)
+
+    def expire_jobs(self, now:float) -> None:
+        # only the earliest deadlines are looked at, not every job in flight ; the heap is rebuilt from the jobs
+        # in flight once answered jobs make up most of it
+        if len(self.deadlines) > 2 * len(self.jobs) + self.max_batch:
+            self.deadlines = [ (job.deadline, job.attempts, job.job_id) for job in self.jobs.values() if job.worker_id is not None ]
+            heapq.heapify(self.deadlines)
+        while len(self.deadlines) > 0 and self.deadlines[0][0] < now:
+            _, attempts, job_id = heapq.heappop(self.deadlines)
+            job = self.jobs.get(job_id)
+            if job is None or job.worker_id is None or job.attempts != attempts:
+                continue
+            logger.warning(f'broker: job {job.job_id.hex()} timed out on worker {job.worker_id.hex()} (attempt {job.attempts})')
+            job.worker_id = None
+            if job.attempts < self.max_attempts:
+                self.queue.appendleft(job.job_id)
+                continue
+            del self.jobs[job.job_id]
+            self.frontend.send_multipart([job.client_id, ERROR, job.job_id, f'job timed out after {job.attempts} attempts'.encode('utf-8')])
+
+    def dispatch(self, now:float) -> None:
+        while len(self.queue) > 0:
+            job = self.jobs.get(self.queue[0])
+            if job is None or job.worker_id is not None:
+                self.queue.popleft()
+                continue
+            # least loaded worker first, workers are kept in least recently active order for ties
+            candidates = [ worker for worker in self.workers.values() if len(worker.jobs) < worker.capacity ]
+            if len(candidates) == 0:
+                return
+            worker = max(candidates, key=lambda worker: worker.capacity - len(worker.jobs))
+            self.queue.popleft()
+            job.attempts += 1
+            job.worker_id = worker.identity
+            job.deadline = now + job.timeout
+            heapq.heappush(self.deadlines, (job.deadline, job.attempts, job.job_id))
+            worker.jobs.add(job.job_id)
+            self.backend.send_multipart([worker.identity, JOB, job.job_id, job.payload])
+
+class SearchWorker:
+    def __init__(self, agent_loop:'AgentLoop', broker_address:str, capacity:int=8, heartbeat_interval:float=1.0, liveness:int=3, max_reconnect_interval:float=32.0, max_batch:int=1024):
+        self.agent_loop = agent_loop
+        self.broker_address = broker_address
+        self.capacity = capacity
+        self.heartbeat_interval = heartbeat_interval
+        self.liveness = liveness
+        self.max_reconnect_interval = max_reconnect_interval
+        self.max_batch = max_batch
+
+    def execute(self, kind:str, arguments:Dict) -> Any:
+        match kind:
+            case 'search':
+                query, search_context_size = arguments['query'], arguments['search_context_size']
+                return self.agent_loop.search_cache.get_or_compute(query, search_context_size, lambda: self.agent_loop.search(query, search_context_size))
+            case 'simple_web_search':
+                return self.agent_loop.simple_web_search(**arguments)
+            case 'deep_iterative_web_search':
+                return self.agent_loop.deep_iterative_web_search(**arguments)
+        raise RemoteJobError(f'unknown job kind: {kind}')
+
+    def run_job(self, mailbox:_Mailbox, job_id:bytes, payload:bytes) -> None:
+        try:
+            request = decode(payload)
+            result = self.execute(request['kind'], request['arguments'])
+            mailbox.post([RESULT, job_id, encode(result)])
+        except Exception as e:
+            logger.error(f'worker: job {job_id.hex()} failed: {e}')
+            mailbox.post([ERROR, job_id, str(e).encode('utf-8')])
+
+    def connect(self, context:zmq.Context) -> zmq.Socket:
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.broker_address)
+        socket.send_multipart([READY, encode({'capacity': self.capacity})])
+        return socket
+
+    def run(self, stop_event:Optional[threading.Event]=None) -> None:
+        context = zmq.Context()
+        mailbox = _Mailbox(context, 'search-worker')
+        executor = ThreadPoolExecutor(max_workers=self.capacity, thread_name_prefix='search_worker')
+        socket = self.connect(context)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(mailbox.receiver, zmq.POLLIN)
+        logger.info(f'worker is connected to {self.broker_address} with capacity {self.capacity}')
+
+        liveness = self.liveness
+        reconnect_interval = self.heartbeat_interval
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+        try:
+            while stop_event is None or not stop_event.is_set():
+                events = dict(poller.poll(self.heartbeat_interval * 1000))
+                if mailbox.receiver in events:
+                    for frames in mailbox.drain():
+                        socket.send_multipart(frames)
+                if socket in events:
+                    liveness = self.liveness
+                    reconnect_interval = self.heartbeat_interval
+                    # every message already queued is handled in this wakeup, like the broker does
+                    with suppress(zmq.Again):
+                        for _ in range(self.max_batch):
+                            command, *rest = socket.recv_multipart(flags=zmq.NOBLOCK)
+                            match command:
+                                case b'JOB':
+                                    job_id, payload = rest
+                                    executor.submit(copy_context().run, self.run_job, mailbox, job_id, payload)
+                                case b'HEARTBEAT':
+                                    pass
+                                case b'DISCONNECT':
+                                    liveness = 0
+                                    break
+                elif mailbox.receiver not in events:
+                    liveness -= 1
+                if liveness <= 0:
+                    # the broker is gone or forgot about us: reconnect with exponential backoff and jitter
+                    logger.warning(f'worker: lost the broker, reconnecting in {reconnect_interval:.1f}s')
+                    time.sleep(reconnect_interval * random.uniform(0.5, 1.0))
+                    reconnect_interval = min(reconnect_interval * 2, self.max_reconnect_interval)
+                    poller.unregister(socket)
+                    socket.close(linger=0)
+                    socket = self.connect(context)
+                    poller.register(socket, zmq.POLLIN)
+                    liveness = self.liveness
+                if time.monotonic() >= next_heartbeat:
+                    socket.send_multipart([HEARTBEAT])
+                    next_heartbeat = time.monotonic() + self.heartbeat_interval
+        except KeyboardInterrupt:
+            logger.info('worker is shutting down...')
+        finally:
+            with suppress(zmq.ZMQError):
+                socket.send_multipart([DISCONNECT])
+            executor.shutdown(wait=False, cancel_futures=True)
+            mailbox.close()
+            socket.close(linger=0)
+            context.destroy(linger=0)
+
+class RemoteSearchClient:
+    # job_timeout=None leaves searches to the broker --job-timeout, a deep research gets research_iteration_timeout
+    # per model turn so that a normal run is not requeued (and run again in parallel) halfway through
+    def __init__(self, broker_address:str, job_timeout:Optional[float]=None, research_iteration_timeout:float=300.0, request_timeout:float=600.0, max_batch:int=1024):
+        self.broker_address = broker_address
+        self.job_timeout = job_timeout
+        self.research_iteration_timeout = research_iteration_timeout
+        self.request_timeout = request_timeout
+        self.max_batch = max_batch
+        self.context = zmq.Context()
+        self.mailbox = _Mailbox(self.context, 'remote-search-client')
+        self.pending:Dict[bytes, Tuple[Future, float]] = {}
+        self.pending_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._io_loop, name='remote_search_client', daemon=True)
+        self.thread.start()
+
+    def timeout_for(self, kind:str, arguments:Dict) -> Optional[float]:
+        if kind == 'deep_iterative_web_search':
+            # the loop runs up to max_iterations + 1 turns, each one a thinking stream plus a search fan-out
+            return self.research_iteration_timeout * (int(arguments.get('max_iterations', 1)) + 1)
+        return self.job_timeout
+
+    def submit(self, kind:str, arguments:Dict, timeout:Optional[float]=None) -> Future:
+        job_id = uuid.uuid4().bytes
+        future = Future()
+        timeout = timeout or self.timeout_for(kind, arguments)
+        payload = encode({'kind': kind, 'arguments': arguments, 'timeout': timeout})
+        with self.pending_lock:
+            # the caller waits at least as long as one attempt of the job may take on the broker
+            self.pending[job_id] = (future, time.monotonic() + max(self.request_timeout, timeout or 0.0))
+        self.mailbox.post([JOB, job_id, payload])
+        return future
+
+    def search(self, query:str, search_context_size:str) -> str:
+        return self.submit('search', {'query': query, 'search_context_size': search_context_size}).result()
+
+    def _resolve(self, job_id:bytes, result:Any=None, error:Optional[Exception]=None) -> None:
+        with self.pending_lock:
+            entry = self.pending.pop(job_id, None)
+        if entry is None:
+            return
+        future, _ = entry
+        # asyncio.wrap_future cancels the future along with the task awaiting it, a late reply is then dropped
+        if not future.set_running_or_notify_cancel():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _handle_reply(self, frames:List[bytes]) -> None:
+        command, job_id, body = frames
+        if command == RESULT:
+            self._resolve(job_id, result=decode(body))
+        else:
+            self._resolve(job_id, error=RemoteJobError(body.decode('utf-8')))
+
+    def _io_loop(self) -> None:
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.broker_address)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.mailbox.receiver, zmq.POLLIN)
+        try:
+            while not self.stop_event.is_set():
+                events = dict(poller.poll(1000))
+                if self.mailbox.receiver in events:
+                    for frames in self.mailbox.drain():
+                        socket.send_multipart(frames)
+                if socket in events:
+                    with suppress(zmq.Again):
+                        for _ in range(self.max_batch):
+                            frames = socket.recv_multipart(flags=zmq.NOBLOCK)
+                            # one malformed reply must not stop the thread that resolves and expires every request
+                            try:
+                                self._handle_reply(frames)
+                            except Exception as e:
+                                logger.error(f'remote search client: dropped a reply of {len(frames)} frames: {e}')
+                now = time.monotonic()
+                with self.pending_lock:
+                    expired = [ job_id for job_id, (_, deadline) in self.pending.items() if deadline < now ]
+                for job_id in expired:
+                    self._resolve(job_id, error=TimeoutError('remote job did not complete in time'))
+        finally:
+            socket.close(linger=0)
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
+        with self.pending_lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future, _ in pending:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RemoteJobError('remote search client was closed'))
+        self.mailbox.close()
+        self.context.destroy(linger=0)
@@ -0,0 +1,40 @@
+import threading
+
+from contextvars import copy_context
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Callable, Any
+
+class LayeredExecutor:
+    # tools can dispatch tools (deep_iterative_web_search -> simple_web_search)
+    # every nesting level gets its own pool, a task only ever waits on tasks of the level below, so the pools cannot deadlock
+    def __init__(self, max_workers:int=8, thread_name_prefix:str='tool'):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.executors:Dict[int, ThreadPoolExecutor] = {}
+
+    def executor(self, level:int) -> ThreadPoolExecutor:
+        with self.lock:
+            executor = self.executors.get(level)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'{self.thread_name_prefix}_{level}')
+                self.executors[level] = executor
+            return executor
+
+    def _run(self, level:int, fn:Callable[..., Any], *args, **kwargs) -> Any:
+        self.local.level = level
+        return fn(*args, **kwargs)
+
+    def submit(self, fn:Callable[..., Any], *args, **kwargs) -> Future:
+        # the task runs in a copy of the caller's context so that context variables such as the event sink follow it
+        level = getattr(self.local, 'level', 0)
+        return self.executor(level).submit(copy_context().run, self._run, level + 1, fn, *args, **kwargs)
+
+    def shutdown(self, wait:bool=True, cancel_futures:bool=False) -> None:
+        with self.lock:
+            executors = list(self.executors.values())
+            self.executors.clear()
+        for executor in executors:
+            executor.shutdown(wait=wait, cancel_futures=cancel_futures)
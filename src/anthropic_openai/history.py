@@ -0,0 +1,139 @@
+import re
+
+from .types import Role, ChatMessage, Usage
+from typing import List, Dict, Tuple, Optional, Any
+
+from .log import logger
+
+EPHEMERAL = {'type': 'ephemeral'}
+UNCACHEABLE_BLOCK_TYPES = ('thinking', 'redacted_thinking')
+SEARCH_RESULT_SEPARATOR = '\n\n---$$$---\n\n'
+COMPACTED_MARKER = '[compacted]\n'
+
+def estimate_history_tokens(conversation_history:List[ChatMessage]) -> int:
+    return sum([ len(chat_message.model_dump_json()) for chat_message in conversation_history ]) // 4
+
+def with_cache_control(system:str, tools:List[Dict], conversation_history:List[ChatMessage]) -> Tuple[List[Dict], List[Dict], List[ChatMessage]]:
+    # the api caches the prefix tools -> system -> messages, one breakpoint is placed at the end of each section
+    # blocks are copied so that breakpoints never accumulate in the stored history (the api accepts at most 4)
+    system_blocks = [{'type': 'text', 'text': system, 'cache_control': EPHEMERAL}]
+    cached_tools = list(tools)
+    if len(cached_tools) > 0:
+        cached_tools[-1] = {**cached_tools[-1], 'cache_control': EPHEMERAL}
+
+    cached_history = list(conversation_history)
+    for index in range(len(cached_history) - 1, -1, -1):
+        chat_message = cached_history[index]
+        content = chat_message.content
+        if isinstance(content, str):
+            content = [{'type': 'text', 'text': content}]
+        for block_index in range(len(content) - 1, -1, -1):
+            if content[block_index].get('type') in UNCACHEABLE_BLOCK_TYPES:
+                continue
+            content = list(content)
+            content[block_index] = {**content[block_index], 'cache_control': EPHEMERAL}
+            cached_history[index] = ChatMessage(role=chat_message.role, content=content)
+            return system_blocks, cached_tools, cached_history
+    return system_blocks, cached_tools, cached_history
+
+def annotate_iteration(conversation_history:List[ChatMessage], current_iteration:int, max_iterations:int) -> List[ChatMessage]:
+    # the iteration counter lives in the newest user turn instead of the system prompt to keep the cached prefix stable
+    last_message = conversation_history[-1]
+    content = last_message.content
+    if isinstance(content, str):
+        content = [{'type': 'text', 'text': content}]
+    content = content + [{'type': 'text', 'text': f'current iteration: {current_iteration}/{max_iterations}'}]
+    return conversation_history[:-1] + [ChatMessage(role=last_message.role, content=content)]
+
+def usage_from_event(event:Any, usage:Usage) -> None:
+    match event.type:
+        case 'message_start':
+            message_usage = event.message.usage
+            usage.input_tokens += message_usage.input_tokens or 0
+            usage.cache_creation_input_tokens += getattr(message_usage, 'cache_creation_input_tokens', None) or 0
+            usage.cache_read_input_tokens += getattr(message_usage, 'cache_read_input_tokens', None) or 0
+        case 'message_delta':
+            usage.output_tokens += event.usage.output_tokens or 0
+
+class HistoryCompactor:
+    def __init__(self, threshold_tokens:int=32_000, keep_recent:int=4, digest_chars:int=480, max_urls:int=8):
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent = keep_recent
+        self.digest_chars = digest_chars
+        self.max_urls = max_urls
+
+    def digest(self, text:str) -> str:
+        digests:List[str] = []
+        for section in text.split(SEARCH_RESULT_SEPARATOR):
+            urls = list(dict.fromkeys(re.findall(r'https?://[^\s)\]>"\']+', section)))[:self.max_urls]
+            summary = ' '.join(section.split())[:self.digest_chars]
+            digest = f'{summary}...' if len(section) > self.digest_chars else summary
+            if len(urls) > 0:
+                digest = digest + '\nsources: ' + ' '.join(urls)
+            digests.append(digest)
+        return COMPACTED_MARKER + '\n---\n'.join(digests)
+
+    def compact_block(self, block:Dict) -> Tuple[Dict, bool]:
+        if block.get('type') != 'tool_result' or block.get('is_error'):
+            return block, False
+        content = block.get('content')
+        if isinstance(content, str):
+            text = content
+        else:
+            text = '\n'.join([ item.get('text', '') for item in content or [] if item.get('type') == 'text' ])
+        if text.startswith(COMPACTED_MARKER):
+            return block, False
+        compacted = {key: value for key, value in block.items() if key != 'content'}
+        compacted['content'] = [{'type': 'text', 'text': self.digest(text)}]
+        return compacted, True
+
+    def compact(self, conversation_history:List[ChatMessage], prompt_tokens:Optional[int]=None) -> List[ChatMessage]:
+        # prompt_tokens is the size the api reported for the previous request; the estimate is only a fallback
+        if prompt_tokens is None:
+            prompt_tokens = estimate_history_tokens(conversation_history)
+        if prompt_tokens < self.threshold_tokens:
+            return conversation_history
+
+        nb_compacted = 0
+        compacted_history:List[ChatMessage] = []
+        boundary = len(conversation_history) - self.keep_recent
+        for index, chat_message in enumerate(conversation_history):
+            if index >= boundary or isinstance(chat_message.content, str):
+                compacted_history.append(chat_message)
+                continue
+            content:List[Dict] = []
+            changed = False
+            for block in chat_message.content:
+                block, was_compacted = self.compact_block(block)
+                changed = changed or was_compacted
+                content.append(block)
+            if changed:
+                nb_compacted += 1
+                chat_message = ChatMessage(role=chat_message.role, content=content)
+            compacted_history.append(chat_message)
+        if nb_compacted > 0:
+            logger.info(f'history compaction: {nb_compacted} messages were compacted ({prompt_tokens} -> ~{estimate_history_tokens(compacted_history)} tokens)')
+        return compacted_history
+
+def synthesize_research(conversation_history:List[ChatMessage], reason:str, compactor:Optional[HistoryCompactor]=None) -> str:
+    # a research stopped by its budget has no final answer, what the model wrote and digests of what it searched stand in for it
+    compactor = compactor if compactor is not None else HistoryCompactor()
+    findings:List[str] = []
+    searches:List[str] = []
+    for chat_message in conversation_history:
+        if isinstance(chat_message.content, str):
+            continue
+        for block in chat_message.content:
+            match block.get('type'):
+                case 'text' if chat_message.role == Role.ASSISTANT and block.get('text', '').strip() != '':
+                    findings.append(block['text'].strip())
+                case 'tool_result' if not block.get('is_error'):
+                    content = compactor.compact_block(block)[0]['content']
+                    text = content if isinstance(content, str) else '\n'.join([ item.get('text', '') for item in content if item.get('type') == 'text' ])
+                    searches.append(text.removeprefix(COMPACTED_MARKER))
+    sections = [f'research stopped before its final answer ({reason})']
+    if len(findings) > 0:
+        sections.append('findings so far:\n' + '\n\n'.join(findings))
+    if len(searches) > 0:
+        sections.append('searched material:\n' + '\n---\n'.join(searches))
+    return '\n###\n'.join(sections)
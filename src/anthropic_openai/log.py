@@ -1,23 +1,33 @@
+import atexit
 import logging 
 from os import getenv 
 from sys import stdout, stderr 
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
 
 log_level = getenv('LOG_LEVEL', 'INFO')
 log_format = '%(asctime)s - %(name)s - %(levelname)s - %(lineno)03d - %(message)s'
+
+# records are handed to a background listener thread, console and disk writes never run on the caller's thread
+log_queue = SimpleQueue()
+formatter = logging.Formatter(log_format)
+stream_handler = logging.StreamHandler(stdout)
+file_handler = logging.FileHandler('anthropic_openai.log', delay=True)
+for handler in (stream_handler, file_handler):
+    handler.setFormatter(formatter)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+
 logging.basicConfig(
     level=log_level,
-    format=log_format,
-    handlers=[
-        logging.StreamHandler(stdout),
-        logging.FileHandler('anthropic_openai.log')
-    ]
+    handlers=[queue_handler]
 )
+log_listener = QueueListener(log_queue, stream_handler, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logger = logging.getLogger('anthropic_openai')
-for handler in logger.handlers:
-    if isinstance(handler, logging.StreamHandler):
-        handler.flush = True 
 
 
 if __name__ == '__main__':
-    logger.info('log was initialized')
\ No newline at end of file
+    logger.info('log was initialized')
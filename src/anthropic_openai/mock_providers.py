@@ -0,0 +1,302 @@
+import json
+import time
+import random
+import asyncio
+import threading
+
+from itertools import count
+from types import SimpleNamespace
+from pydantic import BaseModel
+
+from typing import List, Dict, Any, Optional, Tuple, Iterator, AsyncIterator, Iterable, Callable
+
+class MockProviderError(Exception):
+    # injected failures behave like an overloaded provider and are retried
+    status_code = 503
+
+class ProviderProfile(BaseModel):
+    time_to_first_byte:float = 0.2
+    per_token_delay:float = 0.002
+    tokens_per_delta:int = 4
+    error_rate:float = 0.0
+    seed:Optional[int] = None
+
+def to_namespace(value:Any) -> Any:
+    match value:
+        case dict():
+            return SimpleNamespace(**{ key: to_namespace(item) for key, item in value.items() })
+        case list():
+            return [ to_namespace(item) for item in value ]
+    return value
+
+def synthetic_words(nb_tokens:int, rng:random.Random) -> List[str]:
+    vocabulary = ['the', 'search', 'result', 'shows', 'that', 'recent', 'research', 'on', 'this', 'topic', 'has', 'found', 'several', 'new', 'sources', 'and', 'evidence']
+    return [ rng.choice(vocabulary) + ' ' for _ in range(nb_tokens) ]
+
+def synthetic_message_events(rng:random.Random, thinking_tokens:int=0, text_tokens:int=0, tool_calls:Optional[List[Dict]]=None, tokens_per_delta:int=4, input_tokens:int=0, text_suffix:str='') -> List[Dict]:
+    tool_calls = tool_calls or []
+    events:List[Dict] = [
+        {'type': 'message_start', 'message': {'id': f'msg_{rng.getrandbits(32):08x}', 'usage': {'input_tokens': input_tokens, 'output_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}}}
+    ]
+    index = 0
+    if thinking_tokens > 0:
+        words = synthetic_words(thinking_tokens, rng)
+        events.append({'type': 'content_block_start', 'index': index, 'content_block': {'type': 'thinking', 'thinking': '', 'signature': ''}})
+        for start in range(0, len(words), tokens_per_delta):
+            events.append({'type': 'content_block_delta', 'index': index, 'delta': {'type': 'thinking_delta', 'thinking': ''.join(words[start:start + tokens_per_delta])}})
+        events.append({'type': 'content_block_delta', 'index': index, 'delta': {'type': 'signature_delta', 'signature': f'sig_{rng.getrandbits(64):016x}'}})
+        events.append({'type': 'content_block_stop', 'index': index})
+        index += 1
+    if text_tokens > 0:
+        words = synthetic_words(text_tokens, rng) + [ text_suffix[start:start + 16] for start in range(0, len(text_suffix), 16) ]
+        events.append({'type': 'content_block_start', 'index': index, 'content_block': {'type': 'text', 'text': ''}})
+        for start in range(0, len(words), tokens_per_delta):
+            events.append({'type': 'content_block_delta', 'index': index, 'delta': {'type': 'text_delta', 'text': ''.join(words[start:start + tokens_per_delta])}})
+        events.append({'type': 'content_block_stop', 'index': index})
+        index += 1
+    for tool_call in tool_calls:
+        events.append({'type': 'content_block_start', 'index': index, 'content_block': {'type': 'tool_use', 'id': tool_call.get('id') or f'toolu_{rng.getrandbits(64):016x}', 'name': tool_call['name'], 'input': {}}})
+        arguments = json.dumps(tool_call['input'])
+        for start in range(0, len(arguments), 16):
+            events.append({'type': 'content_block_delta', 'index': index, 'delta': {'type': 'input_json_delta', 'partial_json': arguments[start:start + 16]}})
+        events.append({'type': 'content_block_stop', 'index': index})
+        index += 1
+    stop_reason = 'tool_use' if len(tool_calls) > 0 else 'end_turn'
+    events.append({'type': 'message_delta', 'delta': {'type': 'message_delta', 'stop_reason': stop_reason, 'stop_sequence': None}, 'usage': {'output_tokens': thinking_tokens + text_tokens + 16 * len(tool_calls)}})
+    events.append({'type': 'message_stop'})
+    return events
+
+def load_recorded_streams(path:str) -> List[List[Dict]]:
+    # one recorded response per line: {"events": [<event.model_dump()>, ...]}
+    with open(path, mode='r', encoding='utf-8') as file_pointer:
+        return [ json.loads(line)['events'] for line in file_pointer if line.strip() ]
+
+def record_stream(stream:Iterable[Any], path:str) -> Iterator[Any]:
+    recorded_events:List[Dict] = []
+    for event in stream:
+        recorded_events.append(event.model_dump(mode='json'))
+        yield event
+    with open(path, mode='a', encoding='utf-8') as file_pointer:
+        file_pointer.write(json.dumps({'events': recorded_events}) + '\n')
+
+def load_recorded_completions(path:str) -> List[Dict]:
+    # one recorded search response per line: {"completion": <completion.model_dump()>}
+    with open(path, mode='r', encoding='utf-8') as file_pointer:
+        return [ json.loads(line)['completion'] for line in file_pointer if line.strip() ]
+
+def record_completion(completion:Any, path:str) -> Any:
+    with open(path, mode='a', encoding='utf-8') as file_pointer:
+        file_pointer.write(json.dumps({'completion': completion.model_dump(mode='json')}) + '\n')
+    return completion
+
+def _completion_tokens(completion:Dict) -> int:
+    usage = completion.get('usage') or {}
+    if usage.get('completion_tokens'):
+        return usage['completion_tokens']
+    return sum([ len(choice['message'].get('content') or '') // 4 for choice in completion.get('choices', []) ])
+
+class AgentScript:
+    # synthetic policy: the main loop delegates to deep_iterative_web_search once, the research loop
+    # calls simple_web_search for research_iterations turns, every turn answers once the tools are done ;
+    # with proposal_accuracy every research turn lists the queries of the next one in its text, and that share
+    # of them is actually searched by the next turn (the rest is replaced)
+    def __init__(self, research_iterations:int=3, queries_per_search:int=4, thinking_tokens:int=256, text_tokens:int=512, seed:Optional[int]=None, proposal_accuracy:Optional[float]=None):
+        self.research_iterations = research_iterations
+        self.queries_per_search = queries_per_search
+        self.thinking_tokens = thinking_tokens
+        self.text_tokens = text_tokens
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.query_counter = count()
+        self.proposal_accuracy = proposal_accuracy
+        self.proposals:Dict[str, List[str]] = {}
+
+    def __call__(self, request:Dict, tokens_per_delta:int) -> List[Dict]:
+        messages = request.get('messages', [])
+        tool_names = [ tool['name'] for tool in request.get('tools', []) ]
+        nb_tool_results = sum([ 1 for message in messages if _has_tool_result(message) ])
+        with self.lock:
+            seed = self.rng.getrandbits(64)
+            query_ids = [ next(self.query_counter) for _ in range(self.queries_per_search) ]
+        rng = random.Random(seed)
+        input_tokens = 256 * len(messages)
+        if 'simple_web_search' in tool_names and nb_tool_results < self.research_iterations:
+            expanded_queries = [ f'synthetic query {query_id}?' for query_id in query_ids ]
+            tool_calls = [{'name': 'simple_web_search', 'input': {'expanded_queries': expanded_queries, 'search_context_size': 'medium'}}]
+            if self.proposal_accuracy is None:
+                return synthetic_message_events(rng, self.thinking_tokens, self.text_tokens // 4, tool_calls, tokens_per_delta, input_tokens)
+            tool_calls[0]['id'] = f'toolu_{rng.getrandbits(64):016x}'
+            with self.lock:
+                proposed = self.proposals.pop(_last_tool_use_id(messages), None)
+                proposals = [ f'synthetic query {next(self.query_counter)}?' for _ in range(self.queries_per_search) ]
+                self.proposals[tool_calls[0]['id']] = proposals
+            if proposed is not None:
+                tool_calls[0]['input']['expanded_queries'] = [ query if rng.random() < self.proposal_accuracy else fresh_query for query, fresh_query in zip(proposed, expanded_queries) ]
+            text_suffix = '\n\nNew search queries to explore next:\n' + ''.join([ f'{index}. {query}\n' for index, query in enumerate(proposals, start=1) ])
+            return synthetic_message_events(rng, self.thinking_tokens, self.text_tokens // 4, tool_calls, tokens_per_delta, input_tokens, text_suffix)
+        if 'deep_iterative_web_search' in tool_names and nb_tool_results == 0:
+            tool_calls = [{'name': 'deep_iterative_web_search', 'input': {'query': 'synthetic research question', 'user_contraints': 'none', 'task_complexity': 'low', 'max_iterations': self.research_iterations}}]
+            return synthetic_message_events(rng, 0, self.text_tokens // 8, tool_calls, tokens_per_delta, input_tokens)
+        return synthetic_message_events(rng, self.thinking_tokens if 'simple_web_search' in tool_names else 0, self.text_tokens, None, tokens_per_delta, input_tokens)
+
+class ReplayScript:
+    def __init__(self, streams:List[List[Dict]]):
+        self.streams = streams
+        self.lock = threading.Lock()
+        self.counter = count()
+
+    def __call__(self, request:Dict, tokens_per_delta:int) -> List[Dict]:
+        with self.lock:
+            index = next(self.counter)
+        return self.streams[index % len(self.streams)]
+
+def _has_tool_result(message:Any) -> bool:
+    content = message.content if isinstance(message, BaseModel) else message.get('content')
+    return isinstance(content, list) and any([ block.get('type') == 'tool_result' for block in content ])
+
+def _last_tool_use_id(messages:List[Any]) -> Optional[str]:
+    for message in reversed(messages):
+        content = message.content if isinstance(message, BaseModel) else message.get('content')
+        if not isinstance(content, list):
+            continue
+        for block in reversed(content):
+            if block.get('type') == 'tool_use':
+                return block['id']
+    return None
+
+def _delta_tokens(event:Dict) -> int:
+    if event['type'] != 'content_block_delta':
+        return 0
+    delta = event['delta']
+    text = delta.get('text') or delta.get('thinking') or delta.get('partial_json') or ''
+    return max(1, len(text) // 4)
+
+class _MockBase:
+    def __init__(self, profile:Optional[ProviderProfile]=None):
+        self.profile = profile or ProviderProfile()
+        self.rng = random.Random(self.profile.seed)
+        self.lock = threading.Lock()
+        self.nb_requests = 0
+        self.nb_failures = 0
+
+    def maybe_fail(self, provider:str) -> None:
+        with self.lock:
+            self.nb_requests += 1
+            failed = self.rng.random() < self.profile.error_rate
+            self.nb_failures += int(failed)
+        if failed:
+            raise MockProviderError(f'{provider} mock: injected failure')
+
+    def close(self) -> None:
+        pass
+
+class _MockMessages:
+    def __init__(self, owner:'MockAnthropic'):
+        self.owner = owner
+
+    def create(self, stream:bool=True, **request) -> Iterator[Any]:
+        self.owner.maybe_fail('anthropic')
+        events = self.owner.script(request, self.owner.profile.tokens_per_delta)
+        return self.owner.play(events)
+
+class MockAnthropic(_MockBase):
+    def __init__(self, script:Optional[Callable[[Dict, int], List[Dict]]]=None, profile:Optional[ProviderProfile]=None):
+        super(MockAnthropic, self).__init__(profile)
+        self.script = script or AgentScript(seed=self.profile.seed)
+        self.messages = _MockMessages(self)
+
+    def play(self, events:List[Dict]) -> Iterator[Any]:
+        time.sleep(self.profile.time_to_first_byte)
+        for event in events:
+            delay = _delta_tokens(event) * self.profile.per_token_delay
+            if delay > 0:
+                time.sleep(delay)
+            yield to_namespace(event)
+
+class _AsyncMockMessages:
+    def __init__(self, owner:'AsyncMockAnthropic'):
+        self.owner = owner
+
+    async def create(self, stream:bool=True, **request) -> AsyncIterator[Any]:
+        self.owner.maybe_fail('anthropic')
+        events = self.owner.script(request, self.owner.profile.tokens_per_delta)
+        return self.owner.play(events)
+
+class AsyncMockAnthropic(_MockBase):
+    def __init__(self, script:Optional[Callable[[Dict, int], List[Dict]]]=None, profile:Optional[ProviderProfile]=None):
+        super(AsyncMockAnthropic, self).__init__(profile)
+        self.script = script or AgentScript(seed=self.profile.seed)
+        self.messages = _AsyncMockMessages(self)
+
+    async def play(self, events:List[Dict]) -> AsyncIterator[Any]:
+        await asyncio.sleep(self.profile.time_to_first_byte)
+        for event in events:
+            delay = _delta_tokens(event) * self.profile.per_token_delay
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield to_namespace(event)
+
+    async def close(self) -> None:
+        pass
+
+def synthetic_completion(query:str, nb_tokens:int, rng:random.Random) -> Any:
+    sources = [ f'[source {index}](https://example.org/{rng.getrandbits(24):06x}/{index})' for index in range(3) ]
+    content = ''.join(synthetic_words(nb_tokens, rng)) + '\n' + '\n'.join(sources)
+    return to_namespace({
+        'id': f'chatcmpl_{rng.getrandbits(32):08x}',
+        'model': 'gpt-4o-mini-search-preview',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': len(query) // 4 + 1, 'completion_tokens': nb_tokens, 'total_tokens': len(query) // 4 + 1 + nb_tokens}
+    })
+
+class _MockOpenAIBase(_MockBase):
+    # search completions are synthetic, or replayed in turn from recorded ones (record_completion / load_recorded_completions)
+    # with the latency of their recorded completion_tokens
+    def __init__(self, profile:Optional[ProviderProfile]=None, result_tokens:int=400, completions:Optional[List[Dict]]=None):
+        super(_MockOpenAIBase, self).__init__(profile)
+        self.result_tokens = result_tokens
+        self.completions = completions
+        self.counter = count()
+
+    def next_completion(self, messages:List[Any]) -> Tuple[Any, float]:
+        with self.lock:
+            seed = self.rng.getrandbits(64)
+            index = next(self.counter)
+        if self.completions:
+            completion = self.completions[index % len(self.completions)]
+            return to_namespace(completion), self.profile.time_to_first_byte + _completion_tokens(completion) * self.profile.per_token_delay
+        delay = self.profile.time_to_first_byte + self.result_tokens * self.profile.per_token_delay
+        return synthetic_completion(str(messages[-1]), self.result_tokens, random.Random(seed)), delay
+
+class _MockCompletions:
+    def __init__(self, owner:'MockOpenAI'):
+        self.owner = owner
+
+    def create(self, messages:List[Any], **request) -> Any:
+        self.owner.maybe_fail('openai')
+        completion, delay = self.owner.next_completion(messages)
+        time.sleep(delay)
+        return completion
+
+class _AsyncMockCompletions:
+    def __init__(self, owner:'AsyncMockOpenAI'):
+        self.owner = owner
+
+    async def create(self, messages:List[Any], **request) -> Any:
+        self.owner.maybe_fail('openai')
+        completion, delay = self.owner.next_completion(messages)
+        await asyncio.sleep(delay)
+        return completion
+
+class MockOpenAI(_MockOpenAIBase):
+    def __init__(self, profile:Optional[ProviderProfile]=None, result_tokens:int=400, completions:Optional[List[Dict]]=None):
+        super(MockOpenAI, self).__init__(profile, result_tokens, completions)
+        self.chat = SimpleNamespace(completions=_MockCompletions(self))
+
+class AsyncMockOpenAI(_MockOpenAIBase):
+    def __init__(self, profile:Optional[ProviderProfile]=None, result_tokens:int=400, completions:Optional[List[Dict]]=None):
+        super(AsyncMockOpenAI, self).__init__(profile, result_tokens, completions)
+        self.chat = SimpleNamespace(completions=_AsyncMockCompletions(self))
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,243 @@
+import re
+import time
+import asyncio
+import threading
+
+from contextvars import ContextVar
+from pydantic import BaseModel
+
+from .types import Usage
+from typing import List, Set, Optional, Any, Iterable, Iterator, AsyncIterable, AsyncIterator
+
+from .log import logger
+from .telemetry import telemetry
+from .aggregation import PassageIndex
+from .prefetch import PrefetchIndex
+from .cache import SEARCH_CONTEXT_SIZES
+
+URL_PATTERN = re.compile(r'https?://[^\s)\]>"\']+')
+ENTITY_PATTERN = re.compile(r'\b[A-Z][\w\-]+(?:\s+[A-Z][\w\-]+)*')
+WORD_PATTERN = re.compile(r'\w+')
+MIN_THINKING_BUDGET = 1024
+
+class IterationNovelty(BaseModel):
+    urls:int = 0
+    new_urls:int = 0
+    entities:int = 0
+    new_entities:int = 0
+    shingles:int = 0
+    overlapping_shingles:int = 0
+
+    @property
+    def overlap(self) -> float:
+        return self.overlapping_shingles / self.shingles if self.shingles > 0 else 0.0
+
+    @property
+    def score(self) -> float:
+        # mean share of what this iteration brought that had not been seen before
+        ratios:List[float] = []
+        if self.urls > 0:
+            ratios.append(self.new_urls / self.urls)
+        if self.entities > 0:
+            ratios.append(self.new_entities / self.entities)
+        if self.shingles > 0:
+            ratios.append(1.0 - self.overlap)
+        return sum(ratios) / len(ratios) if len(ratios) > 0 else 0.0
+
+class ResearchDecision(BaseModel):
+    action:str
+    reason:str
+    budget_tokens:int
+    search_context_size:Optional[str] = None
+
+class ResearchJob:
+    # state of one deep_iterative_web_search call, reachable from the tools it dispatches through current_research_job
+    def __init__(self, query:str, budget_tokens:int, max_iterations:int, max_seconds:Optional[float]=None, max_tokens:Optional[int]=None, shingle_size:int=5):
+        self.query = query
+        self.budget_tokens = budget_tokens
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.shingle_size = shingle_size
+        self.started_at = time.monotonic()
+        self.search_context_size:Optional[str] = None
+        self.seen_urls:Set[str] = set()
+        self.seen_entities:Set[str] = set()
+        self.seen_shingles:Set[int] = set()
+        self.current = IterationNovelty()
+        self.history:List[IterationNovelty] = []
+        self.decisions:List[ResearchDecision] = []
+        self.passages = PassageIndex()
+        self.prefetched = PrefetchIndex()
+        self.tokens_used = 0
+        self.low_novelty_streak = 0
+        # set once a hard budget stopped the job, its result is then a synthesis of the iterations so far
+        self.budget_stop:Optional[str] = None
+        self.lock = threading.Lock()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> Optional[float]:
+        return max(0.0, self.max_seconds - self.elapsed) if self.max_seconds is not None else None
+
+    def bound(self, timeout:Optional[float]) -> Optional[float]:
+        # a timeout of a call made by the job never reaches past its wall clock budget
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def overrun(self, usage:Optional[Usage]=None) -> Optional[str]:
+        # unlike NoveltyScheduler.budget_exhausted this is no prediction, it is checked while an iteration runs
+        if self.max_seconds is not None and self.elapsed >= self.max_seconds:
+            return f'wall clock budget: {self.elapsed:.1f}s spent of {self.max_seconds:.1f}s'
+        tokens_used = self.tokens_used + (usage_tokens(usage) if usage is not None else 0)
+        if self.max_tokens is not None and tokens_used >= self.max_tokens:
+            return f'token budget: {tokens_used} spent of {self.max_tokens}'
+        return None
+
+    def cut_off(self, reason:str) -> None:
+        if self.budget_stop is None:
+            self.budget_stop = reason
+            logger.warning(f'research {self.query!r} cut off during iteration {len(self.history) + 1}: {reason}')
+
+    def narrow(self, search_context_size:str) -> str:
+        # the model picks a size per call, the scheduler may cap it once searches stop adding anything
+        if self.search_context_size is None or search_context_size not in SEARCH_CONTEXT_SIZES:
+            return search_context_size
+        return min(search_context_size, self.search_context_size, key=SEARCH_CONTEXT_SIZES.index)
+
+    def observe(self, text:str) -> None:
+        urls = set(URL_PATTERN.findall(text))
+        entities = set([ entity.casefold() for entity in ENTITY_PATTERN.findall(text) ])
+        words = WORD_PATTERN.findall(text.casefold())
+        shingles = set([ hash(tuple(words[index:index + self.shingle_size])) for index in range(max(0, len(words) - self.shingle_size + 1)) ])
+        # parallel simple_web_search calls of one iteration report concurrently
+        with self.lock:
+            current = self.current
+            current.urls += len(urls)
+            current.new_urls += len(urls - self.seen_urls)
+            current.entities += len(entities)
+            current.new_entities += len(entities - self.seen_entities)
+            current.shingles += len(shingles)
+            current.overlapping_shingles += len(shingles & self.seen_shingles)
+            self.seen_urls |= urls
+            self.seen_entities |= entities
+            self.seen_shingles |= shingles
+
+    def end_iteration(self, usage:Usage) -> IterationNovelty:
+        self.tokens_used += usage_tokens(usage)
+        with self.lock:
+            novelty = self.current
+            self.history.append(novelty)
+            self.current = IterationNovelty()
+        return novelty
+
+def usage_tokens(usage:Usage) -> int:
+    return usage.input_tokens + usage.output_tokens + usage.cache_creation_input_tokens + usage.cache_read_input_tokens
+
+def budgeted_stream(stream:Iterable[Any], job:ResearchJob, usage:Usage) -> Iterator[Any]:
+    # ends the stream of an iteration once a hard budget is spent ; without a stop_reason consume_stream drops the
+    # partial message and cancels the tools it dispatched. A stalled stream is bounded by the request timeout, see ResearchJob.bound
+    try:
+        for event in stream:
+            yield event
+            reason = job.overrun(usage)
+            if reason is not None:
+                job.cut_off(reason)
+                close = getattr(stream, 'close', None)
+                if close is not None:
+                    close()
+                return
+    except Exception:
+        reason = job.overrun(usage)
+        if reason is None:
+            raise
+        job.cut_off(reason)
+
+async def abudgeted_stream(stream:AsyncIterable[Any], job:ResearchJob, usage:Usage) -> AsyncIterator[Any]:
+    # a coroutine can be cancelled, a stalled stream is cut off at the deadline instead of at the request timeout
+    iterator = aiter(stream)
+    while True:
+        try:
+            async with asyncio.timeout(job.remaining()):
+                event = await anext(iterator)
+        except StopAsyncIteration:
+            return
+        except Exception:
+            reason = job.overrun(usage)
+            if reason is None:
+                raise
+            job.cut_off(reason)
+            return
+        yield event
+        reason = job.overrun(usage)
+        if reason is not None:
+            job.cut_off(reason)
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+            return
+
+current_research_job:ContextVar[Optional[ResearchJob]] = ContextVar('current_research_job', default=None)
+
+class NoveltyScheduler:
+    # decides after every deep research iteration whether the next one is worth its latency and cost
+    #   stop   : a hard budget would be exceeded, or novelty stayed below min_novelty for `patience` iterations
+    #   shrink : novelty is below shrink_novelty, the thinking budget is scaled down and search_context_size narrowed
+    def __init__(self, min_novelty:float=0.15, shrink_novelty:float=0.4, patience:int=2, shrink_factor:float=0.5, max_seconds:Optional[float]=None, max_tokens:Optional[int]=None):
+        self.min_novelty = min_novelty
+        self.shrink_novelty = shrink_novelty
+        self.patience = patience
+        self.shrink_factor = shrink_factor
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+
+    def start(self, query:str, budget_tokens:int, max_iterations:int) -> ResearchJob:
+        return ResearchJob(query, budget_tokens, max_iterations, max_seconds=self.max_seconds, max_tokens=self.max_tokens)
+
+    def budget_exhausted(self, job:ResearchJob) -> Optional[str]:
+        # the next iteration is assumed to cost as much as the average of the previous ones
+        nb_iterations = max(1, len(job.history))
+        if job.max_seconds is not None and job.elapsed + job.elapsed / nb_iterations > job.max_seconds:
+            return f'wall clock budget: {job.elapsed:.1f}s spent of {job.max_seconds:.1f}s'
+        if job.max_tokens is not None and job.tokens_used + job.tokens_used / nb_iterations > job.max_tokens:
+            return f'token budget: {job.tokens_used} spent of {job.max_tokens}'
+        return None
+
+    def decide(self, job:ResearchJob, usage:Usage) -> ResearchDecision:
+        novelty = job.end_iteration(usage)
+        iteration = len(job.history)
+        reason = job.budget_stop or self.budget_exhausted(job)
+        if reason is not None:
+            action = 'stop'
+            job.budget_stop = reason
+        elif iteration == 1 or novelty.shingles == 0:
+            action, reason = 'continue', 'first iteration' if iteration == 1 else 'no search results in this iteration'
+        elif novelty.score < self.min_novelty:
+            job.low_novelty_streak += 1
+            if job.low_novelty_streak >= self.patience:
+                action, reason = 'stop', f'novelty below {self.min_novelty} for {job.low_novelty_streak} iterations'
+            else:
+                action, reason = 'shrink', f'novelty below {self.min_novelty}'
+        elif novelty.score < self.shrink_novelty:
+            job.low_novelty_streak = 0
+            action, reason = 'shrink', f'novelty below {self.shrink_novelty}'
+        else:
+            job.low_novelty_streak = 0
+            action, reason = 'continue', 'searches are still adding new material'
+
+        if action == 'shrink':
+            job.budget_tokens = max(MIN_THINKING_BUDGET, int(job.budget_tokens * self.shrink_factor))
+            index = SEARCH_CONTEXT_SIZES.index(job.search_context_size) if job.search_context_size is not None else len(SEARCH_CONTEXT_SIZES) - 1
+            job.search_context_size = SEARCH_CONTEXT_SIZES[max(0, index - 1)]
+
+        decision = ResearchDecision(action=action, reason=reason, budget_tokens=job.budget_tokens, search_context_size=job.search_context_size)
+        job.decisions.append(decision)
+        logger.info(f'research scheduler: iteration {iteration}/{job.max_iterations} novelty={novelty.score:.2f} new_urls={novelty.new_urls}/{novelty.urls} new_entities={novelty.new_entities}/{novelty.entities} overlap={novelty.overlap:.2f} elapsed={job.elapsed:.1f}s tokens={job.tokens_used} -> {action} ({reason}) budget_tokens={job.budget_tokens} search_context_size={job.search_context_size}')
+        if telemetry.enabled:
+            telemetry.inc('research_decisions_total', action=action)
+            telemetry.trace('research_decision', iteration=iteration, novelty=novelty.score, overlap=novelty.overlap, elapsed=job.elapsed, tokens=job.tokens_used, **novelty.model_dump(), **decision.model_dump())
+        return decision
@@ -0,0 +1,196 @@
+import re
+import time
+import threading
+
+from typing import List, Dict, Optional, Any
+
+from .log import logger
+from .telemetry import telemetry
+from .throttling import estimate_tokens
+from .cache import normalize_query, SEARCH_CONTEXT_SIZES
+
+# "New search queries to explore next:", "### Follow-up searches", "Next queries:" ...
+PROPOSAL_HEADER_PATTERN = re.compile(r'\b(?:next|new|follow[\s\-]?up|further|additional)\b.*\b(?:quer(?:y|ies)|searches)\b|\b(?:quer(?:y|ies)|searches)\b.*\bnext\b', re.IGNORECASE)
+LIST_ITEM_PATTERN = re.compile(r'\s*(?:[-*+•]|\d+[.)])\s+(?P<item>.+?)\s*')
+MARKUP_PATTERN = re.compile(r'\*\*|__|`')
+QUOTES = '"\'“”‘’'
+
+class QueryProposalParser:
+    # fed with the text deltas of a research turn, returns every list item of a "next search queries" section
+    # as soon as its line is complete ; any other non empty line closes the section
+    def __init__(self, min_chars:int=8, max_chars:int=300):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.pending = ''
+        self.in_section = False
+
+    def feed(self, text:str) -> List[str]:
+        if '\n' not in text:
+            self.pending += text
+            return []
+        lines = (self.pending + text).split('\n')
+        self.pending = lines.pop()
+        return [ query for query in map(self.parse_line, lines) if query is not None ]
+
+    def close(self) -> List[str]:
+        line, self.pending = self.pending, ''
+        query = self.parse_line(line)
+        self.in_section = False
+        return [query] if query is not None else []
+
+    def parse_line(self, line:str) -> Optional[str]:
+        if line.strip() == '':
+            return None
+        match = LIST_ITEM_PATTERN.fullmatch(line)
+        if match is None or not self.in_section:
+            self.in_section = PROPOSAL_HEADER_PATTERN.search(line) is not None and len(line) < 200
+            return None
+        query = MARKUP_PATTERN.sub('', match.group('item')).strip().strip(QUOTES).strip()
+        if not self.min_chars <= len(query) <= self.max_chars:
+            return None
+        return query
+
+class PrefetchEntry:
+    __slots__ = ('query', 'search_context_size', 'future', 'started_at', 'finished_at', 'tokens', 'taken', 'wasted')
+    def __init__(self, query:str, search_context_size:str):
+        self.query = query
+        self.search_context_size = search_context_size
+        self.future:Optional[Any] = None
+        self.started_at = time.perf_counter()
+        self.finished_at:Optional[float] = None
+        self.tokens = 0
+        self.taken = False
+        self.wasted = False
+
+class PrefetchIndex:
+    # speculative searches of one research job by normalized query, shared by its iterations
+    def __init__(self):
+        self.entries:Dict[str, PrefetchEntry] = {}
+        self.lock = threading.Lock()
+
+class SearchPrefetcher:
+    # while a research turn streams, the follow-up queries it proposes in its text are searched in the background
+    # (through the search cache, so they are single-flight and warm it) ; a simple_web_search of the same job asking
+    # for the same query with a context size no larger than the speculative one is served from the in-flight or
+    # finished search. speculation is capped per job and process-wide, unclaimed searches are counted as waste
+    def __init__(self, max_inflight:int=8, max_per_job:int=12, search_context_size:str='medium'):
+        self.max_inflight = max_inflight
+        self.max_per_job = max_per_job
+        self.search_context_size = search_context_size
+        self.lock = threading.Lock()
+        self.nb_inflight = 0
+        self.counters:Dict[str, float] = {
+            'launched': 0,
+            'hits': 0,
+            'inflight_hits': 0,
+            'wasted': 0,
+            'errors': 0,
+            'capped': 0,
+            'used_tokens': 0,
+            'wasted_tokens': 0,
+            'saved_seconds': 0.0
+        }
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            stats = dict(self.counters)
+            stats['inflight'] = self.nb_inflight
+        stats['hit_rate'] = stats['hits'] / stats['launched'] if stats['launched'] > 0 else 0.0
+        return stats
+
+    def count(self, outcome:str, value:float=1) -> None:
+        with self.lock:
+            self.counters[outcome] += value
+
+    def admit(self, index:PrefetchIndex, query:str, search_context_size:str) -> Optional[PrefetchEntry]:
+        # registers a speculative search, the caller launches it and attaches its future
+        key = normalize_query(query)
+        with index.lock:
+            if key in index.entries:
+                return None
+            if len(index.entries) >= self.max_per_job:
+                self.count('capped')
+                return None
+            with self.lock:
+                if self.nb_inflight >= self.max_inflight:
+                    self.counters['capped'] += 1
+                    return None
+                self.nb_inflight += 1
+                self.counters['launched'] += 1
+            entry = PrefetchEntry(query, search_context_size)
+            index.entries[key] = entry
+        logger.info(f'speculative search for {query} ({search_context_size})')
+        if telemetry.enabled:
+            telemetry.inc('prefetch_searches_total', outcome='launched')
+        return entry
+
+    def attach(self, entry:PrefetchEntry, future:Any) -> None:
+        # future is a concurrent.futures.Future or an asyncio.Task, both call back with themselves once done
+        entry.future = future
+        future.add_done_callback(lambda done: self.settle(entry, done))
+
+    def settle(self, entry:PrefetchEntry, future:Any) -> None:
+        failed = future.cancelled() or future.exception() is not None
+        tokens = estimate_tokens(entry.query) + (estimate_tokens(future.result()) if not failed else 0)
+        with self.lock:
+            entry.finished_at = time.perf_counter()
+            entry.tokens = tokens
+            self.nb_inflight -= 1
+            if failed:
+                self.counters['errors'] += 1
+            # a search finishing after its job ended was already counted as wasted, its tokens are added now
+            if entry.wasted:
+                self.counters['wasted_tokens'] += entry.tokens
+        if telemetry.enabled and entry.wasted:
+            telemetry.inc('prefetch_tokens_total', entry.tokens, outcome='wasted')
+
+    def take(self, index:PrefetchIndex, query:str, search_context_size:str) -> Optional[PrefetchEntry]:
+        key = normalize_query(query)
+        with index.lock:
+            entry = index.entries.get(key)
+            if entry is None or entry.taken or entry.future is None:
+                return None
+            if entry.future.done() and (entry.future.cancelled() or entry.future.exception() is not None):
+                return None
+            if search_context_size in SEARCH_CONTEXT_SIZES and SEARCH_CONTEXT_SIZES.index(entry.search_context_size) < SEARCH_CONTEXT_SIZES.index(search_context_size):
+                return None
+            entry.taken = True
+        # the search time already behind us when the real call arrives is what speculation saved
+        with self.lock:
+            inflight = entry.finished_at is None
+            saved_seconds = (time.perf_counter() if inflight else entry.finished_at) - entry.started_at
+            self.counters['hits'] += 1
+            self.counters['inflight_hits'] += int(inflight)
+            self.counters['saved_seconds'] += saved_seconds
+        if telemetry.enabled:
+            telemetry.inc('prefetch_searches_total', outcome='inflight_hit' if inflight else 'hit')
+            telemetry.observe('prefetch_saved_seconds', saved_seconds)
+        return entry
+
+    def used(self, entry:PrefetchEntry, search_result:str) -> None:
+        # the done callback may not have run yet when the taker wakes up, the tokens are counted from the result
+        tokens = estimate_tokens(entry.query) + estimate_tokens(search_result)
+        self.count('used_tokens', tokens)
+        if telemetry.enabled:
+            telemetry.inc('prefetch_tokens_total', tokens, outcome='used')
+
+    def finish(self, index:PrefetchIndex) -> None:
+        # called when the research job ends, whatever was not claimed by then was spent for nothing
+        with index.lock:
+            entries = list(index.entries.values())
+        nb_wasted, wasted_tokens = 0, 0
+        with self.lock:
+            for entry in entries:
+                if entry.taken:
+                    continue
+                entry.wasted = True
+                nb_wasted += 1
+                if entry.finished_at is not None:
+                    wasted_tokens += entry.tokens
+            self.counters['wasted'] += nb_wasted
+            self.counters['wasted_tokens'] += wasted_tokens
+        if len(entries) > 0:
+            logger.info(f'speculative searches of the research: {len(entries)} launched, {len(entries) - nb_wasted} used, {nb_wasted} wasted (~{wasted_tokens} tokens so far)')
+        if telemetry.enabled:
+            telemetry.inc('prefetch_searches_total', nb_wasted, outcome='wasted')
+            telemetry.inc('prefetch_tokens_total', wasted_tokens, outcome='wasted')
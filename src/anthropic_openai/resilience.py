@@ -0,0 +1,321 @@
+import time
+import random
+import asyncio
+import threading
+
+from collections import deque
+from concurrent.futures import Executor, Future, wait, FIRST_COMPLETED
+from pydantic import BaseModel
+
+import anthropic
+import openai
+
+from typing import Dict, Tuple, Set, Optional, Callable, Awaitable, Iterable, AsyncIterable, Iterator, AsyncIterator, Deque, Any, TypeVar
+
+from .log import logger
+from .telemetry import telemetry
+
+T = TypeVar('T')
+
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+CONNECTION_ERRORS = (anthropic.APIConnectionError, openai.APIConnectionError, TimeoutError, ConnectionError)
+
+class ResiliencePolicy(BaseModel):
+    timeout:Optional[float] = None           # deadline of one attempt in seconds
+    max_retries:int = 3
+    backoff_base:float = 0.5
+    backoff_max:float = 8.0
+    hedge:bool = False                       # only safe for idempotent calls such as web searches
+    hedge_quantile:float = 0.95
+    hedge_min_delay:float = 0.5
+    hedge_min_samples:int = 20
+    breaker_failure_threshold:int = 5
+    breaker_reset_timeout:float = 30.0
+
+class CircuitOpenError(Exception):
+    pass
+
+def is_retryable(error:BaseException) -> bool:
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and (status_code in RETRYABLE_STATUS_CODES or status_code >= 500)
+
+def retry_after(error:BaseException) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class CircuitBreaker:
+    # closed    : calls go through, consecutive provider failures are counted
+    # open      : calls fail fast with CircuitOpenError until reset_timeout has passed
+    # half_open : a single probe is let through, its outcome closes or re-opens the circuit
+    def __init__(self, name:str, failure_threshold:int, reset_timeout:float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _transition(self, state:str) -> None:
+        # must be called with self.lock held
+        if self.state == state:
+            return
+        logger.warning(f'circuit breaker {self.name}: {self.state} -> {state}')
+        self.state = state
+        if telemetry.enabled:
+            telemetry.inc('circuit_breaker_transitions_total', breaker=self.name, state=state)
+
+    def allow(self) -> None:
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._transition('half_open')
+            if self.state == 'closed' or (self.state == 'half_open' and not self.probing):
+                self.probing = self.state == 'half_open'
+                return
+        if telemetry.enabled:
+            telemetry.inc('circuit_breaker_rejections_total', breaker=self.name)
+        raise CircuitOpenError(f'circuit breaker {self.name} is open')
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self._transition('closed')
+
+    def record_failure(self, error:BaseException) -> None:
+        # client errors (bad request, authentication...) say nothing about the health of the provider
+        if not is_retryable(error):
+            with self.lock:
+                self.probing = False
+            return
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition('open')
+
+class LatencyTracker:
+    __slots__ = ('samples', 'lock')
+    def __init__(self, window:int=256):
+        self.samples:Deque[float] = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, value:float) -> None:
+        with self.lock:
+            self.samples.append(value)
+
+    def quantile(self, q:float, min_samples:int) -> Optional[float]:
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Resilience:
+    # process-wide, like the request scheduler: breakers and latency windows are shared by every agent loop
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.provider_policies:Dict[str, ResiliencePolicy] = {
+            'anthropic': ResiliencePolicy(timeout=600.0),
+            'openai': ResiliencePolicy(timeout=60.0, hedge=True)
+        }
+        self.model_policies:Dict[Tuple[str, str], ResiliencePolicy] = {}
+        self.breakers:Dict[Tuple[str, str], CircuitBreaker] = {}
+        self.trackers:Dict[Tuple[str, str], LatencyTracker] = {}
+
+    def configure(self, provider:str, policy:ResiliencePolicy, model:Optional[str]=None) -> None:
+        with self.lock:
+            if model is None:
+                self.provider_policies[provider] = policy
+                for key in [ key for key in self.breakers if key[0] == provider and key not in self.model_policies ]:
+                    del self.breakers[key]
+            else:
+                self.model_policies[(provider, model)] = policy
+                self.breakers.pop((provider, model), None)
+        logger.info(f'resilience policy for {provider}/{model or "*"} was set to {policy.model_dump()}')
+
+    def policy(self, provider:str, model:str) -> ResiliencePolicy:
+        return self.model_policies.get((provider, model), self.provider_policies.get(provider, ResiliencePolicy()))
+
+    def breaker(self, provider:str, model:str) -> CircuitBreaker:
+        key = (provider, model)
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                policy = self.policy(provider, model)
+                breaker = self.breakers[key] = CircuitBreaker(f'{provider}/{model}', policy.breaker_failure_threshold, policy.breaker_reset_timeout)
+            return breaker
+
+    def tracker(self, provider:str, model:str) -> LatencyTracker:
+        key = (provider, model)
+        with self.lock:
+            tracker = self.trackers.get(key)
+            if tracker is None:
+                tracker = self.trackers[key] = LatencyTracker()
+            return tracker
+
+    def hedge_delay(self, provider:str, model:str, policy:ResiliencePolicy) -> Optional[float]:
+        if not policy.hedge:
+            return None
+        quantile = self.tracker(provider, model).quantile(policy.hedge_quantile, policy.hedge_min_samples)
+        return max(policy.hedge_min_delay, quantile) if quantile is not None else None
+
+    def backoff(self, policy:ResiliencePolicy, attempt:int, error:BaseException) -> float:
+        # full jitter, a retry-after header is honoured up to backoff_max
+        delay = random.uniform(0, min(policy.backoff_max, policy.backoff_base * 2 ** attempt))
+        hint = retry_after(error)
+        return min(policy.backoff_max, max(delay, hint)) if hint is not None else delay
+
+    def _on_error(self, provider:str, model:str, policy:ResiliencePolicy, attempt:int, error:BaseException) -> Optional[float]:
+        # returns the delay before the next attempt, None when the error has to be raised
+        self.breaker(provider, model).record_failure(error)
+        reason = 'timeout' if isinstance(error, TimeoutError) else type(error).__name__
+        if telemetry.enabled:
+            telemetry.inc('resilience_errors_total', provider=provider, model=model, reason=reason)
+        if not is_retryable(error) or attempt >= policy.max_retries:
+            return None
+        delay = self.backoff(policy, attempt, error)
+        logger.warning(f'{provider}/{model} attempt {attempt + 1}/{policy.max_retries + 1} failed ({reason}: {error}), retrying in {delay:.2f}s')
+        if telemetry.enabled:
+            telemetry.inc('resilience_retries_total', provider=provider, model=model, reason=reason)
+        return delay
+
+    def _on_success(self, provider:str, model:str, started_at:float) -> None:
+        self.breaker(provider, model).record_success()
+        self.tracker(provider, model).observe(time.monotonic() - started_at)
+
+    def call(self, provider:str, model:str, fn:Callable[[], T], hedge_executor:Optional[Executor]=None) -> T:
+        policy = self.policy(provider, model)
+        attempt = 0
+        while True:
+            self.breaker(provider, model).allow()
+            started_at = time.monotonic()
+            try:
+                result = self._hedged(provider, model, policy, fn, hedge_executor) if hedge_executor is not None else fn()
+            except Exception as e:
+                delay = self._on_error(provider, model, policy, attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(provider, model, started_at)
+            return result
+
+    def _hedged(self, provider:str, model:str, policy:ResiliencePolicy, fn:Callable[[], T], executor:Executor) -> T:
+        # a duplicate request is sent once the first one is slower than the p95 of recent calls, the first success wins
+        # the loser keeps running until its own timeout, its result is dropped
+        deadline = time.monotonic() + policy.timeout if policy.timeout is not None else None
+        pending:Set[Future] = set([executor.submit(fn)])
+        hedge_delay = self.hedge_delay(provider, model, policy)
+        error:Optional[BaseException] = None
+        hedged = False
+        while len(pending) > 0:
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            timeout = hedge_delay if not hedged and hedge_delay is not None else remaining
+            if remaining is not None and timeout is not None:
+                timeout = min(timeout, remaining)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if hedged and telemetry.enabled:
+                        telemetry.inc('resilience_hedges_total', provider=provider, model=model, outcome='completed')
+                    return future.result()
+                error = future.exception()
+            if len(done) == 0:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                hedged = True
+                pending.add(executor.submit(fn))
+                logger.info(f'{provider}/{model} call is slower than {hedge_delay:.2f}s, a hedged request was sent')
+                if telemetry.enabled:
+                    telemetry.inc('resilience_hedges_total', provider=provider, model=model, outcome='launched')
+        for future in pending:
+            future.cancel()
+        if error is not None and len(pending) == 0:
+            raise error
+        raise TimeoutError(f'{provider}/{model} call exceeded its {policy.timeout}s deadline')
+
+    async def acall(self, provider:str, model:str, fn:Callable[[], Awaitable[T]], hedge:bool=False) -> T:
+        policy = self.policy(provider, model)
+        attempt = 0
+        while True:
+            self.breaker(provider, model).allow()
+            started_at = time.monotonic()
+            try:
+                if hedge:
+                    result = await self._ahedged(provider, model, policy, fn)
+                else:
+                    result = await asyncio.wait_for(fn(), timeout=policy.timeout)
+            except Exception as e:
+                delay = self._on_error(provider, model, policy, attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._on_success(provider, model, started_at)
+            return result
+
+    async def _ahedged(self, provider:str, model:str, policy:ResiliencePolicy, fn:Callable[[], Awaitable[T]]) -> T:
+        deadline = time.monotonic() + policy.timeout if policy.timeout is not None else None
+        pending:Set[asyncio.Task] = set([asyncio.ensure_future(fn())])
+        hedge_delay = self.hedge_delay(provider, model, policy)
+        error:Optional[BaseException] = None
+        hedged = False
+        try:
+            while len(pending) > 0:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                timeout = hedge_delay if not hedged and hedge_delay is not None else remaining
+                if remaining is not None and timeout is not None:
+                    timeout = min(timeout, remaining)
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedged and telemetry.enabled:
+                            telemetry.inc('resilience_hedges_total', provider=provider, model=model, outcome='completed')
+                        return task.result()
+                    error = task.exception()
+                if len(done) == 0:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        break
+                    hedged = True
+                    pending.add(asyncio.ensure_future(fn()))
+                    logger.info(f'{provider}/{model} call is slower than {hedge_delay:.2f}s, a hedged request was sent')
+                    if telemetry.enabled:
+                        telemetry.inc('resilience_hedges_total', provider=provider, model=model, outcome='launched')
+        finally:
+            # unlike threads, the losing coroutine can be cancelled
+            for task in pending:
+                task.cancel()
+        if error is not None and len(pending) == 0:
+            raise error
+        raise TimeoutError(f'{provider}/{model} call exceeded its {policy.timeout}s deadline')
+
+def guarded_stream(stream:Iterable[Any], breaker:CircuitBreaker) -> Iterator[Any]:
+    # failures after the stream was opened cannot be retried without replaying output, they still count against the breaker
+    try:
+        yield from stream
+    except Exception as e:
+        breaker.record_failure(e)
+        raise
+
+async def aguarded_stream(stream:AsyncIterable[Any], breaker:CircuitBreaker) -> AsyncIterator[Any]:
+    try:
+        async for event in stream:
+            yield event
+    except Exception as e:
+        breaker.record_failure(e)
+        raise
+
+resilience = Resilience()
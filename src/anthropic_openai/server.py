@@ -0,0 +1,204 @@
+import json
+import asyncio
+
+from http import HTTPStatus
+
+from .types import Role, ChatMessage
+from typing import List, Dict, Tuple, Set, Optional, Any
+
+from .log import logger
+from .async_agent_loop import AsyncAgentLoop
+from .sessions import Session, SessionStore
+from .sinks import QueueSink, current_sink
+from .transcript import current_transcript
+from .telemetry import telemetry
+
+class HTTPError(Exception):
+    def __init__(self, status:HTTPStatus, message:str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def format_sse(event:Dict) -> bytes:
+    return f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'.encode('utf-8')
+
+class SessionServer:
+    # minimal http/1.1 front-end over a single AsyncAgentLoop, one connection per request
+    #   POST   /sessions                  -> create a session
+    #   GET    /sessions/{id}             -> session state and history
+    #   DELETE /sessions/{id}             -> drop a session
+    #   POST   /sessions/{id}/messages    -> {"query": ...}, the turn is streamed back as server-sent events
+    #   GET    /health                    -> liveness and store stats
+    #   GET    /metrics                   -> prometheus text exposition when telemetry is enabled
+    def __init__(self, agent_loop:AsyncAgentLoop, session_store:SessionStore, host:str='127.0.0.1', port:int=8000, max_pending_events:int=256, max_body_size:int=1 << 20, keepalive_interval:float=15.0, sweep_interval:float=60.0):
+        self.agent_loop = agent_loop
+        self.session_store = session_store
+        self.host = host
+        self.port = port
+        self.max_pending_events = max_pending_events
+        self.max_body_size = max_body_size
+        self.keepalive_interval = keepalive_interval
+        self.sweep_interval = sweep_interval
+        self.turns:Set[asyncio.Task] = set()
+
+    async def serve_forever(self) -> None:
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        sweeper = asyncio.create_task(self.sweep())
+        logger.info(f'session server is listening on http://{self.host}:{self.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+            for turn in list(self.turns):
+                turn.cancel()
+            await asyncio.gather(*self.turns, return_exceptions=True)
+
+    async def sweep(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.session_store.evict()
+
+    async def read_request(self, reader:asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], bytes]:
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'request head is too large')
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, path, _ = lines[0].split(' ', 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'malformed request line')
+        headers:Dict[str, str] = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        try:
+            content_length = int(headers.get('content-length', '0') or 0)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, 'invalid content-length')
+        if content_length > self.max_body_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f'body is limited to {self.max_body_size} bytes')
+        body = await reader.readexactly(content_length) if content_length > 0 else b''
+        return method.upper(), path.split('?', 1)[0], headers, body
+
+    async def respond(self, writer:asyncio.StreamWriter, status:HTTPStatus, payload:Optional[Any]=None, content_type:str='application/json') -> None:
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+        else:
+            body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        head = f'HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, path, _, body = await self.read_request(reader)
+                await self.route(writer, method, path, body)
+            except HTTPError as e:
+                await self.respond(writer, e.status, {'error': e.message})
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            except Exception as e:
+                logger.error(f'error: {e}')
+                await self.respond(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer:asyncio.StreamWriter, method:str, path:str, body:bytes) -> None:
+        segments:List[str] = [ segment for segment in path.split('/') if segment ]
+        match (method, segments):
+            case ('GET', ['health']):
+                await self.respond(writer, HTTPStatus.OK, {'status': 'ok', **self.session_store.stats()})
+            case ('GET', ['metrics']):
+                if not telemetry.enabled:
+                    raise HTTPError(HTTPStatus.NOT_FOUND, 'metrics are disabled, set METRICS_ENABLED=true')
+                await self.respond(writer, HTTPStatus.OK, telemetry.render_prometheus(), content_type='text/plain; version=0.0.4')
+            case ('POST', ['sessions']):
+                session = await self.session_store.create()
+                await self.respond(writer, HTTPStatus.CREATED, session.describe())
+            case ('GET', ['sessions', session_id]):
+                session = await self.get_session(session_id)
+                history = [ chat_message.model_dump(mode='json') for chat_message in session.conversation_history ]
+                await self.respond(writer, HTTPStatus.OK, {**session.describe(), 'conversation_history': history})
+            case ('DELETE', ['sessions', session_id]):
+                session = await self.get_session(session_id)
+                if session.lock.locked():
+                    raise HTTPError(HTTPStatus.CONFLICT, 'a turn is running on this session')
+                await self.session_store.remove(session_id, delete=True)
+                await self.respond(writer, HTTPStatus.OK, {'session_id': session_id, 'deleted': True})
+            case ('POST', ['sessions', session_id, 'messages']):
+                session = await self.get_session(session_id)
+                try:
+                    query = json.loads(body or b'{}')['query']
+                except (ValueError, KeyError, TypeError):
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, 'body must be a json object with a query field')
+                if not isinstance(query, str) or len(query.strip()) == 0:
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, 'query must be a non empty string')
+                await self.stream_turn(writer, session, query)
+            case (_, ['health'] | ['metrics'] | ['sessions'] | ['sessions', _] | ['sessions', _, 'messages']):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f'{method} is not allowed on {path}')
+            case _:
+                raise HTTPError(HTTPStatus.NOT_FOUND, f'{path} was not found')
+
+    async def get_session(self, session_id:str) -> Session:
+        session = await self.session_store.get(session_id)
+        if session is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f'session {session_id} was not found')
+        return session
+
+    async def run_turn(self, session:Session, query:str, sink:QueueSink) -> None:
+        # runs in its own task so the sink is only visible to this turn and to the tools it spawns
+        current_sink.set(sink)
+        current_transcript.set(session.transcript)
+        try:
+            # a session restored after a restart first finishes the turn it was interrupted in
+            await self.agent_loop.resume_turn(session.conversation_history)
+            user_message = ChatMessage(role=Role.USER, content=query)
+            session.conversation_history.append(user_message)
+            if session.transcript is not None:
+                await asyncio.to_thread(session.transcript.append, [user_message])
+            stop_reason = await self.agent_loop.handle_turn(session.conversation_history)
+            sink.emit({'type': 'turn_end', 'stop_reason': stop_reason})
+        except Exception as e:
+            logger.error(f'session {session.session_id} -> error: {e}')
+            sink.emit({'type': 'error', 'message': str(e)})
+        finally:
+            session.nb_turns += 1
+            session.touch()
+            sink.close()
+            if session.transcript is not None:
+                await asyncio.to_thread(session.transcript.close)
+
+    async def stream_turn(self, writer:asyncio.StreamWriter, session:Session, query:str) -> None:
+        if session.lock.locked():
+            raise HTTPError(HTTPStatus.CONFLICT, 'a turn is already running on this session')
+        async with session.lock:
+            sink = QueueSink(max_pending=self.max_pending_events)
+            turn = asyncio.create_task(self.run_turn(session, query, sink))
+            self.turns.add(turn)
+            turn.add_done_callback(self.turns.discard)
+            try:
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+                while True:
+                    try:
+                        event = await asyncio.wait_for(sink.get(), timeout=self.keepalive_interval)
+                    except asyncio.TimeoutError:
+                        writer.write(b': keepalive\n\n')
+                        await writer.drain()
+                        continue
+                    if event is None:
+                        break
+                    writer.write(format_sse(event))
+                    # a slow reader blocks here, the sink fills up and the turn stops pulling from the provider stream
+                    await writer.drain()
+            except ConnectionError:
+                # the turn is left to finish so the stored history stays consistent, its events are dropped
+                logger.info(f'session {session.session_id}: client went away, finishing the turn without a reader')
+                sink.detach()
+            await asyncio.shield(turn)
@@ -0,0 +1,114 @@
+import time
+import asyncio
+
+from uuid import uuid4
+from collections import OrderedDict
+
+from .types import Role, ChatMessage
+from .transcript import TranscriptStore, Transcript
+from typing import List, Dict, Optional
+
+from .log import logger
+
+class Session:
+    def __init__(self, session_id:str, transcript:Optional[Transcript]=None):
+        self.session_id = session_id
+        self.transcript = transcript
+        self.conversation_history:List[ChatMessage] = list(transcript.messages) if transcript is not None else []
+        self.lock = asyncio.Lock()
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        self.nb_turns = sum([ 1 for chat_message in self.conversation_history if chat_message.role == Role.USER and isinstance(chat_message.content, str) ])
+
+    def touch(self) -> None:
+        self.last_used = time.monotonic()
+
+    def describe(self) -> Dict:
+        return {
+            'session_id': self.session_id,
+            'created_at': self.created_at,
+            'nb_turns': self.nb_turns,
+            'nb_messages': len(self.conversation_history),
+            'busy': self.lock.locked()
+        }
+
+class SessionStore:
+    # sessions are kept in lru order and are evicted when idle for longer than idle_ttl or when max_sessions is
+    # exceeded ; a session with a running turn is never evicted, the store may then temporarily hold more entries
+    # with a transcript store, evicted sessions stay on disk and are restored by get() ; the transcript files are
+    # opened, closed and deleted from a worker thread so that the event loop of the server never waits on the disk
+    def __init__(self, max_sessions:int=1024, idle_ttl:float=3600, transcript_store:Optional[TranscriptStore]=None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.transcript_store = transcript_store
+        self.sessions:OrderedDict[str, Session] = OrderedDict()
+        self.nb_evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    async def create(self) -> Session:
+        session_id = uuid4().hex
+        transcript = await asyncio.to_thread(self.transcript_store.open, session_id) if self.transcript_store is not None else None
+        session = Session(session_id, transcript)
+        self.sessions[session.session_id] = session
+        await self.evict()
+        return session
+
+    async def get(self, session_id:str) -> Optional[Session]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return await self.restore(session_id)
+        if time.monotonic() - session.last_used > self.idle_ttl and not session.lock.locked():
+            await self.remove(session_id)
+            self.nb_evictions += 1
+            return None
+        session.touch()
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def load_transcript(self, session_id:str) -> Optional[Transcript]:
+        if self.transcript_store is None or not self.transcript_store.exists(session_id):
+            return None
+        return self.transcript_store.open(session_id)
+
+    async def restore(self, session_id:str) -> Optional[Session]:
+        transcript = await asyncio.to_thread(self.load_transcript, session_id)
+        if transcript is None:
+            return None
+        # a concurrent request may have restored the same session while its transcript was loading
+        session = self.sessions.get(session_id)
+        if session is not None:
+            await asyncio.to_thread(transcript.close)
+            return session
+        session = Session(session_id, transcript)
+        self.sessions[session_id] = session
+        await self.evict()
+        logger.info(f'session {session_id} was restored with {len(session.conversation_history)} messages')
+        return session
+
+    async def remove(self, session_id:str, delete:bool=False) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is not None and session.transcript is not None:
+            await asyncio.to_thread(session.transcript.close)
+        if delete and self.transcript_store is not None:
+            await asyncio.to_thread(self.transcript_store.delete, session_id)
+        return session is not None
+
+    async def evict(self) -> None:
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if session.lock.locked():
+                continue
+            if len(self.sessions) <= self.max_sessions and now - session.last_used <= self.idle_ttl:
+                break
+            await self.remove(session_id)
+            self.nb_evictions += 1
+            logger.info(f'session {session_id} was evicted')
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'sessions': len(self.sessions),
+            'busy': sum([ 1 for session in self.sessions.values() if session.lock.locked() ]),
+            'evictions': self.nb_evictions
+        }
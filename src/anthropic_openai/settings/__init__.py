@@ -1 +1,9 @@
-from .credentials import Credentials
\ No newline at end of file
+from .credentials import Credentials
+from .rate_limits import RateLimits
+from .search_cache import SearchCacheSettings
+from .telemetry import TelemetrySettings
+from .research import ResearchSettings
+from .aggregation import AggregationSettings
+from .resilience import ResilienceSettings
+from .transcripts import TranscriptSettings
+from .prefetch import PrefetchSettings
@@ -0,0 +1,7 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+class AggregationSettings(BaseSettings):
+    enabled:bool = Field(default=True, validation_alias='SEARCH_AGGREGATION')
+    token_budget:int = Field(default=4000, validation_alias='SEARCH_TOKEN_BUDGET')
+    similarity_threshold:float = Field(default=0.7, validation_alias='SEARCH_DEDUP_THRESHOLD')
@@ -0,0 +1,8 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+class PrefetchSettings(BaseSettings):
+    enabled:bool = Field(default=False, validation_alias='SEARCH_PREFETCH')
+    max_inflight:int = Field(default=8, validation_alias='SEARCH_PREFETCH_MAX_INFLIGHT')
+    max_per_job:int = Field(default=12, validation_alias='SEARCH_PREFETCH_MAX_PER_JOB')
+    search_context_size:str = Field(default='medium', validation_alias='SEARCH_PREFETCH_CONTEXT_SIZE')
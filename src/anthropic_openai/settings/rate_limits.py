@@ -0,0 +1,12 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+from typing import Optional
+
+class RateLimits(BaseSettings):
+    anthropic_max_concurrency:int = Field(default=8, validation_alias='ANTHROPIC_MAX_CONCURRENCY')
+    anthropic_requests_per_minute:Optional[int] = Field(default=50, validation_alias='ANTHROPIC_REQUESTS_PER_MINUTE')
+    anthropic_tokens_per_minute:Optional[int] = Field(default=80_000, validation_alias='ANTHROPIC_TOKENS_PER_MINUTE')
+    openai_max_concurrency:int = Field(default=16, validation_alias='OPENAI_MAX_CONCURRENCY')
+    openai_requests_per_minute:Optional[int] = Field(default=500, validation_alias='OPENAI_REQUESTS_PER_MINUTE')
+    openai_tokens_per_minute:Optional[int] = Field(default=400_000, validation_alias='OPENAI_TOKENS_PER_MINUTE')
@@ -0,0 +1,12 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+from typing import Optional
+
+class ResearchSettings(BaseSettings):
+    adaptive:bool = Field(default=False, validation_alias='RESEARCH_ADAPTIVE')
+    min_novelty:float = Field(default=0.15, validation_alias='RESEARCH_MIN_NOVELTY')
+    shrink_novelty:float = Field(default=0.4, validation_alias='RESEARCH_SHRINK_NOVELTY')
+    patience:int = Field(default=2, validation_alias='RESEARCH_PATIENCE')
+    max_seconds:Optional[float] = Field(default=None, validation_alias='RESEARCH_MAX_SECONDS')
+    max_tokens:Optional[int] = Field(default=None, validation_alias='RESEARCH_MAX_TOKENS')
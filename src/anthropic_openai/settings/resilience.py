@@ -0,0 +1,17 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+from typing import Optional
+
+class ResilienceSettings(BaseSettings):
+    anthropic_timeout:Optional[float] = Field(default=600.0, validation_alias='ANTHROPIC_TIMEOUT')
+    anthropic_max_retries:int = Field(default=3, validation_alias='ANTHROPIC_MAX_RETRIES')
+    openai_timeout:Optional[float] = Field(default=60.0, validation_alias='OPENAI_TIMEOUT')
+    openai_max_retries:int = Field(default=3, validation_alias='OPENAI_MAX_RETRIES')
+    backoff_base:float = Field(default=0.5, validation_alias='RETRY_BACKOFF_BASE')
+    backoff_max:float = Field(default=8.0, validation_alias='RETRY_BACKOFF_MAX')
+    search_hedge:bool = Field(default=True, validation_alias='SEARCH_HEDGE')
+    search_hedge_quantile:float = Field(default=0.95, validation_alias='SEARCH_HEDGE_QUANTILE')
+    search_hedge_min_delay:float = Field(default=0.5, validation_alias='SEARCH_HEDGE_MIN_DELAY')
+    breaker_failure_threshold:int = Field(default=5, validation_alias='BREAKER_FAILURE_THRESHOLD')
+    breaker_reset_timeout:float = Field(default=30.0, validation_alias='BREAKER_RESET_TIMEOUT')
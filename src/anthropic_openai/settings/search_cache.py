@@ -0,0 +1,9 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+from typing import Optional
+
+class SearchCacheSettings(BaseSettings):
+    path:Optional[str] = Field(default='search_cache.sqlite3', validation_alias='SEARCH_CACHE_PATH')
+    max_entries:int = Field(default=1024, validation_alias='SEARCH_CACHE_MAX_ENTRIES')
+    ttl:float = Field(default=3600.0, validation_alias='SEARCH_CACHE_TTL')
@@ -0,0 +1,9 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+from typing import Optional
+
+class TelemetrySettings(BaseSettings):
+    enabled:bool = Field(default=False, validation_alias='METRICS_ENABLED')
+    trace_path:Optional[str] = Field(default='trace.jsonl', validation_alias='METRICS_TRACE_PATH')
+    prometheus_path:Optional[str] = Field(default='metrics.prom', validation_alias='METRICS_PROMETHEUS_PATH')
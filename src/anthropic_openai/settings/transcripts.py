@@ -0,0 +1,9 @@
+from pydantic_settings import BaseSettings
+from pydantic import Field 
+
+from typing import Optional
+
+class TranscriptSettings(BaseSettings):
+    path:Optional[str] = Field(default='transcripts', validation_alias='TRANSCRIPT_PATH')
+    snapshot_every:int = Field(default=256, validation_alias='TRANSCRIPT_SNAPSHOT_EVERY')
+    fsync:bool = Field(default=False, validation_alias='TRANSCRIPT_FSYNC')
@@ -0,0 +1,189 @@
+import sys
+import json
+import time
+import asyncio
+import threading
+
+from collections import deque
+from contextvars import ContextVar
+
+from typing import List, Dict, Deque, Optional, TextIO
+
+class EventSink:
+    # receives the stream events of consume_stream: message_start, block_start, text_delta, thinking_delta,
+    # block_stop, tool_call, message_stop ; emit must never block the stream parser, a sink that needs the
+    # producer to slow down reports backlogged and the async engine awaits wait_writable
+    # tool_input_delta (the arguments of a tool_use parsed so far) is only produced for sinks that set partial_tool_input
+    backlogged:bool = False
+    partial_tool_input:bool = False
+
+    def emit(self, event:Dict) -> None:
+        raise NotImplementedError
+
+    async def wait_writable(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+class NullSink(EventSink):
+    # headless runs and workers: the stream is still parsed into the history, nothing is rendered
+    def emit(self, event:Dict) -> None:
+        pass
+
+class BufferedSink(EventSink):
+    # rendered chunks are joined and written in one call when a block boundary is reached, when max_buffered
+    # characters are pending or when flush_interval has elapsed, instead of one flushed write per delta ;
+    # a flusher thread, started with the first buffered delta, writes them out once they are flush_interval old
+    # so that a stream stalling in the middle of a block (a slow tool call, a long thinking pause) is not held back
+    def __init__(self, file_pointer:Optional[TextIO]=None, flush_interval:float=0.05, max_buffered:int=4096):
+        self.file_pointer = file_pointer
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.lock = threading.Lock()
+        self.pending = threading.Condition(self.lock)
+        self.chunks:List[str] = []
+        self.nb_buffered = 0
+        self.last_flush = time.monotonic()
+        self.flusher:Optional[threading.Thread] = None
+        self.closed = False
+
+    def render(self, event:Dict) -> Optional[str]:
+        raise NotImplementedError
+
+    def emit(self, event:Dict) -> None:
+        chunk = self.render(event)
+        if chunk is None:
+            # the end of a message is always written out, even when it renders nothing itself
+            if event['type'] == 'message_stop':
+                self.flush()
+            return
+        with self.lock:
+            self.chunks.append(chunk)
+            self.nb_buffered += len(chunk)
+            if event['type'] in DELTA_EVENTS and self.nb_buffered < self.max_buffered and time.monotonic() - self.last_flush < self.flush_interval:
+                if len(self.chunks) == 1:
+                    self._wake_flusher()
+                return
+            self._flush()
+
+    def _wake_flusher(self) -> None:
+        # must be called with self.lock held
+        if self.flusher is None and not self.closed:
+            self.flusher = threading.Thread(target=self.flush_loop, name='sink_flusher', daemon=True)
+            self.flusher.start()
+        self.pending.notify()
+
+    def flush_loop(self) -> None:
+        with self.lock:
+            while not self.closed:
+                if len(self.chunks) == 0:
+                    self.pending.wait()
+                    continue
+                delay = self.last_flush + self.flush_interval - time.monotonic()
+                if delay > 0:
+                    self.pending.wait(delay)
+                    continue
+                self._flush()
+
+    def _flush(self) -> None:
+        if len(self.chunks) > 0:
+            file_pointer = self.file_pointer if self.file_pointer is not None else sys.stdout
+            file_pointer.write(''.join(self.chunks))
+            file_pointer.flush()
+            self.chunks.clear()
+            self.nb_buffered = 0
+        self.last_flush = time.monotonic()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self._flush()
+            self.closed = True
+            self.pending.notify()
+
+class TerminalSink(BufferedSink):
+    def render(self, event:Dict) -> Optional[str]:
+        match event['type']:
+            case 'message_start':
+                return '\n'
+            case 'block_start':
+                tag = BLOCK_TAGS.get(event['block'])
+                return f'<{tag}>\n' if tag is not None else None
+            case 'text_delta':
+                return event['text']
+            case 'thinking_delta':
+                return event['thinking']
+            case 'block_stop':
+                tag = BLOCK_TAGS.get(event['block'])
+                return f'\n</{tag}>\n' if tag is not None else '\n'
+            case 'tool_call':
+                return f'{event["name"]}\n{event["arguments"]}\n'
+        return None
+
+class StructuredSink(BufferedSink):
+    # one json document per event, for consumers that parse the output of a headless run
+    def __init__(self, file_pointer:Optional[TextIO]=None, flush_interval:float=0.05, max_buffered:int=4096, partial_tool_input:bool=False):
+        super(StructuredSink, self).__init__(file_pointer=file_pointer, flush_interval=flush_interval, max_buffered=max_buffered)
+        self.partial_tool_input = partial_tool_input
+
+    def render(self, event:Dict) -> Optional[str]:
+        return json.dumps({'ts': time.time(), **event}, default=str) + '\n'
+
+class QueueSink(EventSink):
+    # bounded hand-off between a session turn and its http response, both running on the same event loop
+    # the producer is told to wait once max_pending events are buffered and resumes when the reader catches up
+    def __init__(self, max_pending:int=256):
+        self.max_pending = max_pending
+        self.events:Deque[Dict] = deque()
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = False
+
+    @property
+    def backlogged(self) -> bool:
+        return len(self.events) >= self.max_pending
+
+    def emit(self, event:Dict) -> None:
+        if self.closed:
+            return
+        self.events.append(event)
+        self.readable.set()
+        if len(self.events) >= self.max_pending:
+            self.writable.clear()
+
+    async def wait_writable(self) -> None:
+        await self.writable.wait()
+
+    async def get(self) -> Optional[Dict]:
+        while len(self.events) == 0:
+            if self.closed:
+                return None
+            self.readable.clear()
+            await self.readable.wait()
+        event = self.events.popleft()
+        if len(self.events) <= self.max_pending // 2:
+            self.writable.set()
+        return event
+
+    def close(self) -> None:
+        self.closed = True
+        self.readable.set()
+        self.writable.set()
+
+    def detach(self) -> None:
+        # the reader went away: drop what is buffered and never block the producer again
+        self.events.clear()
+        self.close()
+
+BLOCK_TAGS = {'text': 'response', 'thinking': 'thinking', 'tool_use': 'tool_use'}
+DELTA_EVENTS = ('text_delta', 'thinking_delta', 'tool_input_delta')
+
+current_sink:ContextVar[EventSink] = ContextVar('current_sink', default=TerminalSink())
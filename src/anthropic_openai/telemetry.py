@@ -0,0 +1,218 @@
+import json
+import time
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from typing import List, Dict, Tuple, Optional, Any, Iterable, Iterator, AsyncIterable, AsyncIterator, TextIO
+
+from .log import logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (1.0, 5.0, 10.0, 25.0, 50.0, 75.0, 100.0, 150.0, 200.0, 400.0, 800.0)
+
+METRIC_HELP = {
+    'llm_queue_wait_seconds': ('histogram', 'time spent waiting for a request scheduler slot', LATENCY_BUCKETS),
+    'llm_time_to_first_token_seconds': ('histogram', 'time from request submission to the first content delta', LATENCY_BUCKETS),
+    'llm_stream_seconds': ('histogram', 'time from request submission to the end of the stream', LATENCY_BUCKETS),
+    'llm_output_tokens_per_second': ('histogram', 'output tokens per second between the first delta and the end of the stream', RATE_BUCKETS),
+    'llm_tokens_total': ('counter', 'tokens reported by the api, thinking and text are split by streamed characters', None),
+    'llm_requests_total': ('counter', 'streamed model requests', None),
+    'tool_seconds': ('histogram', 'tool execution latency', LATENCY_BUCKETS),
+    'search_seconds': ('histogram', 'make_search latency including the cache lookup', LATENCY_BUCKETS),
+    'research_iteration_seconds': ('histogram', 'duration of one deep_iterative_web_search iteration', LATENCY_BUCKETS),
+    'research_decisions_total': ('counter', 'decisions of the novelty scheduler after each deep research iteration', None),
+    'resilience_errors_total': ('counter', 'failed provider call attempts by exception type', None),
+    'resilience_retries_total': ('counter', 'provider call attempts that were retried after a backoff', None),
+    'resilience_hedges_total': ('counter', 'hedged duplicate search requests that were launched, and hedged calls that completed', None),
+    'circuit_breaker_transitions_total': ('counter', 'circuit breaker state changes', None),
+    'circuit_breaker_rejections_total': ('counter', 'calls failed fast by an open circuit breaker', None),
+    'prefetch_searches_total': ('counter', 'speculative searches launched during deep research, claimed by a later call (hit, inflight_hit) or never claimed (wasted)', None),
+    'prefetch_tokens_total': ('counter', 'estimated tokens of speculative searches that were used or wasted', None),
+    'prefetch_saved_seconds': ('histogram', 'search time already spent by a speculative search when a real call claimed it', LATENCY_BUCKETS),
+    'search_aggregation_tokens_total': ('counter', 'estimated tokens of simple_web_search results before and after aggregation', None),
+    'search_aggregation_passages_total': ('counter', 'search result passages kept, dropped as near duplicates or dropped over the token budget', None),
+}
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+    def __init__(self, buckets:Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Telemetry:
+    # hot paths check telemetry.enabled before doing any work, a disabled instance costs one attribute lookup
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters:Dict[str, Dict[LabelSet, float]] = {}
+        self.histograms:Dict[str, Dict[LabelSet, Histogram]] = {}
+        self.trace_file:Optional[TextIO] = None
+        self.prometheus_path:Optional[str] = None
+
+    def configure(self, enabled:bool, trace_path:Optional[str]=None, prometheus_path:Optional[str]=None) -> None:
+        self.close()
+        self.enabled = enabled
+        self.prometheus_path = prometheus_path
+        if enabled and trace_path is not None:
+            self.trace_file = open(trace_path, mode='a', encoding='utf-8', buffering=1 << 16)
+
+    def inc(self, name:str, value:float=1.0, **labels:Any) -> None:
+        label_set = tuple(sorted((key, str(label_value)) for key, label_value in labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[label_set] = series.get(label_set, 0.0) + value
+
+    def observe(self, name:str, value:float, **labels:Any) -> None:
+        label_set = tuple(sorted((key, str(label_value)) for key, label_value in labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(label_set)
+            if histogram is None:
+                histogram = series[label_set] = Histogram(METRIC_HELP.get(name, ('histogram', '', LATENCY_BUCKETS))[2])
+            histogram.observe(value)
+
+    def trace(self, span:str, **fields:Any) -> None:
+        if self.trace_file is None:
+            return
+        line = json.dumps({'ts': time.time(), 'span': span, **fields}, default=str)
+        with self.lock:
+            self.trace_file.write(line + '\n')
+
+    @contextmanager
+    def span(self, name:str, **labels:Any) -> Iterator[Dict[str, Any]]:
+        # yields a dict the caller may fill with extra trace fields
+        fields:Dict[str, Any] = {}
+        if not self.enabled:
+            yield fields
+            return
+        started_at = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            duration = time.perf_counter() - started_at
+            self.observe(f'{name}_seconds', duration, **labels)
+            self.trace(name, duration=duration, **labels, **fields)
+
+    def render_prometheus(self) -> str:
+        lines:List[str] = []
+        with self.lock:
+            names = sorted(set(self.counters) | set(self.histograms))
+            for name in names:
+                kind, description, _ = METRIC_HELP.get(name, ('histogram' if name in self.histograms else 'counter', '', None))
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                for label_set, value in self.counters.get(name, {}).items():
+                    lines.append(f'{name}{_format_labels(label_set)} {value}')
+                for label_set, histogram in self.histograms.get(name, {}).items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(label_set + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_bucket{_format_labels(label_set + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{_format_labels(label_set)} {histogram.total}')
+                    lines.append(f'{name}_count{_format_labels(label_set)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self) -> None:
+        if self.prometheus_path is not None and self.enabled:
+            with open(self.prometheus_path, mode='w', encoding='utf-8') as file_pointer:
+                file_pointer.write(self.render_prometheus())
+            logger.info(f'metrics were written to {self.prometheus_path}')
+        if self.trace_file is not None:
+            with self.lock:
+                self.trace_file.close()
+                self.trace_file = None
+
+def _format_labels(label_set:LabelSet) -> str:
+    if len(label_set) == 0:
+        return ''
+    return '{' + ','.join([ f'{key}="{value}"' for key, value in label_set ]) + '}'
+
+class StreamStats:
+    __slots__ = ('model', 'started_at', 'first_token_at', 'thinking_chars', 'text_chars', 'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_write_tokens')
+    def __init__(self, model:str, started_at:float):
+        self.model = model
+        self.started_at = started_at
+        self.first_token_at:Optional[float] = None
+        self.thinking_chars = 0
+        self.text_chars = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+    def update(self, event:Any) -> None:
+        match event.type:
+            case 'message_start':
+                usage = event.message.usage
+                self.input_tokens += usage.input_tokens or 0
+                self.cache_read_tokens += getattr(usage, 'cache_read_input_tokens', None) or 0
+                self.cache_write_tokens += getattr(usage, 'cache_creation_input_tokens', None) or 0
+            case 'message_delta':
+                self.output_tokens = event.usage.output_tokens or 0
+            case 'content_block_delta':
+                if self.first_token_at is None:
+                    self.first_token_at = time.perf_counter()
+                match event.delta.type:
+                    case 'thinking_delta':
+                        self.thinking_chars += len(event.delta.thinking)
+                    case 'text_delta':
+                        self.text_chars += len(event.delta.text)
+
+    def finish(self, telemetry:Telemetry) -> None:
+        finished_at = time.perf_counter()
+        model = self.model
+        telemetry.inc('llm_requests_total', model=model)
+        telemetry.observe('llm_stream_seconds', finished_at - self.started_at, model=model)
+        if self.first_token_at is not None:
+            telemetry.observe('llm_time_to_first_token_seconds', self.first_token_at - self.started_at, model=model)
+            if finished_at > self.first_token_at and self.output_tokens > 0:
+                telemetry.observe('llm_output_tokens_per_second', self.output_tokens / (finished_at - self.first_token_at), model=model)
+        # the api only reports total output tokens, they are split between thinking and the rest by streamed characters
+        streamed_chars = self.thinking_chars + self.text_chars
+        thinking_tokens = round(self.output_tokens * self.thinking_chars / streamed_chars) if streamed_chars > 0 else 0
+        for kind, value in (('input', self.input_tokens), ('output', self.output_tokens), ('cache_read', self.cache_read_tokens), ('cache_write', self.cache_write_tokens), ('thinking', thinking_tokens), ('text', self.output_tokens - thinking_tokens)):
+            if value > 0:
+                telemetry.inc('llm_tokens_total', value, model=model, kind=kind)
+        telemetry.trace(
+            'llm_stream',
+            model=model,
+            duration=finished_at - self.started_at,
+            ttft=self.first_token_at - self.started_at if self.first_token_at is not None else None,
+            input_tokens=self.input_tokens,
+            output_tokens=self.output_tokens,
+            thinking_tokens=thinking_tokens,
+            cache_read_tokens=self.cache_read_tokens,
+            cache_write_tokens=self.cache_write_tokens
+        )
+
+def traced_stream(stream:Iterable[Any], model:str, started_at:float) -> Iterator[Any]:
+    stats = StreamStats(model, started_at)
+    try:
+        for event in stream:
+            stats.update(event)
+            yield event
+    finally:
+        stats.finish(telemetry)
+
+async def atraced_stream(stream:AsyncIterable[Any], model:str, started_at:float) -> AsyncIterator[Any]:
+    stats = StreamStats(model, started_at)
+    try:
+        async for event in stream:
+            stats.update(event)
+            yield event
+    finally:
+        stats.finish(telemetry)
+
+telemetry = Telemetry()
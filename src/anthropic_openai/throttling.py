@@ -0,0 +1,254 @@
+import time
+import asyncio
+import threading
+
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager, suppress
+from pydantic import BaseModel
+
+from typing import Dict, Tuple, Optional, Iterator, AsyncIterator, Iterable, AsyncIterable, Deque, Any
+
+from .log import logger
+
+class ProviderLimits(BaseModel):
+    max_concurrency:int = 8
+    requests_per_minute:Optional[int] = None
+    tokens_per_minute:Optional[int] = None
+
+class TokenBucket:
+    def __init__(self, capacity:float, refill_per_second:float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.level = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now:float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def delay(self, amount:float, now:float) -> float:
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_second
+
+    def consume(self, amount:float) -> None:
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount:float) -> None:
+        # positive amount refunds an over-estimate, negative amount charges an under-estimate
+        self.level = min(self.capacity, self.level + amount)
+
+class _Waiter:
+    __slots__ = ('tokens', 'event', 'loop')
+    def __init__(self, tokens:int, loop:Optional[asyncio.AbstractEventLoop]=None):
+        self.tokens = tokens
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+
+    def wake(self) -> None:
+        if self.loop is None:
+            self.event.set()
+        else:
+            with suppress(RuntimeError):  # the waiting loop may already be closed
+                self.loop.call_soon_threadsafe(self.event.set)
+
+class Reservation:
+    __slots__ = ('limiter', 'tokens', 'queue_wait', 'released')
+    def __init__(self, limiter:'ProviderLimiter', tokens:int, queue_wait:float):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.queue_wait = queue_wait
+        self.released = False
+
+    def release(self, used_tokens:Optional[int]=None) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.limiter.release(self, used_tokens)
+
+class ProviderLimiter:
+    def __init__(self, name:str, limits:ProviderLimits):
+        self.name = name
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.waiters:Deque[_Waiter] = deque()
+        self.active = 0
+        self.request_bucket:Optional[TokenBucket] = None
+        self.token_bucket:Optional[TokenBucket] = None
+        if limits.requests_per_minute:
+            self.request_bucket = TokenBucket(limits.requests_per_minute, limits.requests_per_minute / 60)
+        if limits.tokens_per_minute:
+            self.token_bucket = TokenBucket(limits.tokens_per_minute, limits.tokens_per_minute / 60)
+
+    def _admit(self, waiter:_Waiter) -> Optional[float]:
+        # must be called with self.lock held
+        # returns 0.0 when admitted, a delay in seconds when a bucket is empty, None when blocked by the queue or the concurrency cap
+        if self.waiters[0] is not waiter or self.active >= self.limits.max_concurrency:
+            return None
+        now = time.monotonic()
+        delay = 0.0
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.delay(1, now))
+        if self.token_bucket is not None:
+            delay = max(delay, self.token_bucket.delay(waiter.tokens, now))
+        if delay > 0:
+            return delay
+        if self.request_bucket is not None:
+            self.request_bucket.consume(1)
+        if self.token_bucket is not None:
+            self.token_bucket.consume(waiter.tokens)
+        self.active += 1
+        self.waiters.popleft()
+        self._wake_head()
+        return 0.0
+
+    def _wake_head(self) -> None:
+        if len(self.waiters) > 0:
+            self.waiters[0].wake()
+
+    def _cancel(self, waiter:_Waiter) -> None:
+        with self.lock:
+            was_head = len(self.waiters) > 0 and self.waiters[0] is waiter
+            try:
+                self.waiters.remove(waiter)
+            except ValueError:
+                return
+            if was_head:
+                self._wake_head()
+
+    def reserve(self, tokens:int=0) -> Reservation:
+        waiter = _Waiter(tokens)
+        started_at = time.monotonic()
+        with self.lock:
+            self.waiters.append(waiter)
+        try:
+            while True:
+                waiter.event.clear()
+                with self.lock:
+                    delay = self._admit(waiter)
+                if delay == 0.0:
+                    return Reservation(self, tokens, time.monotonic() - started_at)
+                waiter.event.wait(delay)
+        except BaseException:
+            self._cancel(waiter)
+            raise
+
+    async def reserve_async(self, tokens:int=0) -> Reservation:
+        waiter = _Waiter(tokens, asyncio.get_running_loop())
+        started_at = time.monotonic()
+        with self.lock:
+            self.waiters.append(waiter)
+        try:
+            while True:
+                waiter.event.clear()
+                with self.lock:
+                    delay = self._admit(waiter)
+                if delay == 0.0:
+                    return Reservation(self, tokens, time.monotonic() - started_at)
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._cancel(waiter)
+            raise
+
+    def release(self, reservation:Reservation, used_tokens:Optional[int]=None) -> None:
+        with self.lock:
+            self.active -= 1
+            if self.token_bucket is not None and used_tokens is not None:
+                self.token_bucket.adjust(reservation.tokens - used_tokens)
+            self._wake_head()
+
+class RequestScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.provider_limits:Dict[str, ProviderLimits] = {
+            'anthropic': ProviderLimits(max_concurrency=8, requests_per_minute=50, tokens_per_minute=80_000),
+            'openai': ProviderLimits(max_concurrency=16, requests_per_minute=500, tokens_per_minute=400_000)
+        }
+        self.model_limits:Dict[Tuple[str, str], ProviderLimits] = {}
+        self.limiters:Dict[Tuple[str, str], ProviderLimiter] = {}
+
+    def configure(self, provider:str, limits:ProviderLimits, model:Optional[str]=None) -> None:
+        with self.lock:
+            if model is None:
+                self.provider_limits[provider] = limits
+                for key in [ key for key in self.limiters if key[0] == provider and key not in self.model_limits ]:
+                    del self.limiters[key]
+            else:
+                self.model_limits[(provider, model)] = limits
+                self.limiters.pop((provider, model), None)
+        logger.info(f'rate limits for {provider}/{model or "*"} were set to {limits.model_dump()}')
+
+    def limiter(self, provider:str, model:str) -> ProviderLimiter:
+        key = (provider, model)
+        with self.lock:
+            limiter = self.limiters.get(key)
+            if limiter is None:
+                limits = self.model_limits.get(key, self.provider_limits.get(provider, ProviderLimits()))
+                limiter = ProviderLimiter(f'{provider}/{model}', limits)
+                self.limiters[key] = limiter
+            return limiter
+
+    def reserve(self, provider:str, model:str, tokens:int=0) -> Reservation:
+        return self.limiter(provider, model).reserve(tokens)
+
+    async def reserve_async(self, provider:str, model:str, tokens:int=0) -> Reservation:
+        return await self.limiter(provider, model).reserve_async(tokens)
+
+    @contextmanager
+    def acquire(self, provider:str, model:str, tokens:int=0) -> Iterator[Reservation]:
+        reservation = self.reserve(provider, model, tokens)
+        try:
+            yield reservation
+        finally:
+            reservation.release()
+
+    @asynccontextmanager
+    async def acquire_async(self, provider:str, model:str, tokens:int=0) -> AsyncIterator[Reservation]:
+        reservation = await self.reserve_async(provider, model, tokens)
+        try:
+            yield reservation
+        finally:
+            reservation.release()
+
+def estimate_tokens(payload:str) -> int:
+    return len(payload) // 4 + 1
+
+def _stream_usage(event:Any, used_tokens:int) -> int:
+    match event.type:
+        case 'message_start':
+            usage = event.message.usage
+            return used_tokens + (usage.input_tokens or 0) + (getattr(usage, 'cache_creation_input_tokens', None) or 0)
+        case 'message_delta':
+            return used_tokens + (event.usage.output_tokens or 0)
+    return used_tokens
+
+def throttled_stream(stream:Iterable[Any], reservation:Reservation) -> Iterator[Any]:
+    # holds the concurrency slot while the model is generating and hands it back on message_delta
+    # so that tools dispatched from the stream can acquire slots of their own
+    used_tokens = 0
+    try:
+        for event in stream:
+            used_tokens = _stream_usage(event, used_tokens)
+            if event.type == 'message_delta':
+                reservation.release(used_tokens)
+            yield event
+    finally:
+        reservation.release(used_tokens or None)
+
+async def athrottled_stream(stream:AsyncIterable[Any], reservation:Reservation) -> AsyncIterator[Any]:
+    used_tokens = 0
+    try:
+        async for event in stream:
+            used_tokens = _stream_usage(event, used_tokens)
+            if event.type == 'message_delta':
+                reservation.release(used_tokens)
+            yield event
+    finally:
+        reservation.release(used_tokens or None)
+
+request_scheduler = RequestScheduler()
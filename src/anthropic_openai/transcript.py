@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import time
+import struct
+import threading
+
+from contextvars import ContextVar
+
+from .types import Role, ChatMessage
+from typing import List, Dict, Tuple, Optional, Any, BinaryIO
+
+from .log import logger
+
+# every record is a 4 byte big-endian length followed by compact json, a torn write at the tail is detected by its length
+RECORD_HEADER = struct.Struct('>I')
+TRANSCRIPT_ID_PATTERN = re.compile(r'[\w\-.]+')
+
+def encode_record(record:Dict) -> bytes:
+    payload = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+def decode_records(data:bytes) -> Tuple[List[Dict], int]:
+    # returns the complete records and the offset right after the last one
+    records:List[Dict] = []
+    offset, size = 0, len(data)
+    while offset + RECORD_HEADER.size <= size:
+        (length,) = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > size:
+            break
+        try:
+            records.append(json.loads(data[offset + RECORD_HEADER.size:end]))
+        except ValueError:
+            break
+        offset = end
+    return records, offset
+
+def load_message(payload:Dict) -> ChatMessage:
+    # records were validated when they were written, model_construct skips a second validation pass on load
+    return ChatMessage.model_construct(role=Role(payload['role']), content=payload['content'])
+
+class Transcript:
+    # append-only log of the ChatMessages of one session or research job
+    #   m : a message
+    #   c : checkpoint, messages[:n] form completed iterations and s holds the state needed to resume after them
+    #   t : rewind, messages after n are dropped (a resumed job discards its unfinished iteration)
+    # every snapshot_every records the whole state is written to a snapshot and the log restarts as a new generation
+    def __init__(self, store:'TranscriptStore', transcript_id:str):
+        self.store = store
+        self.transcript_id = transcript_id
+        self.lock = threading.Lock()
+        self.messages:List[ChatMessage] = []
+        self.checkpoint_index = 0
+        self.checkpoint_state:Optional[Dict[str, Any]] = None
+        self.generation = 0
+        self.nb_records = 0
+        self.file_pointer:Optional[BinaryIO] = None
+
+    def apply(self, record:Dict) -> None:
+        match record['k']:
+            case 'm':
+                self.messages.append(load_message(record['m']))
+            case 'c':
+                self.checkpoint_index = record['n']
+                self.checkpoint_state = record['s']
+            case 't':
+                del self.messages[record['n']:]
+                self.checkpoint_index = min(self.checkpoint_index, record['n'])
+
+    def load(self) -> None:
+        snapshot_path = self.store.snapshot_path(self.transcript_id)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, mode='rb') as file_pointer:
+                records, _ = decode_records(file_pointer.read())
+            if len(records) > 0:
+                snapshot = records[0]
+                self.generation = snapshot['g']
+                self.messages = [ load_message(payload) for payload in snapshot['m'] ]
+                self.checkpoint_index = snapshot['n']
+                self.checkpoint_state = snapshot['s']
+
+        log_path = self.store.log_path(self.transcript_id, self.generation)
+        if os.path.exists(log_path):
+            with open(log_path, mode='rb') as file_pointer:
+                data = file_pointer.read()
+            records, offset = decode_records(data)
+            for record in records:
+                self.apply(record)
+            self.nb_records = len(records)
+            if offset < len(data):
+                logger.warning(f'transcript {self.transcript_id}: dropping {len(data) - offset} bytes of a torn record')
+                with open(log_path, mode='r+b') as file_pointer:
+                    file_pointer.truncate(offset)
+        self.store.remove_stale_logs(self.transcript_id, self.generation)
+
+    def write(self, records:List[Dict]) -> None:
+        # must be called with self.lock held ; the log is opened lazily so that idle transcripts hold no descriptor
+        if self.file_pointer is None:
+            self.file_pointer = open(self.store.log_path(self.transcript_id, self.generation), mode='ab', buffering=0)
+        self.file_pointer.write(b''.join([ encode_record(record) for record in records ]))
+        if self.store.fsync:
+            os.fsync(self.file_pointer.fileno())
+        self.nb_records += len(records)
+        if self.nb_records >= self.store.snapshot_every:
+            self._compact()
+
+    def append(self, chat_messages:List[ChatMessage]) -> None:
+        records = [ {'k': 'm', 'm': chat_message.model_dump(mode='json')} for chat_message in chat_messages ]
+        with self.lock:
+            self.messages.extend(chat_messages)
+            self.write(records)
+
+    def checkpoint(self, **state:Any) -> None:
+        with self.lock:
+            self.checkpoint_index = len(self.messages)
+            self.checkpoint_state = state
+            self.write([{'k': 'c', 'n': self.checkpoint_index, 's': state}])
+
+    def rewind(self, index:int) -> None:
+        with self.lock:
+            if index >= len(self.messages):
+                return
+            del self.messages[index:]
+            self.checkpoint_index = min(self.checkpoint_index, index)
+            self.write([{'k': 't', 'n': index}])
+
+    def compact(self) -> None:
+        with self.lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        # the snapshot of generation g + 1 is made durable before the log of generation g is dropped
+        started_at = time.perf_counter()
+        generation = self.generation + 1
+        snapshot = {
+            'g': generation,
+            'm': [ chat_message.model_dump(mode='json') for chat_message in self.messages ],
+            'n': self.checkpoint_index,
+            's': self.checkpoint_state
+        }
+        snapshot_path = self.store.snapshot_path(self.transcript_id)
+        with open(snapshot_path + '.tmp', mode='wb') as file_pointer:
+            file_pointer.write(encode_record(snapshot))
+            file_pointer.flush()
+            os.fsync(file_pointer.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+        if self.file_pointer is not None:
+            self.file_pointer.close()
+            self.file_pointer = None
+        self.store.remove_stale_logs(self.transcript_id, generation)
+        self.generation = generation
+        self.nb_records = 0
+        logger.info(f'transcript {self.transcript_id}: snapshot of {len(self.messages)} messages written in {(time.perf_counter() - started_at) * 1000:.1f}ms')
+
+    def close(self) -> None:
+        # releases the descriptor only, a later append reopens the log
+        with self.lock:
+            if self.file_pointer is not None:
+                self.file_pointer.close()
+                self.file_pointer = None
+
+class TranscriptStore:
+    def __init__(self, path:str='transcripts', snapshot_every:int=256, fsync:bool=False):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+
+    def snapshot_path(self, transcript_id:str) -> str:
+        return os.path.join(self.path, f'{transcript_id}.snapshot')
+
+    def log_path(self, transcript_id:str, generation:int) -> str:
+        return os.path.join(self.path, f'{transcript_id}.{generation}.log')
+
+    def remove_stale_logs(self, transcript_id:str, generation:int) -> None:
+        # the previous log is left behind when the process dies between a snapshot and the unlink
+        stale_path = self.log_path(transcript_id, generation - 1)
+        if generation > 0 and os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    def exists(self, transcript_id:str) -> bool:
+        return TRANSCRIPT_ID_PATTERN.fullmatch(transcript_id) is not None and (os.path.exists(self.snapshot_path(transcript_id)) or os.path.exists(self.log_path(transcript_id, 0)))
+
+    def open(self, transcript_id:str) -> Transcript:
+        if TRANSCRIPT_ID_PATTERN.fullmatch(transcript_id) is None:
+            raise ValueError(f'invalid transcript id {transcript_id}')
+        started_at = time.perf_counter()
+        transcript = Transcript(self, transcript_id)
+        transcript.load()
+        if len(transcript.messages) > 0:
+            logger.info(f'transcript {transcript_id}: {len(transcript.messages)} messages loaded in {(time.perf_counter() - started_at) * 1000:.1f}ms')
+        return transcript
+
+    def delete(self, transcript_id:str) -> None:
+        if TRANSCRIPT_ID_PATTERN.fullmatch(transcript_id) is None:
+            return
+        # the research transcripts of a session are named <session>.<tool_use_id>, see open_research_transcript
+        pattern = re.compile(re.escape(transcript_id) + r'(\.[^.]+)?\.(\d+\.log|snapshot|snapshot\.tmp)')
+        for filename in os.listdir(self.path):
+            if pattern.fullmatch(filename) is not None:
+                os.remove(os.path.join(self.path, filename))
+
+current_transcript:ContextVar[Optional[Transcript]] = ContextVar('current_transcript', default=None)
+current_tool_use_id:ContextVar[Optional[str]] = ContextVar('current_tool_use_id', default=None)
+
+def open_research_transcript(transcript_store:Optional[TranscriptStore]) -> Optional[Transcript]:
+    # a research job is checkpointed next to the transcript of the session that called it, under its tool_use id,
+    # so that re-running the dangling tool call of a restored session resumes the job instead of starting over
+    session_transcript = current_transcript.get()
+    tool_use_id = current_tool_use_id.get()
+    if transcript_store is None or session_transcript is None or tool_use_id is None:
+        return None
+    return transcript_store.open(f'{session_transcript.transcript_id}.{tool_use_id}')
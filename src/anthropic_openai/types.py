@@ -14,6 +14,13 @@ class ChatMessage(BaseModel):
     content: str | List[Dict]
 
 
+class Usage(BaseModel):
+    input_tokens:int = 0
+    output_tokens:int = 0
+    cache_creation_input_tokens:int = 0
+    cache_read_input_tokens:int = 0
+
+
 class StopReason(str, Enum):
     END_TURN: str = "end_turn"
     MAX_TOKENS: str = "max_tokens"
@@ -0,0 +1,15 @@
+import sys
+
+import pytest
+
+from anthropic_openai.throttling import request_scheduler, ProviderLimits
+
+@pytest.fixture(autouse=True, scope='session')
+def unlimited_providers():
+    # the mock providers answer instantly, the process-wide rate limits would only slow the suite down
+    saved_limits = dict(request_scheduler.provider_limits)
+    for provider in ('anthropic', 'openai'):
+        request_scheduler.configure(provider, ProviderLimits(max_concurrency=sys.maxsize))
+    yield
+    for provider, limits in saved_limits.items():
+        request_scheduler.configure(provider, limits)
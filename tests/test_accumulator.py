@@ -0,0 +1,47 @@
+import json
+
+from anthropic_openai.accumulator import PartialJSONParser, BlockRecord
+
+DOCUMENT = {'expanded_queries': ['first "quoted" query?', 'second\\query', 'third query'], 'search_context_size': 'medium', 'limit': 12, 'nested': {'flag': True, 'empty': None, 'values': [1.5, -2, []]}}
+
+def is_prefix(partial, value) -> bool:
+    # a snapshot only holds complete values, containers may miss their trailing members
+    match partial:
+        case dict():
+            return isinstance(value, dict) and all([ key in value and is_prefix(item, value[key]) for key, item in partial.items() ])
+        case list():
+            return isinstance(value, list) and len(partial) <= len(value) and all([ is_prefix(item, other) for item, other in zip(partial, value) ])
+    return partial == value
+
+def test_snapshot_at_every_split_is_a_prefix_of_the_document():
+    text = json.dumps(DOCUMENT, indent=1)
+    for split in range(len(text) + 1):
+        parser = PartialJSONParser()
+        parser.feed(text[:split])
+        parser.feed(text[split:split + 7])
+        snapshot = parser.snapshot()
+        assert snapshot is None or is_prefix(snapshot, DOCUMENT)
+    parser = PartialJSONParser()
+    for character in text:
+        parser.feed(character)
+    assert parser.snapshot() == DOCUMENT
+
+def test_partial_arguments_are_throttled_by_growth():
+    arguments = json.dumps({'expanded_queries': [ f'query number {index} about a topic?' for index in range(2000) ]})
+    block = BlockRecord('tool_use', 'simple_web_search', 'toolu_1')
+    snapshots = []
+    for index in range(0, len(arguments), 3):
+        block.chunks.append(arguments[index:index + 3])
+        snapshot = block.partial_arguments()
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    # a few dozen parses of a growing prefix instead of one per completed query
+    assert 5 < len(snapshots) < 40
+    assert all([ is_prefix(snapshot, json.loads(arguments)) for snapshot in snapshots ])
+    assert len(snapshots[-1]['expanded_queries']) > 1500
+    assert block.materialize()['input'] == json.loads(arguments)
+
+def test_partial_arguments_of_other_blocks_are_none():
+    block = BlockRecord('text')
+    block.chunks.append('{"a": 1}')
+    assert block.partial_arguments() is None
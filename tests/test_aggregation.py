@@ -0,0 +1,35 @@
+from anthropic_openai.aggregation import SearchAggregator, PassageIndex, normalize_url
+
+PASSAGE = 'The Rust 1.80 release stabilized lazy cells and exclusive range patterns, and cargo now checks cfg names against the declared features of the crate. Lazy cells replace the once_cell crate in most projects, and the new range patterns make match arms on integer bounds shorter to write.'
+
+def search_result(query:str, *paragraphs:str) -> str:
+    return f'query:{query}\n###\nresult:' + '\n\n'.join(paragraphs)
+
+def test_tracking_parameters_are_stripped():
+    assert normalize_url('https://example.com/a?utm_source=openai&id=3&fbclid=x).') == 'https://example.com/a?id=3'
+    assert normalize_url('https://example.com/a,') == 'https://example.com/a'
+
+def test_duplicates_across_queries_keep_their_sources():
+    aggregator = SearchAggregator()
+    text = aggregator.aggregate([
+        search_result('rust 1.80 release?', f'{PASSAGE} https://blog.rust-lang.org/1.80'),
+        search_result('what is new in rust 1.80?', f'{PASSAGE} https://news.example.com/rust?utm_source=openai')
+    ])
+    assert text.count('lazy cells') == 1
+    assert 'sources (passages left out as duplicates or over the token budget):' in text
+    assert 'https://news.example.com/rust' in text and 'utm_source' not in text
+
+def test_passages_seen_in_earlier_iterations_are_dropped():
+    aggregator = SearchAggregator()
+    index = PassageIndex()
+    aggregator.aggregate([search_result('rust 1.80?', PASSAGE)], index)
+    text = aggregator.aggregate([search_result('rust release notes?', PASSAGE, 'Cargo also gained a new resolver setting for workspaces that prefers versions compatible with the declared rust-version.')], index)
+    assert 'lazy cells' not in text and 'resolver' in text
+
+def test_token_budget_and_failed_searches():
+    aggregator = SearchAggregator(token_budget=80)
+    paragraphs = [ f'Paragraph {index} about topic number {index * 7} covers a distinct subject with its own wording {index * 13} and details {index * 31}.' for index in range(20) ]
+    text = aggregator.aggregate([search_result('topics?', *paragraphs), 'query:broken -> result: error: timeout'])
+    assert 'query:broken -> result: error: timeout' in text
+    assert sum([ 1 for index in range(20) if f'Paragraph {index} ' in text ]) < 20
+    assert len(text) // 4 < 80 + 40
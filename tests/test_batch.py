@@ -0,0 +1,79 @@
+import json
+import asyncio
+
+from anthropic_openai.agent_loop import AgentLoop
+from anthropic_openai.async_agent_loop import AsyncAgentLoop
+from anthropic_openai.batch import BatchRunner, BatchWriter, BatchProgress, load_items, load_done_ids, in_shard
+from anthropic_openai.cache import SearchCache
+from anthropic_openai.mock_providers import ProviderProfile, AgentScript, MockAnthropic, MockOpenAI, AsyncMockAnthropic, AsyncMockOpenAI
+from anthropic_openai.transcript import TranscriptStore
+
+FAST = ProviderProfile(time_to_first_byte=0.0, per_token_delay=0.0)
+
+def write_input(path, queries) -> None:
+    with open(path, mode='w', encoding='utf-8') as file_pointer:
+        for item_id, query in queries:
+            file_pointer.write(json.dumps({'id': item_id, 'query': query} if item_id is not None else {'query': query}) + '\n')
+        file_pointer.write('not json\n\n')
+
+def read_output(path):
+    with open(path, mode='r', encoding='utf-8') as file_pointer:
+        return [ json.loads(line) for line in file_pointer ]
+
+def test_shards_partition_the_input(tmp_path):
+    input_path = tmp_path / 'input.jsonl'
+    write_input(input_path, [ (f'q{index}', f'question {index}') for index in range(40) ] + [(None, 'question without id')])
+    shards = [ load_items(str(input_path), set(), shard_index=index, num_shards=3)[0] for index in range(3) ]
+    item_ids = [ item.item_id for shard in shards for item in shard ]
+    assert len(item_ids) == len(set(item_ids)) == 41
+    assert all([ in_shard(item.item_id, index, 3) for index, shard in enumerate(shards) for item in shard ])
+    items, nb_skipped = load_items(str(input_path), {'q1', 'q2'})
+    assert (len(items), nb_skipped) == (39, 2)
+
+def make_runner(output_path, total:int, transcript_store=None) -> BatchRunner:
+    return BatchRunner(BatchWriter(str(output_path)), BatchProgress(total=total, interval=60.0), transcript_store=transcript_store)
+
+def test_batch_answers_and_restarts_skip_done_queries(tmp_path):
+    input_path, output_path = tmp_path / 'input.jsonl', tmp_path / 'output.jsonl'
+    write_input(input_path, [ (f'q{index}', f'question {index}') for index in range(6) ])
+    store = TranscriptStore(str(tmp_path / 'transcripts'))
+    agent_loop = AgentLoop(
+        openai_api_key='test',
+        anthropic_api_key='test',
+        search_cache=SearchCache(path=None),
+        openai_client=MockOpenAI(profile=FAST, result_tokens=16),
+        anthropic_client=MockAnthropic(script=AgentScript(research_iterations=1, thinking_tokens=16, text_tokens=16, seed=0), profile=FAST),
+        transcript_store=store
+    )
+    items, _ = load_items(str(input_path), load_done_ids(str(output_path)))
+    runner = make_runner(output_path, len(items), store)
+    with agent_loop:
+        runner.run(agent_loop, items, concurrency=3)
+    runner.writer.close()
+    records = read_output(output_path)
+    assert sorted([ record['id'] for record in records ]) == [ f'q{index}' for index in range(6) ]
+    assert all([ record['status'] == 'ok' and record['answer'] for record in records ])
+    # the transcripts of answered queries, and of their research, are removed
+    assert list((tmp_path / 'transcripts').iterdir()) == []
+    assert load_items(str(input_path), load_done_ids(str(output_path))) == ([], 6)
+
+def test_async_batch(tmp_path):
+    input_path, output_path = tmp_path / 'input.jsonl', tmp_path / 'output.jsonl'
+    write_input(input_path, [ (f'q{index}', f'question {index}') for index in range(4) ])
+    items, _ = load_items(str(input_path), set())
+    runner = make_runner(output_path, len(items))
+
+    async def run():
+        agent_loop = AsyncAgentLoop(
+            openai_api_key='test',
+            anthropic_api_key='test',
+            search_cache=SearchCache(path=None),
+            openai_client=AsyncMockOpenAI(profile=FAST, result_tokens=16),
+            anthropic_client=AsyncMockAnthropic(script=AgentScript(research_iterations=1, thinking_tokens=16, text_tokens=16, seed=0), profile=FAST)
+        )
+        async with agent_loop:
+            await runner.arun(agent_loop, items, concurrency=2)
+
+    asyncio.run(run())
+    runner.writer.close()
+    assert sorted([ record['id'] for record in read_output(output_path) if record['status'] == 'ok' ]) == [ f'q{index}' for index in range(4) ]
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+
+import pytest
+
+from anthropic_openai.cache import SearchCache
+
+def make_cache() -> SearchCache:
+    return SearchCache(path=None)
+
+def test_concurrent_misses_are_computed_once():
+    cache = make_cache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute() -> str:
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    threads = [ threading.Thread(target=lambda: results.append(cache.get_or_compute('Some Query?', 'low', compute))) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['result'] * 8
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 7
+    # normalized queries share the entry
+    assert cache.get_or_compute('some query', 'low', lambda: 'other') == 'result'
+
+def test_owner_error_reaches_waiters_and_is_not_cached():
+    cache = make_cache()
+    started, release = threading.Event(), threading.Event()
+
+    def failing() -> str:
+        started.set()
+        release.wait(5)
+        raise RuntimeError('search failed')
+
+    errors = []
+    def call(compute) -> None:
+        try:
+            cache.get_or_compute('q', 'low', compute)
+        except RuntimeError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=call, args=(failing,))
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(target=call, args=(lambda: 'unused',))
+    waiter.start()
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+    assert [ str(e) for e in errors ] == ['search failed', 'search failed']
+    assert cache.get_or_compute('q', 'low', lambda: 'fresh') == 'fresh'
+
+def test_cancelled_waiter_does_not_cancel_the_shared_search():
+    async def main():
+        cache = make_cache()
+        release = asyncio.Event()
+        calls = []
+
+        async def compute() -> str:
+            calls.append(1)
+            await release.wait()
+            return 'result'
+
+        owner = asyncio.create_task(cache.aget_or_compute('q', 'low', compute))
+        await asyncio.sleep(0.05)
+        cancelled_waiter = asyncio.create_task(cache.aget_or_compute('q', 'low', compute))
+        waiter = asyncio.create_task(cache.aget_or_compute('q', 'low', compute))
+        await asyncio.sleep(0.05)
+        cancelled_waiter.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        outcomes = await asyncio.gather(owner, cancelled_waiter, waiter, return_exceptions=True)
+        return outcomes, calls
+
+    (owner, cancelled_waiter, waiter), calls = asyncio.run(main())
+    assert owner == 'result'
+    assert isinstance(cancelled_waiter, asyncio.CancelledError)
+    assert waiter == 'result'
+    assert len(calls) == 1
+
+def test_cancelled_owner_hands_the_search_to_a_waiter():
+    async def main():
+        cache = make_cache()
+        calls = []
+
+        async def compute() -> str:
+            calls.append(1)
+            await asyncio.sleep(0.2 if len(calls) == 1 else 0.01)
+            return f'result {len(calls)}'
+
+        owner = asyncio.create_task(cache.aget_or_compute('q', 'low', compute))
+        await asyncio.sleep(0.05)
+        waiters = [ asyncio.create_task(cache.aget_or_compute('q', 'low', compute)) for _ in range(3) ]
+        await asyncio.sleep(0.05)
+        owner.cancel()
+        outcomes = await asyncio.gather(owner, *waiters, return_exceptions=True)
+        return outcomes, calls, cache.stats()
+
+    (owner, *waiters), calls, stats = asyncio.run(main())
+    assert isinstance(owner, asyncio.CancelledError)
+    # one waiter took over the search, the others coalesced on it
+    assert waiters == ['result 2'] * 3
+    assert len(calls) == 2
+    assert stats['inflight'] == 0
+
+def test_interrupted_sync_owner_does_not_fail_its_waiters():
+    cache = make_cache()
+    started, release = threading.Event(), threading.Event()
+
+    def interrupted() -> str:
+        started.set()
+        release.wait(5)
+        raise KeyboardInterrupt()
+
+    def owner() -> None:
+        with pytest.raises(KeyboardInterrupt):
+            cache.get_or_compute('q', 'low', interrupted)
+
+    results = []
+    owner_thread = threading.Thread(target=owner)
+    owner_thread.start()
+    started.wait(5)
+    waiter = threading.Thread(target=lambda: results.append(cache.get_or_compute('q', 'low', lambda: 'recomputed')))
+    waiter.start()
+    release.set()
+    owner_thread.join(5)
+    waiter.join(5)
+    assert results == ['recomputed']
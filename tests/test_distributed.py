@@ -0,0 +1,196 @@
+import time
+import socket
+import threading
+
+import zmq
+import pytest
+
+from concurrent.futures import CancelledError
+
+from anthropic_openai.distributed import RemoteSearchClient, RemoteJobError, encode, decode, JOB, RESULT
+
+def free_address() -> str:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return f'tcp://127.0.0.1:{probe.getsockname()[1]}'
+
+def recv(sock:zmq.Socket, timeout:float=5.0):
+    assert sock.poll(timeout * 1000), 'nothing received in time'
+    return sock.recv_multipart()
+
+@pytest.fixture
+def fake_broker():
+    # a ROUTER standing in for the broker frontend, the test answers the client jobs by hand
+    context = zmq.Context()
+    address = free_address()
+    router = context.socket(zmq.ROUTER)
+    router.setsockopt(zmq.LINGER, 0)
+    router.bind(address)
+    yield address, router
+    context.destroy(linger=0)
+
+def test_late_reply_to_a_cancelled_request_keeps_the_client_alive(fake_broker):
+    address, router = fake_broker
+    client = RemoteSearchClient(address)
+    try:
+        cancelled = client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+        client_id, command, job_id, payload = recv(router)
+        assert command == JOB and decode(payload)['kind'] == 'search'
+        assert cancelled.cancel()
+        router.send_multipart([client_id, RESULT, job_id, encode('too late')])
+        # a reply that does not follow the protocol is dropped as well
+        router.send_multipart([client_id, RESULT, b'garbage'])
+
+        answered = client.submit('search', {'query': 'other', 'search_context_size': 'low'})
+        client_id, _, job_id, _ = recv(router)
+        router.send_multipart([client_id, RESULT, job_id, encode('fresh')])
+        assert answered.result(timeout=5) == 'fresh'
+        assert client.thread.is_alive()
+        with pytest.raises(CancelledError):
+            cancelled.result(timeout=0)
+    finally:
+        client.close()
+
+def test_remote_errors_and_close_reach_the_callers(fake_broker):
+    address, router = fake_broker
+    client = RemoteSearchClient(address)
+    failing = client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+    client_id, _, job_id, _ = recv(router)
+    router.send_multipart([client_id, b'ERROR', job_id, b'boom'])
+    with pytest.raises(RemoteJobError, match='boom'):
+        failing.result(timeout=5)
+    pending = client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+    cancelled = client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+    cancelled.cancel()
+    client.close()
+    with pytest.raises(RemoteJobError, match='closed'):
+        pending.result(timeout=0)
+
+def test_deep_research_jobs_get_a_timeout_per_iteration(fake_broker):
+    address, router = fake_broker
+    client = RemoteSearchClient(address, research_iteration_timeout=100.0)
+    try:
+        client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+        client.submit('deep_iterative_web_search', {'query': 'q', 'user_contraints': '', 'task_complexity': 'high', 'max_iterations': 3})
+        client.submit('search', {'query': 'q', 'search_context_size': 'low'}, timeout=7.0)
+        timeouts = [ decode(recv(router)[3])['timeout'] for _ in range(3) ]
+        assert timeouts == [None, 400.0, 7.0]
+    finally:
+        client.close()
+
+class FakeWorker:
+    # a DEALER speaking the worker protocol, jobs are answered (or not) by the test
+    def __init__(self, context:zmq.Context, address:str, capacity:int=1):
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+        self.socket.send_multipart([b'READY', encode({'capacity': capacity})])
+
+    def next_job(self, timeout:float=5.0):
+        while True:
+            frames = recv(self.socket, timeout)
+            if frames[0] == JOB:
+                return frames[1], decode(frames[2])
+
+    def answer(self, job_id:bytes, result) -> None:
+        self.socket.send_multipart([RESULT, job_id, encode(result)])
+
+@pytest.fixture
+def broker():
+    from anthropic_openai.distributed import SearchBroker
+    frontend, backend = free_address(), free_address()
+    search_broker = SearchBroker(frontend, backend, heartbeat_interval=0.2, liveness=50, job_timeout=0.5, max_attempts=2)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=search_broker.run, args=(stop_event,), daemon=True)
+    thread.start()
+    context = zmq.Context()
+    yield search_broker, frontend, backend, context
+    stop_event.set()
+    thread.join(5)
+    context.destroy(linger=0)
+
+def test_broker_requeues_a_timed_out_job_to_another_worker(broker):
+    search_broker, frontend, backend, context = broker
+    slow = FakeWorker(context, backend)
+    time.sleep(0.2)
+    client = RemoteSearchClient(frontend)
+    try:
+        future = client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+        job_id, request = slow.next_job()
+        assert request['kind'] == 'search'
+        fast = FakeWorker(context, backend)
+        # the first attempt times out after job_timeout, the job goes to the worker with free capacity
+        requeued_id, _ = fast.next_job()
+        assert requeued_id == job_id
+        fast.answer(job_id, 'from the second worker')
+        assert future.result(timeout=5) == 'from the second worker'
+        # the late answer of the first worker is ignored
+        slow.answer(job_id, 'too late')
+        time.sleep(0.2)
+        assert len(search_broker.jobs) == 0
+    finally:
+        client.close()
+
+def test_broker_gives_up_after_max_attempts(broker):
+    _, frontend, backend, context = broker
+    worker = FakeWorker(context, backend, capacity=4)
+    time.sleep(0.2)
+    client = RemoteSearchClient(frontend)
+    try:
+        future = client.submit('search', {'query': 'q', 'search_context_size': 'low'})
+        first_id, _ = worker.next_job()
+        second_id, _ = worker.next_job()
+        assert first_id == second_id
+        with pytest.raises(RemoteJobError, match='timed out after 2 attempts'):
+            future.result(timeout=5)
+    finally:
+        client.close()
+
+def test_broker_honours_the_timeout_of_a_deep_research_job(broker):
+    search_broker, frontend, backend, context = broker
+    worker = FakeWorker(context, backend)
+    time.sleep(0.2)
+    client = RemoteSearchClient(frontend, research_iteration_timeout=1.0)
+    try:
+        future = client.submit('deep_iterative_web_search', {'query': 'q', 'user_contraints': '', 'task_complexity': 'low', 'max_iterations': 1})
+        job_id, _ = worker.next_job()
+        # well past the broker default of 0.5s, within the 2s given to a one iteration research
+        time.sleep(1.2)
+        worker.answer(job_id, [{'type': 'text', 'text': 'report'}])
+        assert future.result(timeout=5) == [{'type': 'text', 'text': 'report'}]
+    finally:
+        client.close()
+
+class EchoWorker:
+    # SearchWorker without an agent loop, a job returns its arguments
+    @staticmethod
+    def make(address:str, capacity:int):
+        from anthropic_openai.distributed import SearchWorker
+
+        class Worker(SearchWorker):
+            def execute(self, kind, arguments):
+                return arguments
+
+        return Worker(None, address, capacity=capacity, heartbeat_interval=0.2, liveness=50)
+
+def test_worker_takes_a_burst_of_jobs_in_one_wakeup(fake_broker):
+    address, router = fake_broker
+    worker = EchoWorker.make(address, capacity=16)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=worker.run, args=(stop_event,), daemon=True)
+    thread.start()
+    try:
+        worker_id, command, _ = recv(router)
+        assert command == b'READY'
+        for index in range(64):
+            router.send_multipart([worker_id, JOB, index.to_bytes(2, 'big'), encode({'kind': 'echo', 'arguments': {'index': index}})])
+        results = {}
+        deadline = time.monotonic() + 10
+        while len(results) < 64 and time.monotonic() < deadline:
+            frames = recv(router)
+            if frames[1] == RESULT:
+                results[int.from_bytes(frames[2], 'big')] = decode(frames[3])['index']
+        assert results == { index: index for index in range(64) }
+    finally:
+        stop_event.set()
+        thread.join(5)
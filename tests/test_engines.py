@@ -0,0 +1,50 @@
+import time
+import asyncio
+
+from anthropic_openai import AgentLoop, AsyncAgentLoop, Role, ChatMessage, StopReason
+from anthropic_openai.cache import SearchCache
+from anthropic_openai.mock_providers import ProviderProfile, AgentScript, MockAnthropic, MockOpenAI, AsyncMockAnthropic, AsyncMockOpenAI
+from anthropic_openai.sinks import NullSink, current_sink
+
+FAST = ProviderProfile(time_to_first_byte=0.0, per_token_delay=0.0)
+
+def script() -> AgentScript:
+    return AgentScript(research_iterations=2, queries_per_search=3, thinking_tokens=32, text_tokens=32, seed=0)
+
+def shape(conversation_history):
+    return [ (chat_message.role, [ block['type'] for block in chat_message.content ] if isinstance(chat_message.content, list) else 'text') for chat_message in conversation_history ]
+
+def test_both_engines_run_the_same_turn():
+    token = current_sink.set(NullSink())
+    try:
+        sync_history = [ChatMessage(role=Role.USER, content='question')]
+        sync_loop = AgentLoop(openai_api_key='test', anthropic_api_key='test', search_cache=SearchCache(path=None), openai_client=MockOpenAI(profile=FAST), anthropic_client=MockAnthropic(script=script(), profile=FAST))
+        with sync_loop:
+            sync_stop_reason = sync_loop.handle_turn(sync_history)
+
+        async def run():
+            async_history = [ChatMessage(role=Role.USER, content='question')]
+            async_loop = AsyncAgentLoop(openai_api_key='test', anthropic_api_key='test', search_cache=SearchCache(path=None), openai_client=AsyncMockOpenAI(profile=FAST), anthropic_client=AsyncMockAnthropic(script=script(), profile=FAST))
+            async with async_loop:
+                return await async_loop.handle_turn(async_history), async_history, async_loop
+
+        async_stop_reason, async_history, async_loop = asyncio.run(run())
+    finally:
+        current_sink.reset(token)
+    assert sync_stop_reason == async_stop_reason == StopReason.END_TURN
+    assert shape(sync_history) == shape(async_history)
+    assert sync_loop.anthropic_client.nb_requests == async_loop.anthropic_client.nb_requests == 5
+    assert sync_loop.openai_client.nb_requests == async_loop.openai_client.nb_requests == 6
+
+def test_async_fan_out_runs_searches_concurrently():
+    async def run():
+        agent_loop = AsyncAgentLoop(openai_api_key='test', anthropic_api_key='test', search_cache=SearchCache(path=None), openai_client=AsyncMockOpenAI(profile=ProviderProfile(time_to_first_byte=0.2, per_token_delay=0.0)))
+        async with agent_loop:
+            started_at = time.monotonic()
+            result = await asyncio.gather(*[ agent_loop.simple_web_search([ f'session {session} query {index}?' for index in range(8) ], 'low') for session in range(16) ])
+            return result, time.monotonic() - started_at
+
+    result, elapsed = asyncio.run(run())
+    # 128 searches of 0.2s on one event loop
+    assert elapsed < 1.0
+    assert all([ text[0]['text'].count('query:') == 8 for text in result ])
@@ -0,0 +1,55 @@
+import pytest
+import asyncio
+
+from openai.types.chat import ChatCompletion
+
+from anthropic_openai.mock_providers import MockOpenAI, AsyncMockOpenAI, ProviderProfile, record_completion, load_recorded_completions, record_stream, load_recorded_streams, ReplayScript, MockAnthropic, synthetic_message_events
+
+def recorded_completion(content:str, completion_tokens:int) -> ChatCompletion:
+    return ChatCompletion.model_validate({
+        'id': 'chatcmpl-1',
+        'object': 'chat.completion',
+        'created': 0,
+        'model': 'gpt-4o-mini-search-preview',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': 12, 'completion_tokens': completion_tokens, 'total_tokens': 12 + completion_tokens}
+    })
+
+def test_recorded_search_completions_are_replayed_in_turn(tmp_path):
+    path = str(tmp_path / 'searches.jsonl')
+    for index in range(2):
+        completion = recorded_completion(f'answer {index} https://example.org/{index}', 1000 * (index + 1))
+        assert record_completion(completion, path) is completion
+    completions = load_recorded_completions(path)
+    profile = ProviderProfile(time_to_first_byte=0.0, per_token_delay=0.0)
+    client = MockOpenAI(profile=profile, completions=completions)
+    contents = [ client.chat.completions.create(messages=[{'role': 'user', 'content': 'q'}]).choices[0].message.content for _ in range(3) ]
+    assert contents == ['answer 0 https://example.org/0', 'answer 1 https://example.org/1', 'answer 0 https://example.org/0']
+    assert client.chat.completions.create(messages=[{'role': 'user', 'content': 'q'}]).usage.total_tokens == 2012
+
+def test_replayed_latency_follows_the_recorded_size():
+    completions = [ recorded_completion('short', 100).model_dump(mode='json'), recorded_completion('long', 4000).model_dump(mode='json') ]
+    client = AsyncMockOpenAI(profile=ProviderProfile(time_to_first_byte=0.5, per_token_delay=0.001), completions=completions)
+    delays = [ client.next_completion([{'role': 'user', 'content': 'q'}])[1] for _ in range(2) ]
+    assert delays == pytest.approx([0.6, 4.5])
+
+def test_synthetic_completions_without_a_recording():
+    client = AsyncMockOpenAI(profile=ProviderProfile(time_to_first_byte=0.0, per_token_delay=0.0, seed=1), result_tokens=50)
+    completion = asyncio.run(client.chat.completions.create(messages=[{'role': 'user', 'content': 'q'}]))
+    assert completion.usage.completion_tokens == 50
+    assert 'https://example.org/' in completion.choices[0].message.content
+
+def test_recorded_anthropic_streams_are_replayed(tmp_path):
+    import random
+    from types import SimpleNamespace
+    path = str(tmp_path / 'streams.jsonl')
+    events = synthetic_message_events(random.Random(0), thinking_tokens=8, text_tokens=8)
+
+    class Event(SimpleNamespace):
+        def model_dump(self, mode:str='python'):
+            return self.raw
+
+    assert len(list(record_stream([ Event(raw=event) for event in events ], path))) == len(events)
+    client = MockAnthropic(script=ReplayScript(load_recorded_streams(path)), profile=ProviderProfile(time_to_first_byte=0.0, per_token_delay=0.0))
+    replayed = list(client.messages.create(messages=[]))
+    assert [ event.type for event in replayed ] == [ event['type'] for event in events ]
@@ -0,0 +1,105 @@
+import time
+import asyncio
+
+from anthropic_openai.agent_loop import AgentLoop
+from anthropic_openai.async_agent_loop import AsyncAgentLoop
+from anthropic_openai.cache import SearchCache
+from anthropic_openai.history import synthesize_research
+from anthropic_openai.mock_providers import ProviderProfile, AgentScript, MockAnthropic, MockOpenAI, AsyncMockAnthropic, AsyncMockOpenAI
+from anthropic_openai.novelty import NoveltyScheduler, ResearchJob
+from anthropic_openai.types import Role, ChatMessage, Usage
+
+FAST = ProviderProfile(time_to_first_byte=0.01, per_token_delay=0.0)
+
+def make_agent_loop(anthropic_profile:ProviderProfile, openai_profile:ProviderProfile, scheduler:NoveltyScheduler) -> AgentLoop:
+    return AgentLoop(
+        openai_api_key='test',
+        anthropic_api_key='test',
+        search_cache=SearchCache(path=None),
+        openai_client=MockOpenAI(profile=openai_profile, result_tokens=64),
+        anthropic_client=MockAnthropic(script=AgentScript(research_iterations=3, thinking_tokens=64, text_tokens=64, seed=0), profile=anthropic_profile),
+        research_scheduler=scheduler
+    )
+
+def make_async_agent_loop(anthropic_profile:ProviderProfile, openai_profile:ProviderProfile, scheduler:NoveltyScheduler) -> AsyncAgentLoop:
+    return AsyncAgentLoop(
+        openai_api_key='test',
+        anthropic_api_key='test',
+        search_cache=SearchCache(path=None),
+        openai_client=AsyncMockOpenAI(profile=openai_profile, result_tokens=64),
+        anthropic_client=AsyncMockAnthropic(script=AgentScript(research_iterations=3, thinking_tokens=64, text_tokens=64, seed=0), profile=anthropic_profile),
+        research_scheduler=scheduler
+    )
+
+def test_overrun_is_checked_against_the_current_iteration():
+    job = ResearchJob('query', 1024, 3, max_tokens=1000)
+    assert job.overrun(Usage(input_tokens=600)) is None
+    job.tokens_used = 500
+    assert job.overrun(Usage(input_tokens=600)).startswith('token budget')
+    job = ResearchJob('query', 1024, 3, max_seconds=10.0)
+    assert job.bound(600.0) <= 10.0
+    assert job.bound(None) <= 10.0
+    assert ResearchJob('query', 1024, 3).bound(600.0) == 600.0
+
+def test_slow_searches_are_cut_off_at_the_deadline():
+    agent_loop = make_agent_loop(FAST, ProviderProfile(time_to_first_byte=2.0, per_token_delay=0.0), NoveltyScheduler(max_seconds=0.5))
+    with agent_loop:
+        started_at = time.monotonic()
+        result = agent_loop.deep_iterative_web_search('question', 'none', 'low', 3)
+        elapsed = time.monotonic() - started_at
+    assert elapsed < 1.5
+    assert result[0]['text'].startswith('research stopped before its final answer (wall clock budget')
+
+def test_slow_stream_is_cut_off_at_the_deadline():
+    agent_loop = make_agent_loop(ProviderProfile(time_to_first_byte=0.01, per_token_delay=0.02), FAST, NoveltyScheduler(max_seconds=0.3))
+    with agent_loop:
+        started_at = time.monotonic()
+        result = agent_loop.deep_iterative_web_search('question', 'none', 'low', 3)
+        elapsed = time.monotonic() - started_at
+    assert elapsed < 1.0
+    assert result[0]['text'].startswith('research stopped before its final answer (wall clock budget')
+
+def test_token_budget_stops_the_iteration_that_exceeds_it():
+    agent_loop = make_agent_loop(FAST, FAST, NoveltyScheduler(max_tokens=100))
+    with agent_loop:
+        result = agent_loop.deep_iterative_web_search('question', 'none', 'low', 3)
+    assert agent_loop.anthropic_client.nb_requests == 1
+    assert result[0]['text'].startswith('research stopped before its final answer (token budget')
+
+def test_stalled_async_stream_is_cut_off_at_the_deadline():
+    async def run():
+        agent_loop = make_async_agent_loop(ProviderProfile(time_to_first_byte=5.0, per_token_delay=0.0), FAST, NoveltyScheduler(max_seconds=0.3))
+        async with agent_loop:
+            started_at = time.monotonic()
+            result = await agent_loop.deep_iterative_web_search('question', 'none', 'low', 3)
+            return result, time.monotonic() - started_at
+
+    result, elapsed = asyncio.run(run())
+    assert elapsed < 1.0
+    assert result[0]['text'].startswith('research stopped before its final answer (wall clock budget')
+
+def test_slow_async_searches_are_cut_off_at_the_deadline():
+    async def run():
+        agent_loop = make_async_agent_loop(FAST, ProviderProfile(time_to_first_byte=5.0, per_token_delay=0.0), NoveltyScheduler(max_seconds=0.5))
+        async with agent_loop:
+            started_at = time.monotonic()
+            result = await agent_loop.deep_iterative_web_search('question', 'none', 'low', 3)
+            return result, time.monotonic() - started_at
+
+    result, elapsed = asyncio.run(run())
+    assert elapsed < 1.5
+    assert 'research budget spent' in result[0]['text']
+
+def test_synthesis_keeps_findings_and_searched_material():
+    conversation_history = [
+        ChatMessage(role=Role.USER, content='query: question'),
+        ChatMessage(role=Role.ASSISTANT, content=[{'type': 'thinking', 'thinking': 'hidden', 'signature': ''}, {'type': 'text', 'text': 'First finding.'}, {'type': 'tool_use', 'name': 'simple_web_search', 'input': {}, 'id': 'toolu_1'}]),
+        ChatMessage(role=Role.USER, content=[{'type': 'tool_result', 'tool_use_id': 'toolu_1', 'content': [{'type': 'text', 'text': 'Rust 1.80 was released, see https://example.com/rust'}]}]),
+        ChatMessage(role=Role.ASSISTANT, content=[{'type': 'text', 'text': 'Second finding.'}]),
+        ChatMessage(role=Role.USER, content=[{'type': 'tool_result', 'tool_use_id': 'toolu_2', 'is_error': True, 'content': 'failed'}])
+    ]
+    synthesis = synthesize_research(conversation_history, 'wall clock budget: 10.0s spent of 10.0s')
+    assert synthesis.startswith('research stopped before its final answer (wall clock budget')
+    assert 'First finding.\n\nSecond finding.' in synthesis
+    assert 'sources: https://example.com/rust' in synthesis
+    assert 'hidden' not in synthesis and 'failed' not in synthesis
@@ -0,0 +1,38 @@
+from concurrent.futures import Future
+
+from anthropic_openai.prefetch import QueryProposalParser, SearchPrefetcher, PrefetchIndex
+
+def test_proposals_are_returned_as_their_line_completes():
+    parser = QueryProposalParser()
+    text = 'Findings so far.\n\n### Follow-up searches\n1. **rust 1.80 lazy cell**\n- "cargo cfg checks"\n* x\nSomething else.\n- not a proposal anymore\n'
+    queries = []
+    for index in range(0, len(text), 5):
+        queries.extend(parser.feed(text[index:index + 5]))
+    queries.extend(parser.close())
+    assert queries == ['rust 1.80 lazy cell', 'cargo cfg checks']
+
+def test_last_line_is_parsed_on_close():
+    parser = QueryProposalParser()
+    assert parser.feed('Next queries:\n- tokio runtime internals') == []
+    assert parser.close() == ['tokio runtime internals']
+
+def test_prefetched_search_is_taken_once_and_waste_is_counted():
+    prefetcher = SearchPrefetcher(max_inflight=2, max_per_job=8, search_context_size='medium')
+    index = PrefetchIndex()
+    used = prefetcher.admit(index, 'Rust 1.80?', 'medium')
+    unused = prefetcher.admit(index, 'cargo cfg checks', 'medium')
+    assert prefetcher.admit(index, 'rust 1.80', 'medium') is None
+    assert prefetcher.admit(index, 'a third query', 'medium') is None
+    for entry in (used, unused):
+        future = Future()
+        prefetcher.attach(entry, future)
+        future.set_result(f'result for {entry.query}')
+
+    # a larger context size than the speculative one is searched again
+    assert prefetcher.take(index, 'rust 1.80', 'high') is None
+    assert prefetcher.take(index, 'rust 1.80', 'low') is used
+    assert prefetcher.take(index, 'rust 1.80', 'low') is None
+    prefetcher.finish(index)
+    stats = prefetcher.stats()
+    assert (stats['launched'], stats['hits'], stats['wasted'], stats['capped'], stats['inflight']) == (2, 1, 1, 1, 0)
+    assert stats['wasted_tokens'] > 0
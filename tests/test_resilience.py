@@ -0,0 +1,102 @@
+import time
+import asyncio
+
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from anthropic_openai.resilience import Resilience, ResiliencePolicy, CircuitBreaker, CircuitOpenError
+
+class ProviderDown(ConnectionError):
+    pass
+
+class BadRequest(Exception):
+    status_code = 400
+
+def make_resilience(**policy) -> Resilience:
+    resilience = Resilience()
+    resilience.configure('test', ResiliencePolicy(backoff_base=0.001, backoff_max=0.01, **policy))
+    return resilience
+
+def test_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure(BadRequest())
+    breaker.record_failure(ProviderDown())
+    breaker.allow()
+    breaker.record_failure(ProviderDown())
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    time.sleep(0.06)
+    breaker.allow()
+    # a single probe is let through while half open
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_failure(ProviderDown())
+    assert breaker.state == 'open'
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+
+def test_call_retries_retryable_errors_only():
+    resilience = make_resilience(max_retries=3)
+    attempts = []
+
+    def flaky() -> str:
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ProviderDown('reset')
+        return 'ok'
+
+    assert resilience.call('test', 'model', flaky) == 'ok'
+    assert len(attempts) == 3
+
+    def bad_request() -> str:
+        attempts.append(1)
+        raise BadRequest('invalid')
+
+    attempts.clear()
+    with pytest.raises(BadRequest):
+        resilience.call('test', 'model', bad_request)
+    assert len(attempts) == 1
+
+def test_open_breaker_fails_fast():
+    resilience = make_resilience(max_retries=0, breaker_failure_threshold=1)
+
+    def down() -> str:
+        raise ProviderDown('down')
+
+    with pytest.raises(ProviderDown):
+        resilience.call('test', 'model', down)
+    with pytest.raises(CircuitOpenError):
+        resilience.call('test', 'model', lambda: 'never called')
+
+def test_slow_call_is_hedged():
+    resilience = make_resilience(timeout=5.0, hedge=True, hedge_min_samples=1, hedge_min_delay=0.05)
+    resilience.tracker('test', 'model').observe(0.01)
+    calls = []
+
+    def search() -> str:
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(1.0)
+            return 'slow'
+        return 'fast'
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        started_at = time.monotonic()
+        assert resilience.call('test', 'model', search, hedge_executor=executor) == 'fast'
+        assert time.monotonic() - started_at < 0.5
+
+def test_async_call_times_out_then_raises():
+    resilience = make_resilience(timeout=0.05, max_retries=1)
+    attempts = []
+
+    async def stalled() -> str:
+        attempts.append(1)
+        await asyncio.sleep(1.0)
+        return 'late'
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(resilience.acall('test', 'model', stalled))
+    assert len(attempts) == 2
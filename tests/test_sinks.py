@@ -0,0 +1,62 @@
+import io
+import time
+import json
+import asyncio
+
+from anthropic_openai.sinks import TerminalSink, StructuredSink, QueueSink
+
+class RecordingFile(io.StringIO):
+    def __init__(self):
+        super(RecordingFile, self).__init__()
+        self.nb_writes = 0
+
+    def write(self, text:str) -> int:
+        self.nb_writes += 1
+        return super(RecordingFile, self).write(text)
+
+def test_deltas_are_written_at_block_boundaries():
+    file_pointer = RecordingFile()
+    sink = TerminalSink(file_pointer=file_pointer, flush_interval=10.0)
+    sink.emit({'type': 'block_start', 'block': 'text'})
+    for index in range(100):
+        sink.emit({'type': 'text_delta', 'text': f'{index} '})
+    nb_writes = file_pointer.nb_writes
+    sink.emit({'type': 'block_stop', 'block': 'text'})
+    sink.close()
+    assert nb_writes == 1
+    assert file_pointer.getvalue() == '<response>\n' + ''.join([ f'{index} ' for index in range(100) ]) + '\n</response>\n'
+
+def test_stalled_block_is_flushed_after_the_interval():
+    file_pointer = RecordingFile()
+    sink = TerminalSink(file_pointer=file_pointer, flush_interval=0.05)
+    sink.emit({'type': 'block_start', 'block': 'text'})
+    sink.emit({'type': 'text_delta', 'text': 'partial'})
+    assert 'partial' not in file_pointer.getvalue()
+    time.sleep(0.2)
+    assert file_pointer.getvalue().endswith('partial')
+    sink.close()
+
+def test_structured_sink_writes_one_document_per_event():
+    file_pointer = io.StringIO()
+    sink = StructuredSink(file_pointer=file_pointer)
+    sink.emit({'type': 'message_start'})
+    sink.emit({'type': 'text_delta', 'text': 'hello'})
+    sink.emit({'type': 'message_stop', 'stop_reason': 'end_turn'})
+    sink.close()
+    events = [ json.loads(line) for line in file_pointer.getvalue().splitlines() ]
+    assert [ event['type'] for event in events ] == ['message_start', 'text_delta', 'message_stop']
+
+def test_queue_sink_backpressure():
+    async def run():
+        sink = QueueSink(max_pending=4)
+        for index in range(4):
+            sink.emit({'type': 'text_delta', 'text': str(index)})
+        assert sink.backlogged and not sink.writable.is_set()
+        events = [ await sink.get() for _ in range(2) ]
+        assert sink.writable.is_set()
+        sink.close()
+        while (event := await sink.get()) is not None:
+            events.append(event)
+        return [ event['text'] for event in events ]
+
+    assert asyncio.run(run()) == ['0', '1', '2', '3']
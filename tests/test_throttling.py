@@ -0,0 +1,69 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from anthropic_openai.throttling import TokenBucket, ProviderLimiter, ProviderLimits
+
+def test_token_bucket_delay_refill_and_adjust():
+    bucket = TokenBucket(capacity=60, refill_per_second=1)
+    now = bucket.updated_at
+    assert bucket.delay(60, now) == 0.0
+    bucket.consume(60)
+    assert bucket.delay(10, now) == pytest.approx(10.0)
+    assert bucket.delay(10, now + 4) == pytest.approx(6.0)
+    # a request larger than the bucket waits for a full bucket instead of forever
+    assert bucket.delay(1000, now + 4) == pytest.approx(56.0)
+    bucket.adjust(30)
+    assert bucket.level == pytest.approx(34.0)
+    bucket.adjust(1000)
+    assert bucket.level == 60
+
+def test_concurrency_cap_admits_waiters_in_order():
+    limiter = ProviderLimiter('test', ProviderLimits(max_concurrency=1))
+    first = limiter.reserve()
+    admitted = []
+
+    def reserve(index:int) -> None:
+        reservation = limiter.reserve()
+        admitted.append(index)
+        reservation.release()
+
+    threads = []
+    for index in range(4):
+        threads.append(threading.Thread(target=reserve, args=(index,)))
+        threads[-1].start()
+        # the next waiter is only queued once the previous one is
+        while len(limiter.waiters) < index + 1:
+            time.sleep(0.001)
+    assert admitted == []
+    first.release()
+    for thread in threads:
+        thread.join(5)
+    assert admitted == [0, 1, 2, 3]
+    assert limiter.active == 0
+
+def test_tokens_per_minute_delays_and_refunds():
+    limiter = ProviderLimiter('test', ProviderLimits(max_concurrency=8, tokens_per_minute=600))
+    reservation = limiter.reserve(tokens=600)
+    reservation.release(used_tokens=540)
+    # 60 refunded tokens cover the next request, the one after waits for 10 tokens/s
+    assert limiter.reserve(tokens=60).queue_wait < 0.05
+    assert limiter.reserve(tokens=3).queue_wait == pytest.approx(0.3, abs=0.1)
+
+def test_cancelled_async_waiter_leaves_the_queue():
+    async def run():
+        limiter = ProviderLimiter('test', ProviderLimits(max_concurrency=1))
+        first = await limiter.reserve_async()
+        cancelled = asyncio.ensure_future(limiter.reserve_async())
+        waiting = asyncio.ensure_future(limiter.reserve_async())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+        first.release()
+        second = await asyncio.wait_for(waiting, 1)
+        second.release()
+        return len(limiter.waiters), limiter.active
+
+    assert asyncio.run(run()) == (0, 0)
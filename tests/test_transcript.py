@@ -0,0 +1,87 @@
+import os
+
+from anthropic_openai.agent_loop import AgentLoop
+from anthropic_openai.cache import SearchCache
+from anthropic_openai.mock_providers import ProviderProfile, AgentScript, MockAnthropic, MockOpenAI
+from anthropic_openai.transcript import TranscriptStore, current_transcript, current_tool_use_id
+from anthropic_openai.types import Role, ChatMessage
+
+FAST = ProviderProfile(time_to_first_byte=0.0, per_token_delay=0.0)
+
+def message(index:int) -> ChatMessage:
+    return ChatMessage(role=Role.USER if index % 2 == 0 else Role.ASSISTANT, content=f'message {index}')
+
+def test_resume_restores_messages_and_checkpoint(tmp_path):
+    store = TranscriptStore(str(tmp_path), snapshot_every=4)
+    transcript = store.open('session')
+    for index in range(6):
+        transcript.append([message(index)])
+    transcript.checkpoint(iteration=2, done=False)
+    transcript.append([message(6)])
+    transcript.close()
+
+    resumed = store.open('session')
+    assert [ chat_message.content for chat_message in resumed.messages ] == [ f'message {index}' for index in range(7) ]
+    assert resumed.checkpoint_index == 6 and resumed.checkpoint_state == {'iteration': 2, 'done': False}
+    resumed.rewind(resumed.checkpoint_index)
+    resumed.close()
+    assert len(store.open('session').messages) == 6
+
+def test_torn_record_is_dropped(tmp_path):
+    store = TranscriptStore(str(tmp_path))
+    transcript = store.open('session')
+    transcript.append([message(0), message(1)])
+    transcript.close()
+    with open(store.log_path('session', 0), mode='ab') as file_pointer:
+        file_pointer.write(b'\x00\x00\x01\x00{"k":')
+    assert len(store.open('session').messages) == 2
+
+def test_delete_removes_the_research_transcripts_of_a_session(tmp_path):
+    store = TranscriptStore(str(tmp_path), snapshot_every=2)
+    for transcript_id in ('session', 'session.toolu_1', 'session.toolu_2', 'other', 'other.toolu_1', 'session-2'):
+        transcript = store.open(transcript_id)
+        transcript.append([message(0), message(1), message(2)])
+        transcript.close()
+    store.delete('session')
+    assert sorted(set([ filename.split('.')[0] for filename in os.listdir(tmp_path) ])) == ['other', 'session-2']
+    assert store.exists('other.toolu_1')
+
+def run_research(tmp_path, fail_at:int=None) -> TranscriptStore:
+    store = TranscriptStore(str(tmp_path))
+    agent_loop = AgentLoop(
+        openai_api_key='test',
+        anthropic_api_key='test',
+        search_cache=SearchCache(path=None),
+        openai_client=MockOpenAI(profile=FAST, result_tokens=16),
+        anthropic_client=MockAnthropic(script=AgentScript(research_iterations=3, thinking_tokens=16, text_tokens=16, seed=0), profile=FAST),
+        transcript_store=store
+    )
+    handle_conversation = agent_loop.handle_conversation
+    calls = []
+
+    def failing_handle_conversation(*args, **kwargs):
+        calls.append(1)
+        # handle_conversation reports api errors as a missing stream
+        return None if len(calls) == fail_at else handle_conversation(*args, **kwargs)
+
+    agent_loop.handle_conversation = failing_handle_conversation
+    session_transcript = store.open('session')
+    transcript_token, tool_use_id_token = current_transcript.set(session_transcript), current_tool_use_id.set('toolu_1')
+    try:
+        with agent_loop:
+            agent_loop.deep_iterative_web_search('question', 'none', 'low', 3)
+    finally:
+        current_transcript.reset(transcript_token)
+        current_tool_use_id.reset(tool_use_id_token)
+        session_transcript.close()
+    return store
+
+def test_completed_research_deletes_its_checkpoints(tmp_path):
+    store = run_research(tmp_path)
+    assert not store.exists('session.toolu_1')
+
+def test_failed_research_keeps_its_checkpoints(tmp_path):
+    store = run_research(tmp_path, fail_at=2)
+    assert store.exists('session.toolu_1')
+    transcript = store.open('session.toolu_1')
+    assert transcript.checkpoint_state['iteration'] == 1 and not transcript.checkpoint_state['done']